@@ -6,7 +6,7 @@ from django.db import models
 from django.urls import reverse_lazy
 from django.utils.html import format_html
 
-from .models import Address, Firm
+from .models import Address, Firm, Subscription
 from .models import AvUser
 from .models import Bank
 from .models import SecurityQuestion
@@ -117,7 +117,16 @@ class UserAdmin(BaseUserAdmin):
         return fieldsets
 
 
+class SubscriptionInline(admin.StackedInline):
+    model = Subscription
+    can_delete = False
+    readonly_fields = ('stripe_id', 'plan_id', 'interval', 'status', 'max_cpa', 'max_client', 'trial_end',
+                       'current_period_end', 'date_modified')
+    exclude = ('date_created',)
+
+
 class FirmAdmin(admin.ModelAdmin):
+    inlines = [SubscriptionInline]
 
     list_display = ('__str__', 'is_paid', 'trial_end', 'trial_days_left', 'cpa_count', 'client_count')
 
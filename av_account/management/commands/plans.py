@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from av_account.utils import invalidate_plans, refresh_plans
+
+
+class Command(BaseCommand):
+    help = 'Warms the Stripe plan cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--invalidate', action='store_true', help='Only drop the cached plans')
+
+    def handle(self, *args, **options):
+        if options['invalidate']:
+            invalidate_plans()
+            self.stdout.write(self.style.SUCCESS('Invalidated cached plans.'))
+            return
+
+        plans = refresh_plans()
+        self.stdout.write(self.style.SUCCESS('Cached %s plans.' % len(plans)))
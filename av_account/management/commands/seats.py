@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, IntegerField, Sum, When
+
+from av_account.models import AvUser, Firm
+from av_utils.utils import bulk_update
+
+
+def seat_counts():
+    """
+    :return: (cpa_count, client_count) keyed by firm id, from a single grouped query
+    """
+    rows = AvUser.objects \
+        .exclude(firm=None) \
+        .values('firm_id') \
+        .annotate(cpas=Sum(Case(When(is_cpa=True, then=1), default=0, output_field=IntegerField())),
+                  clients=Sum(Case(When(is_cpa=False, then=1), default=0, output_field=IntegerField())))
+    return {row['firm_id']: (row['cpas'], row['clients']) for row in rows}
+
+
+class Command(BaseCommand):
+    help = 'Recounts firm seats and repairs any counters that drifted'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # lock firms so seat changes made meanwhile wait for the repaired counters
+            firms = list(Firm.objects.select_for_update())
+            counts = seat_counts()
+
+            drifted = []
+            for firm in firms:
+                cpa_count, client_count = counts.get(firm.id, (0, 0))
+                if (firm.cpa_count, firm.client_count) != (cpa_count, client_count):
+                    self.stdout.write('Firm {} had {} cpas and {} clients, counted {} and {}.'.format(
+                        firm.id, firm.cpa_count, firm.client_count, cpa_count, client_count))
+                    firm.cpa_count, firm.client_count = cpa_count, client_count
+                    drifted.append(firm)
+
+            bulk_update(Firm, drifted, Firm.COUNTER_FIELDS)
+
+        self.stdout.write(self.style.SUCCESS('Checked %s firms and repaired %s.' % (len(firms), len(drifted))))
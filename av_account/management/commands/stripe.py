@@ -1,105 +1,236 @@
-import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import stripe
-from django.core.management.base import BaseCommand
-
-from av_account.models import Communications, Firm
-from av_core import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from av_account.models import Communications, Firm, Subscription, from_stripe_timestamp
+from av_account.utils import refresh_plans
+from av_core import settings, logger
 from av_emails.utils import send_trial_end_email, send_trial_final_email
+from av_utils.utils import bulk_update
+
+# notified firms whose emails and communications are written together
+RECORD_BATCH = 100
+
+MIRROR_FIELDS = ('stripe_id', 'plan_id', 'interval', 'status', 'max_cpa', 'max_client', 'trial_end',
+                 'current_period_end')
+
+
+def parse_shard(value):
+    try:
+        shard, shards = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise CommandError('Shard should look like N/M, e.g. 0/4')
+    if not 0 <= shard < shards:
+        raise CommandError('Shard N/M needs 0 <= N < M')
+    return shard, shards
 
 
 class Command(BaseCommand):
     help = 'Synchronizes with Stripe'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', default='0/1', help='Only sync firms whose id modulo M is N, given as N/M')
+        parser.add_argument('--workers', type=int, default=8, help='Number of concurrent stripe and email calls')
+
     def handle(self, *args, **options):
+        started = time.time()
+        shard, shards = parse_shard(options['shard'])
+
         stripe.api_key = settings.STRIPE_SECRET_KEY
 
-        # retrieve all plans at once for speed
-        plans = stripe.Plan.list()
+        # retrieve all plans at once for speed, this also keeps the plan cache warm
+        plans = refresh_plans()
 
         # pluck out the plans we are interested in
         # default to a monthly plan, so as not to automatically charge for a whole year
-        plan_a = next(x for x in plans.data if x.id == settings.STRIPE_PLANS['monthly']['a'])
-        plan_b = next(x for x in plans.data if x.id == settings.STRIPE_PLANS['monthly']['b'])
-        plan_c = next(x for x in plans.data if x.id == settings.STRIPE_PLANS['monthly']['c'])
-        
-        # grab all cpa accounts
-        firms = Firm.objects.all()
-        self.stdout.write('Found %s firms.' % len(firms))
-        
-        # iterate over all firms
-        count = 0
-        for firm in firms:
-            
-            # ensure firm has stripe id
-            if firm.stripe_id:
-
-                # grab customer object and ensure we do have a subscription
-                customer = stripe.Customer.retrieve(firm.stripe_id)
-                if customer is not None and customer.subscriptions.total_count > 0:
-                
-                    # get firm subscription
-                    subscription = customer.subscriptions.data[0]
-                    
-                    # update trial end time
-                    firm.trial_end = datetime.datetime.fromtimestamp(subscription.trial_end, datetime.timezone.utc)
-
-                    # update status
-                    if subscription.status in ('trialing', 'active', 'past_due'):
-                        firm.is_paid = True
-                    else:
-                        firm.is_paid = False
-
-                    firm.save()
-                    count += 1
-                    
-                    # may need to email the boss
-                    boss = firm.boss
-
-                    self.stdout.write('Firm {} has {} trial days left.'.format(firm, firm.trial_days_left()))
-
-                    # look up past communications to see if we've already emailed about an ending trial
-                    comms, created = Communications.objects.get_or_create(user=boss)
-
-                    # get usage counts
-                    cpa_count = firm.cpa_count()
-                    client_count = firm.client_count()
-
-                    # figure out candidate plan based on usage
-                    plan = plan_a
-                    if cpa_count > int(plan_a.metadata.max_cpa) or client_count > int(plan_a.metadata.max_client):
-                        plan = plan_b
-                        if cpa_count > int(plan_b.metadata.max_cpa) or client_count > int(plan_b.metadata.max_client):
-                            plan = plan_c
-                    plan.amount = round(plan.amount / 100)
-
-                    # send 3 day warning
-                    if firm.trial_days_left() <= 3 and comms.trial_end_reminders < 1:
-                        # email warning to cpa
-                        send_trial_end_email(boss, plan.metadata.name, plan.amount)
-    
-                        # record that email was sent
-                        comms.trial_end_reminders = comms.trial_end_reminders + 1
-                        comms.save()
-
-                    self.stdout.write('  current interval: {}'.format(subscription.plan.interval))
-
-                    # change plan before trial end and send notice, only if user didn't switch to a yearly plan already
-                    if firm.trial_days_left() < 1 and comms.trial_change_notice < 1 and subscription.plan.interval != 'year':
-                        # email warning to cpa
-                        send_trial_final_email(boss, plan.metadata.name, plan.amount)
-
-                        # change customer plan
-                        stripe.Subscription.modify(subscription.id,
-                                                   cancel_at_period_end=False,
-                                                   items=[{
-                                                       'id': subscription['items']['data'][0].id,
-                                                       'plan': plan.id,
-                                                   }]
-                                                   )
-    
-                        # record that email was sent
-                        comms.trial_change_notice = comms.trial_change_notice + 1
-                        comms.save()
-
-        self.stdout.write(self.style.SUCCESS('Updated %s firms.' % count))
+        plan_a = plans[settings.STRIPE_PLANS['monthly']['a']]
+        plan_b = plans[settings.STRIPE_PLANS['monthly']['b']]
+        plan_c = plans[settings.STRIPE_PLANS['monthly']['c']]
+
+        # grab all cpa accounts in this shard
+        firms = Firm.objects.exclude(stripe_id=None).annotate(shard=F('id') % shards).filter(shard=shard)
+        firms = {firm.stripe_id: firm for firm in firms.select_related('boss')}
+        self.stdout.write('Found %s firms in shard %s/%s.' % (len(firms), shard, shards))
+
+        subscriptions = self.list_subscriptions(firms, shards, options['workers'])
+        self.stdout.write('Listed %s subscriptions in %.1fs.' % (len(subscriptions), time.time() - started))
+
+        comms = self.communications(firm.boss_id for firm in firms.values() if firm.boss_id)
+
+        # update trial end time and status, writing only what changed
+        changed = []
+        for customer, subscription in subscriptions.items():
+            firm = firms[customer]
+            before = (firm.trial_end, firm.is_paid)
+            if subscription.trial_end is not None:
+                firm.trial_end = from_stripe_timestamp(subscription.trial_end)
+            firm.is_paid = subscription.status in Subscription.PAID_STATUSES
+            if (firm.trial_end, firm.is_paid) != before:
+                changed.append(firm)
+
+        with transaction.atomic():
+            bulk_update(Firm, changed, ['trial_end', 'is_paid'])
+            self.update_mirrors(firms, subscriptions)
+        self.stdout.write('Wrote %s changed firms in %.1fs.' % (len(changed), time.time() - started))
+
+        # figure out which bosses need to hear about their trial, without any io
+        jobs = []
+        for customer, subscription in subscriptions.items():
+            firm = firms[customer]
+            if firm.boss is None or firm.trial_end is None:
+                continue
+
+            # look up past communications to see if we've already emailed about an ending trial
+            comm = comms[firm.boss_id]
+
+            # figure out candidate plan based on usage
+            cpa_count, client_count = firm.cpa_count, firm.client_count
+            plan = plan_a
+            if cpa_count > int(plan_a['metadata']['max_cpa']) or client_count > int(plan_a['metadata']['max_client']):
+                plan = plan_b
+                if cpa_count > int(plan_b['metadata']['max_cpa']) or client_count > int(plan_b['metadata']['max_client']):
+                    plan = plan_c
+
+            days_left = firm.trial_days_left()
+
+            # send 3 day warning
+            warn = days_left <= 3 and comm.trial_end_reminders < 1
+
+            # change plan before trial end and send notice, only if user didn't switch to a yearly plan already
+            change = days_left < 1 and comm.trial_change_notice < 1 and subscription.plan.interval != 'year'
+
+            if warn or change:
+                jobs.append((firm, subscription, plan, warn, change))
+
+        # the remaining per firm calls go to stripe, so run them concurrently
+        # each firm's outcome is recorded as it arrives, so a failing firm or an interrupted run loses none of
+        # the plan changes made, which would otherwise be made and announced again next run
+        outcomes = []
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {executor.submit(self.notify, job): job for job in jobs}
+            for done, future in enumerate(as_completed(futures), 1):
+                job = futures[future]
+                try:
+                    outcomes.append((job, future.result()))
+                except Exception as e:
+                    firm, subscription, plan, warn, change = job
+                    logger.exception('Trial notification error for firm %s: %s', firm.id, e)
+                    # the plan change is made last, so it did not go through, the warning does not depend on it
+                    outcomes.append((job, (warn, False)))
+                if len(outcomes) == RECORD_BATCH:
+                    self.record(outcomes, comms)
+                    outcomes = []
+                if done % 100 == 0:
+                    self.stdout.write('  notified %s of %s firms' % (done, len(jobs)))
+        self.record(outcomes, comms)
+
+        self.stdout.write(self.style.SUCCESS('Updated %s firms and notified %s in %.1fs.' % (
+            len(subscriptions), len(jobs), time.time() - started)))
+
+    def record(self, outcomes, comms):
+        """
+        Queues the emails of notified firms and records them as sent together
+        :param outcomes: list of (job, (warned, changed plan))
+        """
+        updated_comms = []
+        with transaction.atomic():
+            for (firm, subscription, plan, warn, change), (warned, changed_plan) in outcomes:
+                amount = round(plan['amount'] / 100)
+                if warned:
+                    send_trial_end_email(firm.boss, plan['metadata']['name'], amount)
+                if changed_plan:
+                    send_trial_final_email(firm.boss, plan['metadata']['name'], amount)
+
+                comm = comms[firm.boss_id]
+                comm.trial_end_reminders += 1 if warned else 0
+                comm.trial_change_notice += 1 if changed_plan else 0
+                updated_comms.append(comm)
+            bulk_update(Communications, updated_comms, ['trial_end_reminders', 'trial_change_notice'])
+
+    def list_subscriptions(self, firms, shards, workers):
+        """
+        Pages through all subscriptions instead of retrieving each customer
+        A shard only lists its own customers' subscriptions, so M shards do not each list the whole account
+        :return: newest subscription of each firm, keyed by customer id
+        """
+        if shards > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                listed = executor.map(self.customer_subscription, firms)
+            return {customer: subscription for customer, subscription in zip(firms, listed)
+                    if subscription is not None}
+
+        subscriptions = {}
+        # newest first, including canceled subscriptions so their firms lose access
+        for subscription in stripe.Subscription.list(status='all', limit=100).auto_paging_iter():
+            if subscription.customer in firms and subscription.customer not in subscriptions:
+                subscriptions[subscription.customer] = subscription
+        return subscriptions
+
+    def customer_subscription(self, customer):
+        # runs in a worker thread, newest first as above
+        subscriptions = stripe.Subscription.list(customer=customer, status='all', limit=1).data
+        return subscriptions[0] if subscriptions else None
+
+    def communications(self, user_ids):
+        """
+        :return: Communications keyed by user id, creating any that are missing
+        """
+        user_ids = set(user_ids)
+        existing = set(Communications.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+        Communications.objects.bulk_create([Communications(user_id=user_id) for user_id in user_ids - existing])
+        return {comm.user_id: comm for comm in Communications.objects.filter(user_id__in=user_ids)}
+
+    def update_mirrors(self, firms, subscriptions):
+        mirrors = Subscription.objects.filter(firm__stripe_id__in=subscriptions.keys())
+        mirrors = {mirror.firm_id: mirror for mirror in mirrors}
+
+        created = []
+        changed = []
+        for customer, subscription in subscriptions.items():
+            firm = firms[customer]
+            mirror = mirrors.get(firm.id)
+            if mirror is None:
+                mirror = Subscription(firm=firm)
+                mirror.update_from_stripe(subscription)
+                created.append(mirror)
+            else:
+                before = [getattr(mirror, field) for field in MIRROR_FIELDS]
+                mirror.update_from_stripe(subscription)
+                if [getattr(mirror, field) for field in MIRROR_FIELDS] != before:
+                    mirror.date_modified = timezone.now()
+                    changed.append(mirror)
+
+        Subscription.objects.bulk_create(created)
+        bulk_update(Subscription, changed, MIRROR_FIELDS + ('date_modified',))
+
+    def notify(self, job):
+        """
+        Runs in a worker thread, changing the plan of a firm whose trial ended
+        Emails are queued by the main thread afterwards, only the outbox sends them
+        :return: (warning due, plan changed)
+        """
+        firm, subscription, plan, warn, change = job
+        changed = False
+
+        self.stdout.write('Firm {} has {} trial days left.'.format(firm, firm.trial_days_left()))
+
+        if change:
+            # change customer plan last, and only tell the cpa once it went through
+            try:
+                stripe.Subscription.modify(subscription.id,
+                                           cancel_at_period_end=False,
+                                           items=[{
+                                               'id': subscription['items']['data'][0].id,
+                                               'plan': plan['id'],
+                                           }]
+                                           )
+                changed = True
+            except stripe.error.StripeError as e:
+                logger.error('Stripe plan change error for firm %s: %s', firm.id, e)
+
+        return warn, changed
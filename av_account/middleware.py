@@ -0,0 +1,78 @@
+from collections import namedtuple
+
+from django.utils.functional import SimpleLazyObject
+
+from av_account.models import AvUser, Firm
+
+
+class AuthSnapshot(namedtuple('AuthSnapshot', 'user_id is_cpa firm groups is_full_cred is_trusted')):
+    """
+    What the permission mixins and menus need to know about the requesting user, read once per request
+    """
+    __slots__ = ()
+
+    @property
+    def is_admin(self):
+        return self.is_cpa and 'admin' in self.groups
+
+    @property
+    def is_associate(self):
+        return self.is_cpa and 'associate' in self.groups
+
+
+ANONYMOUS = AuthSnapshot(None, False, None, frozenset(), False, False)
+
+
+def build_auth_snapshot(request):
+    """
+    Loads the user's firm and group names with a single joined query
+    The firm is also cached on request.user, so views reading request.user.firm don't query it again
+    """
+    user = request.user
+    if not user.is_authenticated:
+        return ANONYMOUS
+
+    firm_fields = [field.name for field in Firm._meta.concrete_fields]
+    rows = list(AvUser.objects
+                .filter(id=user.id)
+                .values_list(*['firm__' + name for name in firm_fields] + ['groups__name']))
+
+    # one row per group, with the firm columns repeated on each
+    firm = None
+    if rows and rows[0][0] is not None:
+        firm = Firm.from_db(AvUser.objects.db, [field.attname for field in Firm._meta.concrete_fields],
+                            rows[0][:len(firm_fields)])
+    user.firm = firm
+
+    agent = getattr(request, 'agent', None)
+    return AuthSnapshot(
+        user_id=user.id,
+        is_cpa=user.is_cpa,
+        firm=firm,
+        groups=frozenset(row[-1] for row in rows if row[-1] is not None),
+        is_full_cred=user.is_full_cred(),
+        is_trusted=agent is not None and agent.is_trusted,
+    )
+
+
+def get_auth_snapshot(request):
+    """
+    :return: the request's AuthSnapshot, built here if AuthSnapshotMiddleware did not run, e.g. with RequestFactory
+    """
+    snapshot = getattr(request, 'auth_snapshot', None)
+    if snapshot is None:
+        snapshot = request.auth_snapshot = build_auth_snapshot(request)
+    return snapshot
+
+
+class AuthSnapshotMiddleware(object):
+    """
+    Sets request.auth_snapshot, built on first use
+    Must come after AuthenticationMiddleware and django_agent_trust's AgentMiddleware
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.auth_snapshot = SimpleLazyObject(lambda: build_auth_snapshot(request))
+        return self.get_response(request)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 10:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_account', '0013_avuser_is_2fa'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Subscription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date created')),
+                ('date_modified', models.DateTimeField(auto_now=True, verbose_name='date modified')),
+                ('stripe_id', models.CharField(max_length=64)),
+                ('plan_id', models.CharField(max_length=64)),
+                ('interval', models.CharField(blank=True, max_length=16)),
+                ('status', models.CharField(blank=True, max_length=32)),
+                ('max_cpa', models.IntegerField(default=0)),
+                ('max_client', models.IntegerField(default=0)),
+                ('trial_end', models.DateTimeField(null=True)),
+                ('current_period_end', models.DateTimeField(null=True)),
+                ('firm', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='av_account.Firm')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
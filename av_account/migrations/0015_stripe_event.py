@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 10:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_account', '0014_subscription'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe_id', models.CharField(max_length=255, unique=True)),
+                ('type', models.CharField(max_length=64)),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date created')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='firm',
+            name='stripe_event_time',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='firm',
+            name='stripe_id',
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 10:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+
+
+def forward(apps, schema_editor):
+    AvUser = apps.get_model('av_account', 'AvUser')
+    Firm = apps.get_model('av_account', 'Firm')
+    for field, is_cpa in (('cpa_count', True), ('client_count', False)):
+        seats = AvUser.objects.filter(firm=OuterRef('pk'), is_cpa=is_cpa) \
+            .order_by().values('firm').annotate(count=Count('pk')).values('count')
+        firms = AvUser.objects.filter(is_cpa=is_cpa).values('firm')
+        Firm.objects.filter(id__in=firms).update(**{field: Subquery(seats)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_account', '0015_stripe_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firm',
+            name='client_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='firm',
+            name='cpa_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(forward, migrations.RunPython.noop),
+    ]
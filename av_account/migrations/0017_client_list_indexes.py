@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 11:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# the client list's case insensitive sorts, which Meta.indexes can't express
+LOWER_INDEXES = [
+    migrations.RunSQL(
+        'CREATE INDEX av_account_avuser_clients_{0} ON av_account_avuser (firm_id, is_cpa, lower({0}), id)'.format(field),
+        'DROP INDEX av_account_avuser_clients_{0}'.format(field),
+    )
+    for field in ('last_name', 'first_name', 'email')
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_account', '0016_firm_seat_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='avuser',
+            index=models.Index(fields=['firm', 'is_cpa', 'is_verified', 'id'], name='av_account__firm_id_715abe_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='avuser',
+            index=models.Index(fields=['firm', 'is_cpa', 'date_created', 'id'], name='av_account__firm_id_2ae49a_idx'),
+        ),
+    ] + LOWER_INDEXES
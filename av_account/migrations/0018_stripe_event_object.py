@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 12:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_account', '0017_client_list_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='firm',
+            name='stripe_event_time',
+        ),
+        migrations.AddField(
+            model_name='stripeevent',
+            name='created',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stripeevent',
+            name='object_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+    ]
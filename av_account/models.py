@@ -1,3 +1,4 @@
+import datetime
 import string
 from secrets import choice
 
@@ -24,13 +25,26 @@ from av_utils.utils import TimeStampedModel
 class Firm(TimeStampedModel):
     name = models.CharField(verbose_name='firm name, as you would like your clients to see it', max_length=150, blank=True)
 
-    stripe_id = models.CharField(null=True, max_length=64)
+    stripe_id = models.CharField(null=True, max_length=64, db_index=True)
     trial_end = models.DateTimeField(null=True)
     is_paid = models.BooleanField(default=False)
 
     # this user's email address is associated with the stripe account
     boss = models.OneToOneField('AvUser', related_name='boss_of', null=True)
 
+    # seats in use, kept current by av_account.signals and repaired by the seats management command
+    cpa_count = models.IntegerField(default=0)
+    client_count = models.IntegerField(default=0)
+
+    COUNTER_FIELDS = ('cpa_count', 'client_count')
+
+    def save(self, *args, **kwargs):
+        # counters are only ever changed with F() updates, so never write back a possibly stale in memory copy
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.COUNTER_FIELDS]
+        super(Firm, self).save(*args, **kwargs)
+
     # user is fully active, i.e. paid or during a trial in the case of CPA user
     def is_full_cred(self):
         if self.stripe_id is None:
@@ -51,12 +65,6 @@ class Firm(TimeStampedModel):
         time_left = self.trial_time_left()
         return time_left.days if self.trial_end is not None else None
 
-    def cpa_count(self):
-        return AvUser.objects.filter(firm=self, is_cpa=True).count()
-
-    def client_count(self):
-        return AvUser.objects.filter(firm=self, is_cpa=False).count()
-
     def get_absolute_url(self):
         return reverse_lazy('team-settings')
 
@@ -64,6 +72,59 @@ class Firm(TimeStampedModel):
         return self.name
 
 
+def from_stripe_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc) if timestamp is not None else None
+
+
+class Subscription(TimeStampedModel):
+    """
+    Local mirror of a firm's stripe subscription, so plan limits can be read without calling stripe
+    Kept up to date by the stripe management command and by plan changes, date_modified is the last sync
+    """
+    # subscription states that still grant access
+    PAID_STATUSES = ('trialing', 'active', 'past_due')
+
+    firm = models.OneToOneField(Firm, on_delete=models.CASCADE)
+
+    stripe_id = models.CharField(max_length=64)
+    plan_id = models.CharField(max_length=64)
+    interval = models.CharField(max_length=16, blank=True)
+    status = models.CharField(max_length=32, blank=True)
+
+    max_cpa = models.IntegerField(default=0)
+    max_client = models.IntegerField(default=0)
+
+    trial_end = models.DateTimeField(null=True)
+    current_period_end = models.DateTimeField(null=True)
+
+    def update_from_stripe(self, subscription):
+        plan = subscription.plan
+        self.stripe_id = subscription.id
+        self.plan_id = plan.id
+        self.interval = plan.interval
+        self.status = subscription.status
+        self.max_cpa = int(plan.metadata.max_cpa)
+        self.max_client = int(plan.metadata.max_client)
+        self.trial_end = from_stripe_timestamp(subscription.trial_end)
+        self.current_period_end = from_stripe_timestamp(subscription.current_period_end)
+
+    def __str__(self):
+        return '{} {}'.format(self.firm, self.plan_id)
+
+
+class StripeEvent(models.Model):
+    """Stripe webhook events that have been applied, so redelivered events are skipped"""
+    stripe_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=64)
+    # subscription or invoice the event is about and when stripe created it, older events arriving late are ignored
+    object_id = models.CharField(max_length=255, blank=True, db_index=True)
+    created = models.DateTimeField(null=True)
+    date_created = models.DateTimeField(_('date created'), default=timezone.now)
+
+    def __str__(self):
+        return '{} {}'.format(self.type, self.stripe_id)
+
+
 class Person(TimeStampedModel):
     first_name = models.CharField(_('first name'), max_length=150, blank=True)
     last_name = models.CharField(_('last name'), max_length=150, blank=True)
@@ -137,6 +198,16 @@ class AvUser(Person, AbstractBaseUser, PermissionsMixin):
     email_verification_code = models.CharField(max_length=16, null=True, blank=True)
     previous_email = models.EmailField(verbose_name='previous email address', max_length=255, null=True, blank=True)
 
+    # seat as last saved, so av_account.signals can move it between firm counters
+    original_firm_id = None
+    original_is_cpa = None
+
+    def __init__(self, *args, **kwargs):
+        super(AvUser, self).__init__(*args, **kwargs)
+        # read from __dict__ so deferred fields are not loaded one query at a time
+        self.original_firm_id = self.__dict__.get('firm_id')
+        self.original_is_cpa = self.__dict__.get('is_cpa')
+
     # user is fully active, i.e. paid or during a trial in the case of CPA user
     def is_full_cred(self):
         if self.is_cpa:
@@ -154,10 +225,10 @@ class AvUser(Person, AbstractBaseUser, PermissionsMixin):
         return self.firm.trial_days_left() if self.is_cpa and self.firm is not None else None
     
     def cpa_count(self):
-        return self.firm.cpa_count()
+        return self.firm.cpa_count
     
     def client_count(self):
-        return self.firm.client_count()
+        return self.firm.client_count
 
     objects = AvUserManager()
 
@@ -167,6 +238,11 @@ class AvUser(Person, AbstractBaseUser, PermissionsMixin):
     class Meta:
         verbose_name = _('user')
         verbose_name_plural = _('users')
+        # for the pages of a firm's client list, the lower() sorts have expression indexes in migration 0017
+        indexes = [
+            models.Index(fields=['firm', 'is_cpa', 'is_verified', 'id']),
+            models.Index(fields=['firm', 'is_cpa', 'date_created', 'id']),
+        ]
 
     def clean(self):
         super().clean()
@@ -220,9 +296,12 @@ class AvUser(Person, AbstractBaseUser, PermissionsMixin):
 
             logger.info('Texted verification code to user {}'.format(request.user))
 
-    def generate_email_code(self):
+    def set_email_code(self):
         self.email_verification_code = ''.join([choice(string.ascii_uppercase + string.digits) for _ in range(16)])
         self.is_email_verified = False
+
+    def generate_email_code(self):
+        self.set_email_code()
         self.save()
 
     def send_email_verification_code(self):
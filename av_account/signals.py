@@ -1,8 +1,36 @@
 from actstream import action
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from av_account.models import Address, Bank, AvUser
+from av_account.models import Address, Bank, AvUser, Firm
+
+
+def change_seats(firm_id, is_cpa, delta):
+    """
+    Adds delta to the firm's cpa or client counter in the database, without reading the firm
+    """
+    if firm_id is None:
+        return
+    field = 'cpa_count' if is_cpa else 'client_count'
+    Firm.objects.filter(id=firm_id).update(**{field: F(field) + delta})
+
+
+@receiver(post_save, sender=AvUser)
+def user_seats_post_save(sender, instance, created, *args, **kwargs):
+    before = (None, None) if created else (instance.original_firm_id, instance.original_is_cpa)
+    after = (instance.firm_id, instance.is_cpa)
+    if before != after:
+        with transaction.atomic():
+            change_seats(*before, -1)
+            change_seats(*after, 1)
+    instance.original_firm_id, instance.original_is_cpa = after
+
+
+@receiver(post_delete, sender=AvUser)
+def user_seats_post_delete(sender, instance, *args, **kwargs):
+    change_seats(instance.original_firm_id, instance.original_is_cpa, -1)
 
 
 # this makes way too much noise, especially when creating a new user
@@ -1,8 +1,19 @@
+import hashlib
+import hmac
+import json
+import time
+from io import StringIO
+from unittest.mock import patch
+
+import stripe
+
 from django.conf import settings
 from django.contrib import auth
 from django.contrib.auth.models import Group
 from django.core import mail
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.utils import timezone
@@ -10,12 +21,26 @@ from freezegun import freeze_time
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from .models import AvUser, SecurityQuestion, UserSecurity, Firm
+from av_utils.stripe import Items, PricedPlan
+from av_utils.testing import CommitCallbacksMixin
+from .management.commands.stripe import Command
+from .models import AvUser, SecurityQuestion, UserSecurity, Firm, Communications, Subscription
+from .utils import PLANS_CACHE_KEY, _plans_local, get_plans, invalidate_plans, sync_subscription
+
+
+def mock_plans():
+    metadata = {'name': 'Proprietor', 'support': 'email', 'max_cpa': '1', 'max_client': '100'}
+    plans = [PricedPlan('plan_unrelated', 100, 'month', 'Other', {})]
+    for interval, amount in (('yearly', 22800), ('monthly', 2500)):
+        for plan_id in settings.STRIPE_PLANS[interval].values():
+            plans.append(PricedPlan(plan_id, amount, interval[:-2], plan_id, metadata))
+    return Items(plans)
 
 
-class AccountTestCase(TestCase):
+class AccountTestCase(CommitCallbacksMixin, TestCase):
 
     def setUp(self):
+        super(AccountTestCase, self).setUp()
         self.password = 'aT%In<Yo'
         self.user = AvUser.objects.create_user(
             email='test@example.com',
@@ -696,3 +721,365 @@ class AccountAPITestCase(APITestCase):
     #
     #     address = Address.objects.get()
     #     self.assertEqual(address.address1, data['address1'])
+
+
+class PlanCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.plans = mock_plans()
+        invalidate_plans()
+
+    def tearDown(self):
+        invalidate_plans()
+
+    @patch("stripe.Plan.list")
+    def test_cached(self, list_mock):
+        list_mock.return_value = self.plans
+
+        plans = get_plans()
+        self.assertEqual(len(plans), 6)
+        self.assertNotIn('plan_unrelated', plans)
+        self.assertEqual(plans[settings.STRIPE_PLANS['yearly']['a']]['metadata']['max_client'], '100')
+
+        get_plans()
+        self.assertEqual(list_mock.call_count, 1)
+
+        invalidate_plans()
+        get_plans()
+        self.assertEqual(list_mock.call_count, 2)
+
+    @patch("stripe.Plan.list")
+    def test_cold_waits_for_fetch(self, list_mock):
+        list_mock.return_value = self.plans
+        plans = get_plans()
+        entry = _plans_local['entry']
+        invalidate_plans()
+
+        class FetchedWhileWaiting(object):
+            # another request held the lock and stored the plans while this one waited for it
+            def __enter__(self):
+                cache.set(PLANS_CACHE_KEY, entry, None)
+
+            def __exit__(self, *args):
+                pass
+
+        with patch('av_account.utils._plans_lock', FetchedWhileWaiting()):
+            self.assertEqual(get_plans(), plans)
+        self.assertEqual(list_mock.call_count, 1)
+
+    @patch("stripe.Plan.list")
+    def test_home(self, list_mock):
+        list_mock.return_value = self.plans
+
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '$19')
+        self.assertContains(response, '$25 with our monthly plan')
+
+        # served from cache, display changes must not leak into the catalog
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, '$19')
+        self.assertEqual(list_mock.call_count, 1)
+
+
+class StripeWebhookTestCase(TestCase):
+
+    def setUp(self):
+        self.firm = Firm(
+            name='acme'
+        )
+        self.firm.stripe_id = 'cus_xxx'
+        self.firm.is_paid = False
+        self.firm.save()
+
+    def post_event(self, event_id, event_type, obj, created, secret='whsec_test'):
+        payload = json.dumps({
+            'id': event_id,
+            'object': 'event',
+            'type': event_type,
+            'created': created,
+            'data': {'object': obj},
+        })
+        timestamp = int(time.time())
+        signed = '{}.{}'.format(timestamp, payload).encode('utf-8')
+        signature = hmac.new(secret.encode('utf-8'), signed, hashlib.sha256).hexdigest()
+        return self.client.post(reverse('stripe-webhook'), payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE='t={},v1={}'.format(timestamp, signature))
+
+    def subscription(self, status):
+        return {
+            'id': 'sub_xxx',
+            'object': 'subscription',
+            'customer': self.firm.stripe_id,
+            'status': status,
+            'trial_end': 1530000000,
+            'current_period_end': 1530000000,
+            'plan': {
+                'id': 'plan_xxx',
+                'object': 'plan',
+                'interval': 'month',
+                'metadata': {'name': 'Proprietor', 'support': 'email', 'max_cpa': '1', 'max_client': '100'},
+            },
+        }
+
+    def test_bad_signature(self):
+        response = self.post_event('evt_1', 'customer.subscription.updated', self.subscription('active'), 100,
+                                   secret='whsec_bogus')
+        self.assertEqual(response.status_code, 400)
+
+        firm = Firm.objects.get(id=self.firm.id)
+        self.assertFalse(firm.is_paid)
+
+    def test_subscription_updated(self):
+        response = self.post_event('evt_1', 'customer.subscription.updated', self.subscription('active'), 100)
+        self.assertEqual(response.status_code, 200)
+
+        firm = Firm.objects.get(id=self.firm.id)
+        self.assertTrue(firm.is_paid)
+        self.assertEqual(firm.trial_end.timestamp(), 1530000000)
+        self.assertEqual(firm.subscription.max_client, 100)
+        self.assertEqual(firm.subscription.status, 'active')
+
+    def test_duplicate(self):
+        self.post_event('evt_1', 'customer.subscription.updated', self.subscription('active'), 100)
+
+        # redelivery of the same event id is ignored
+        response = self.post_event('evt_1', 'customer.subscription.deleted', self.subscription('canceled'), 200)
+        self.assertEqual(response.status_code, 200)
+
+        firm = Firm.objects.get(id=self.firm.id)
+        self.assertTrue(firm.is_paid)
+
+    def test_out_of_order(self):
+        self.post_event('evt_2', 'customer.subscription.deleted', self.subscription('canceled'), 200)
+        self.post_event('evt_1', 'customer.subscription.updated', self.subscription('active'), 100)
+
+        firm = Firm.objects.get(id=self.firm.id)
+        self.assertFalse(firm.is_paid)
+        self.assertEqual(firm.subscription.status, 'canceled')
+
+    def test_unknown_customer(self):
+        # the checkout creates the subscription before it saves the firm's customer
+        self.firm.stripe_id = None
+        self.firm.save()
+        subscription = dict(self.subscription('active'), customer='cus_new')
+        response = self.post_event('evt_1', 'customer.subscription.created', subscription, 100)
+        self.assertEqual(response.status_code, 404)
+
+        # stripe's retry is applied once the firm is saved
+        self.firm.stripe_id = 'cus_new'
+        self.firm.save()
+        response = self.post_event('evt_1', 'customer.subscription.created', subscription, 100)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Firm.objects.get(id=self.firm.id).is_paid)
+
+    def test_order_per_object(self):
+        # an invoice event is not dropped for being older than an event about the subscription
+        self.post_event('evt_2', 'customer.subscription.updated', self.subscription('trialing'), 200)
+        Firm.objects.filter(id=self.firm.id).update(is_paid=False)
+        invoice = {'id': 'in_xxx', 'object': 'invoice', 'customer': self.firm.stripe_id}
+        self.post_event('evt_1', 'invoice.payment_succeeded', invoice, 100)
+        self.assertTrue(Firm.objects.get(id=self.firm.id).is_paid)
+
+    def test_sync_race(self):
+        self.post_event('evt_1', 'customer.subscription.updated', self.subscription('trialing'), 100)
+
+        # as if a webhook created the mirror between this request's lookup and its insert
+        subscription = stripe.util.convert_to_stripe_object(self.subscription('active'))
+        with patch('av_account.utils.get_object_or_None', return_value=None):
+            sync_subscription(self.firm, subscription)
+        self.assertEqual(Subscription.objects.get(firm=self.firm).status, 'active')
+
+    def test_invoice(self):
+        invoice = {'id': 'in_xxx', 'object': 'invoice', 'customer': self.firm.stripe_id}
+        self.post_event('evt_1', 'invoice.payment_succeeded', invoice, 100)
+
+        firm = Firm.objects.get(id=self.firm.id)
+        self.assertTrue(firm.is_paid)
+
+
+class StripeCommandTestCase(CommitCallbacksMixin, TestCase):
+
+    def setUp(self):
+        super(StripeCommandTestCase, self).setUp()
+        self.boss = AvUser.objects.create_user(
+            email='cpa@example.com',
+            password='password',
+            is_cpa=True,
+        )
+
+        self.firm = Firm(
+            name='acme'
+        )
+        self.firm.stripe_id = 'cus_xxx'
+        self.firm.boss = self.boss
+        self.firm.save()
+
+        self.boss.firm = self.firm
+        self.boss.save()
+
+        trial_end = int((timezone.now() + timezone.timedelta(days=2)).timestamp())
+        self.subscription = stripe.Subscription.construct_from({
+            'id': 'sub_xxx',
+            'customer': self.firm.stripe_id,
+            'status': 'trialing',
+            'trial_end': trial_end,
+            'current_period_end': trial_end,
+            'plan': {
+                'id': 'plan_xxx',
+                'interval': 'month',
+                'metadata': {'name': 'Proprietor', 'support': 'email', 'max_cpa': '1', 'max_client': '100'},
+            },
+            'items': {'data': [{'id': 'si_xxx'}]},
+        }, 'key')
+
+        invalidate_plans()
+
+    def tearDown(self):
+        invalidate_plans()
+
+    @patch("stripe.Plan.list")
+    @patch("stripe.Subscription.list")
+    def test_sync(self, subscription_list_mock, plan_list_mock):
+        plan_list_mock.return_value = mock_plans()
+        subscription_list_mock.return_value.auto_paging_iter.return_value = [self.subscription]
+        mail.outbox = []
+
+        call_command('stripe', stdout=StringIO())
+
+        firm = Firm.objects.get(id=self.firm.id)
+        self.assertTrue(firm.is_paid)
+        self.assertEqual(firm.trial_end.timestamp(), self.subscription.trial_end)
+        self.assertEqual(firm.subscription.status, 'trialing')
+
+        # trial ends within 3 days, so the boss is warned exactly once
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(Communications.objects.get(user=self.boss).trial_end_reminders, 1)
+
+        call_command('stripe', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+    @patch("stripe.Subscription.modify")
+    @patch("stripe.Plan.list")
+    @patch("stripe.Subscription.list")
+    def test_notify_error(self, subscription_list_mock, plan_list_mock, modify_mock):
+        # a second firm whose trial ended, so its plan is changed
+        boss = AvUser.objects.create_user(email='cpa2@example.com', password='password', is_cpa=True)
+        firm = Firm.objects.create(name='ended', stripe_id='cus_yyy', boss=boss)
+        boss.firm = firm
+        boss.save()
+        ended = int((timezone.now() - timezone.timedelta(days=1)).timestamp())
+        subscription = stripe.Subscription.construct_from(dict(
+            self.subscription.to_dict_recursive(), id='sub_yyy', customer='cus_yyy', trial_end=ended), 'key')
+
+        plan_list_mock.return_value = mock_plans()
+        subscription_list_mock.return_value.auto_paging_iter.return_value = [self.subscription, subscription]
+        mail.outbox = []
+
+        # the first firm fails unexpectedly, the plan change of the other is still recorded
+        notify = Command.notify
+
+        def failing_notify(command, job):
+            if job[0].id == self.firm.id:
+                raise RuntimeError('boom')
+            return notify(command, job)
+
+        with patch.object(Command, 'notify', failing_notify):
+            call_command('stripe', stdout=StringIO())
+
+        self.assertEqual(modify_mock.call_count, 1)
+        self.assertEqual(Communications.objects.get(user=boss).trial_change_notice, 1)
+        # the warning does not depend on stripe, so the failed firm's boss is warned anyway
+        self.assertEqual(Communications.objects.get(user=self.boss).trial_end_reminders, 1)
+        # the ended trial is warned and told of the change together
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['cpa2@example.com', 'cpa2@example.com', 'cpa@example.com'])
+
+        # nothing is changed or sent again
+        call_command('stripe', stdout=StringIO())
+        self.assertEqual(modify_mock.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+
+    @patch("stripe.Plan.list")
+    @patch("stripe.Subscription.list")
+    def test_shard(self, subscription_list_mock, plan_list_mock):
+        plan_list_mock.return_value = mock_plans()
+        subscription_list_mock.return_value.data = [self.subscription]
+
+        shard = '{}/2'.format((self.firm.id + 1) % 2)
+        call_command('stripe', shard=shard, stdout=StringIO())
+
+        firm = Firm.objects.get(id=self.firm.id)
+        self.assertFalse(firm.is_paid)
+        self.assertFalse(subscription_list_mock.called)
+
+        # a shard asks for its own customers' subscriptions rather than paging through the whole account
+        shard = '{}/2'.format(self.firm.id % 2)
+        call_command('stripe', shard=shard, stdout=StringIO())
+
+        firm = Firm.objects.get(id=self.firm.id)
+        self.assertTrue(firm.is_paid)
+        subscription_list_mock.assert_called_once_with(customer='cus_xxx', status='all', limit=1)
+
+
+class SeatCounterTestCase(TestCase):
+
+    def setUp(self):
+        self.firm = Firm.objects.create(name='acme')
+        self.other = Firm.objects.create(name='other')
+
+        self.cpa = AvUser.objects.create_user(email='cpa@example.com', password='password', is_cpa=True)
+        self.cpa.firm = self.firm
+        self.cpa.save()
+
+        self.client_user = AvUser.objects.create_user(email='client@example.com', password='password')
+        self.client_user.firm = self.firm
+        self.client_user.save()
+
+    def assertSeats(self, firm, cpa_count, client_count):
+        firm = Firm.objects.get(id=firm.id)
+        self.assertEqual((firm.cpa_count, firm.client_count), (cpa_count, client_count))
+
+    def test_counters(self):
+        self.assertSeats(self.firm, 1, 1)
+
+        # saving again without changing seats leaves the counters alone
+        self.client_user.first_name = 'client'
+        self.client_user.save()
+        self.assertSeats(self.firm, 1, 1)
+
+        # moving a client to another firm
+        self.client_user.firm = self.other
+        self.client_user.save()
+        self.assertSeats(self.firm, 1, 0)
+        self.assertSeats(self.other, 0, 1)
+
+        # a reloaded user still knows its seat
+        user = AvUser.objects.get(id=self.client_user.id)
+        user.is_cpa = True
+        user.save()
+        self.assertSeats(self.other, 1, 0)
+
+        user.delete()
+        self.assertSeats(self.other, 0, 0)
+
+    def test_stale_firm_save(self):
+        # a firm loaded before users joined must not write its old counts back
+        self.firm.name = 'renamed'
+        self.firm.save()
+        self.assertSeats(self.firm, 1, 1)
+
+    def test_seat_check_reads_firm_row(self):
+        user = AvUser.objects.get(id=self.cpa.id)
+        with self.assertNumQueries(1):
+            self.assertEqual((user.cpa_count(), user.client_count()), (1, 1))
+
+    def test_repair(self):
+        Firm.objects.filter(id=self.firm.id).update(cpa_count=5, client_count=0)
+        Firm.objects.filter(id=self.other.id).update(client_count=2)
+
+        out = StringIO()
+        call_command('seats', stdout=out)
+        self.assertIn('repaired 2', out.getvalue())
+        self.assertSeats(self.firm, 1, 1)
+        self.assertSeats(self.other, 0, 0)
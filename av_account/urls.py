@@ -95,6 +95,11 @@ urlpatterns = [
         view=ChangeCardView.as_view(),
         name='change-card',
     ),
+    url(
+        regex=r'^stripe/webhook/$',
+        view=StripeWebhookView.as_view(),
+        name='stripe-webhook',
+    ),
     url(
         regex=r'^logins/$',
         view=LoginsView.as_view(),
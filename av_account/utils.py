@@ -1,14 +1,22 @@
+import copy
+import threading
+import time
+
 import stripe
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
 from django.shortcuts import redirect, get_object_or_404
 from django.urls import reverse
 from django.views import View
 from django.views.generic.base import ContextMixin
 from rest_framework import permissions
 
-from av_account.models import AvUser
+from av_account.middleware import get_auth_snapshot
+from av_account.models import AvUser, Subscription
 from av_core import settings, logger
+from av_utils.utils import get_object_or_None
 
 
 class VerifiedAndTrustedRequiredMixin(LoginRequiredMixin):
@@ -21,7 +29,7 @@ class VerifiedAndTrustedRequiredMixin(LoginRequiredMixin):
             if user.is_2fa and not user.is_verified:
                 user.send_verification_code(request)
                 return redirect_to_login(request.get_full_path(), settings.VERIFY_URL, self.get_redirect_field_name())
-            if not request.agent.is_trusted:
+            if not get_auth_snapshot(request).is_trusted:
                 user.send_verification_code(request)
                 return redirect_to_login(request.get_full_path(), settings.VERIFY_URL, self.get_redirect_field_name())
         return super(VerifiedAndTrustedRequiredMixin, self).dispatch(request, *args, **kwargs)
@@ -44,11 +52,12 @@ class FullRequiredMixin(FullyVerifiedRequiredMixin):
     """
     def dispatch(self, request, *args, **kwargs):
         if request.user.is_authenticated:
-            if not request.user.is_full_cred():
-                if request.user.is_cpa:
-                    if request.user.firm is None:
+            snapshot = get_auth_snapshot(request)
+            if not snapshot.is_full_cred:
+                if snapshot.is_cpa:
+                    if snapshot.firm is None:
                         return redirect(reverse('firm'))
-                    elif request.user.firm.stripe_id is None:
+                    elif snapshot.firm.stripe_id is None:
                         return redirect(reverse('checkout'))
                     else:
                         return redirect(reverse('disabled'))
@@ -66,7 +75,7 @@ class ClientRequiredMixin(FullRequiredMixin):
 class CPARequiredMixin(FullRequiredMixin):
     def dispatch(self, request, *args, **kwargs):
         if request.user.is_authenticated:
-            if not request.user.is_cpa:
+            if not get_auth_snapshot(request).is_cpa:
                 return redirect(reverse('home'))
         return super(CPARequiredMixin, self).dispatch(request, *args, **kwargs)
 
@@ -74,7 +83,7 @@ class CPARequiredMixin(FullRequiredMixin):
 class CPAAdminRequiredMixin(CPARequiredMixin):
     def dispatch(self, request, *args, **kwargs):
         if request.user.is_authenticated:
-            if not request.user.is_admin():
+            if not get_auth_snapshot(request).is_admin:
                 return redirect(reverse('home'))
         return super(CPARequiredMixin, self).dispatch(request, *args, **kwargs)
 
@@ -87,14 +96,49 @@ class UserViewMixin(View):
         return self.get_user()
 
 
+def sync_subscription(firm, subscription=None):
+    """
+    Stores a firm's stripe subscription in the local mirror
+    :param firm: firm with a stripe customer
+    :param subscription: stripe subscription, retrieved from stripe if not given
+    :return: the updated Subscription mirror
+    """
+    if subscription is None:
+        stripe.api_key = settings.STRIPE_SECRET_KEY
+        customer = stripe.Customer.retrieve(firm.stripe_id)
+        subscription = customer.subscriptions.data[0]
+
+    local = get_object_or_None(Subscription, firm=firm) or Subscription(firm=firm)
+    local.update_from_stripe(subscription)
+    try:
+        with transaction.atomic():
+            local.save()
+    except IntegrityError:
+        # another request, e.g. a webhook, created the firm's mirror since it was looked up
+        local = Subscription.objects.get(firm=firm)
+        local.update_from_stripe(subscription)
+        local.save()
+    return local
+
+
 class StripeMixin(View):
     def dispatch(self, request, *args, **kwargs):
         stripe.api_key = settings.STRIPE_SECRET_KEY
         return super(StripeMixin, self).dispatch(request, *args, **kwargs)
     
     def get_subscription(self):
+        """
+        Live subscription from stripe, use get_local_subscription() when only reading plan details
+        """
         customer = stripe.Customer.retrieve(self.request.user.firm.stripe_id)
         return customer.subscriptions.data[0]
+
+    def get_local_subscription(self):
+        """
+        Subscription mirror for the user's firm, stripe is only asked if the firm has never been synced
+        """
+        firm = self.request.user.firm
+        return get_object_or_None(Subscription, firm=firm) or sync_subscription(firm)
     
     def change_plan(self, plan_id):
         subscription = self.get_subscription()
@@ -115,14 +159,15 @@ class StripeMixin(View):
         if old_plan.interval == 'yearly' and new_plan.interval == 'monthly' and old_plan.amount / 12 < new_plan.amount:
             prorate = True
 
-        stripe.Subscription.modify(subscription.id,
-                                   cancel_at_period_end=False,
-                                   items=[{
-                                       'id': subscription['items']['data'][0].id,
-                                       'plan': plan_id,
-                                   }],
-                                   prorate=prorate
-                                   )
+        subscription = stripe.Subscription.modify(subscription.id,
+                                                  cancel_at_period_end=False,
+                                                  items=[{
+                                                      'id': subscription['items']['data'][0].id,
+                                                      'plan': plan_id,
+                                                  }],
+                                                  prorate=prorate
+                                                  )
+        sync_subscription(self.request.user.firm, subscription)
 
         verb = 'changed plan from {} to {} with prorate {}'.format(old_plan.id, new_plan.id, prorate)
         logger.info('action: {}, {}'.format(self.request.user, verb))
@@ -136,47 +181,166 @@ class StripeMixin(View):
         logger.info('action: {}, {}'.format(self.request.user, 'generated invoice due to plan change'))
 
 
+# stripe plan catalog
+# plans rarely change, so keep them in a shared cache and in process memory rather than asking stripe on every page
+
+PLANS_CACHE_KEY = 'stripe_plans'
+
+_plans_local = {'entry': None, 'expires': 0}
+_plans_lock = threading.Lock()
+
+
+def fetch_plans():
+    """
+    Retrieves the plans listed in STRIPE_PLANS from stripe
+    :return: dict of plain plan dicts keyed by plan id
+    """
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+
+    wanted = [plan_id for interval in settings.STRIPE_PLANS.values() for plan_id in interval.values()]
+
+    plans = {}
+    for plan in stripe.Plan.list(limit=100).data:
+        if plan.id in wanted:
+            plans[plan.id] = {
+                'id': plan.id,
+                'amount': plan.amount,
+                'interval': plan.interval,
+                'nickname': plan.nickname,
+                'metadata': dict(plan.metadata),
+            }
+
+    return plans
+
+
+def _store_plans(plans):
+    entry = {
+        'plans': plans,
+        'expires': time.time() + settings.STRIPE_PLANS_CACHE_SECONDS,
+    }
+    # keep the shared copy around past expiry so a stale catalog can be served while refreshing
+    cache.set(PLANS_CACHE_KEY, entry, None)
+    _plans_local['entry'] = entry
+    _plans_local['expires'] = min(entry['expires'], time.time() + settings.STRIPE_PLANS_LOCAL_SECONDS)
+    return entry
+
+
+def refresh_plans():
+    """
+    Fetches plans from stripe and stores them in the shared and local caches
+    Used as the warm-up hook, see the plans management command
+    """
+    with _plans_lock:
+        return _store_plans(fetch_plans())['plans']
+
+
+def _load_plans():
+    with _plans_lock:
+        # whoever held the lock before us may have just fetched them
+        entry = cache.get(PLANS_CACHE_KEY)
+        if entry is not None:
+            _plans_local['entry'] = entry
+            _plans_local['expires'] = min(entry['expires'], time.time() + settings.STRIPE_PLANS_LOCAL_SECONDS)
+            return entry['plans']
+        return _store_plans(fetch_plans())['plans']
+
+
+def _refresh_plans_in_background():
+    # only one refresh at a time, everyone else keeps serving the stale catalog
+    if not _plans_lock.acquire(blocking=False):
+        return
+
+    def refresh():
+        try:
+            _store_plans(fetch_plans())
+        except stripe.error.StripeError as e:
+            logger.error('Stripe plan refresh error: %s', e)
+        finally:
+            _plans_lock.release()
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def invalidate_plans():
+    """
+    Drops the cached catalog, the next get_plans() call will fetch from stripe
+    Other processes drop their local copy within STRIPE_PLANS_LOCAL_SECONDS
+    """
+    cache.delete(PLANS_CACHE_KEY)
+    _plans_local['entry'] = None
+    _plans_local['expires'] = 0
+
+
+def get_plans():
+    """
+    Returns the plan catalog, only calling stripe when no process has cached it yet
+    An expired catalog is still returned while it is refreshed in a background thread
+    :return: dict of plain plan dicts keyed by plan id, treat as read only
+    """
+    now = time.time()
+
+    entry = _plans_local['entry']
+    if entry is None or _plans_local['expires'] <= now:
+        entry = cache.get(PLANS_CACHE_KEY)
+        if entry is not None:
+            _plans_local['entry'] = entry
+            _plans_local['expires'] = min(entry['expires'], now + settings.STRIPE_PLANS_LOCAL_SECONDS)
+
+    if entry is None:
+        # cold cache, nothing to serve
+        return _load_plans()
+
+    if entry['expires'] <= now:
+        _refresh_plans_in_background()
+
+    return entry['plans']
+
+
+def get_plan(plan_id):
+    """
+    :return: a copy of the cached plan, safe to modify for display
+    """
+    return copy.deepcopy(get_plans()[plan_id])
+
+
 class StripePlansMixin(ContextMixin, StripeMixin):
     def get_context_data(self, **kwargs):
         context = super(StripePlansMixin, self).get_context_data(**kwargs)
         
-        # retrieve all plans at once for speed
-        plans = stripe.Plan.list()
-        
-        # pluck out the plans we are interested in
-        plan_a = next(x for x in plans.data if x.id == settings.STRIPE_PLANS['yearly']['a'])
-        plan_b = next(x for x in plans.data if x.id == settings.STRIPE_PLANS['yearly']['b'])
-        plan_c = next(x for x in plans.data if x.id == settings.STRIPE_PLANS['yearly']['c'])
+        # pluck out the plans we are interested in from the local catalog
+        plan_a = get_plan(settings.STRIPE_PLANS['yearly']['a'])
+        plan_b = get_plan(settings.STRIPE_PLANS['yearly']['b'])
+        plan_c = get_plan(settings.STRIPE_PLANS['yearly']['c'])
         
-        plan_am = next(x for x in plans.data if x.id == settings.STRIPE_PLANS['monthly']['a'])
-        plan_bm = next(x for x in plans.data if x.id == settings.STRIPE_PLANS['monthly']['b'])
-        plan_cm = next(x for x in plans.data if x.id == settings.STRIPE_PLANS['monthly']['c'])
+        plan_am = get_plan(settings.STRIPE_PLANS['monthly']['a'])
+        plan_bm = get_plan(settings.STRIPE_PLANS['monthly']['b'])
+        plan_cm = get_plan(settings.STRIPE_PLANS['monthly']['c'])
         
         # calculate display versions of prices
-        plan_a.amount = round(plan_a.amount / 1200)
-        plan_b.amount = round(plan_b.amount / 1200)
-        plan_c.amount = round(plan_c.amount / 1200)
+        plan_a['amount'] = round(plan_a['amount'] / 1200)
+        plan_b['amount'] = round(plan_b['amount'] / 1200)
+        plan_c['amount'] = round(plan_c['amount'] / 1200)
         
-        plan_am.amount = round(plan_am.amount / 100)
-        plan_bm.amount = round(plan_bm.amount / 100)
-        plan_cm.amount = round(plan_cm.amount / 100)
+        plan_am['amount'] = round(plan_am['amount'] / 100)
+        plan_bm['amount'] = round(plan_bm['amount'] / 100)
+        plan_cm['amount'] = round(plan_cm['amount'] / 100)
         
         # show monthly option in yearly plans
-        plan_a.metadata.monthly = plan_am.amount
-        plan_b.metadata.monthly = plan_bm.amount
-        plan_c.metadata.monthly = plan_cm.amount
+        plan_a['metadata']['monthly'] = plan_am['amount']
+        plan_b['metadata']['monthly'] = plan_bm['amount']
+        plan_c['metadata']['monthly'] = plan_cm['amount']
         
-        plan_a.metadata.post = 'a'
-        plan_b.metadata.post = 'b'
-        plan_c.metadata.post = 'c'
+        plan_a['metadata']['post'] = 'a'
+        plan_b['metadata']['post'] = 'b'
+        plan_c['metadata']['post'] = 'c'
         
         # if logged in, check usage to calculate plan availability
         if self.request.user.is_authenticated:
             cpa_count = self.request.user.cpa_count()
             client_count = self.request.user.client_count()
             
-            if cpa_count > int(plan_a.metadata.max_cpa) or client_count > int(plan_a.metadata.max_client):
-                plan_a.metadata.disabled = True
+            if cpa_count > int(plan_a['metadata']['max_cpa']) or client_count > int(plan_a['metadata']['max_client']):
+                plan_a['metadata']['disabled'] = True
             
             context['cpa_count'] = cpa_count
             context['client_count'] = client_count
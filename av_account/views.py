@@ -10,10 +10,14 @@ from django.contrib.auth.models import Group
 from django.contrib.auth.views import LoginView
 from django.contrib.auth.views import SuccessURLAllowedHostsMixin
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound
 from django.shortcuts import redirect
 from django.shortcuts import render
 from django.urls import reverse
 from django.urls import reverse_lazy
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import FormView, DeleteView
 from django.views.generic import ListView
 from django.views.generic import TemplateView
@@ -26,6 +30,7 @@ from av_account.models import UserLogin
 from av_account.models import UserSecurity
 from av_account.utils import FullyVerifiedRequiredMixin, StripeMixin, StripePlansMixin, VerifiedAndTrustedRequiredMixin, \
     FullRequiredMixin
+from av_account.webhooks import handle_event
 from av_core import logger, settings
 from av_utils.utils import get_object_or_None
 from .forms import AccountForm, FirmForm, AccountSetPasswordForm
@@ -411,6 +416,31 @@ class ChangeCardView(FullyVerifiedRequiredMixin, TemplateView, StripeMixin):
         return context
 
 
+@method_decorator(csrf_exempt, name='dispatch')
+class StripeWebhookView(View):
+    """
+    Receives signed stripe events, keeping firm billing state current without polling stripe
+    """
+    def post(self, request, *args, **kwargs):
+        try:
+            event = stripe.Webhook.construct_event(
+                request.body,
+                request.META.get('HTTP_STRIPE_SIGNATURE', ''),
+                settings.STRIPE_WEBHOOK_SECRET,
+            )
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
+            logger.warn('Rejected stripe webhook: {}'.format(e))
+            return HttpResponseBadRequest()
+
+        try:
+            handle_event(event)
+        except Firm.DoesNotExist as e:
+            # not yet saved by the checkout, stripe retries anything but a 2xx
+            logger.warn('Deferred stripe webhook: {}'.format(e))
+            return HttpResponseNotFound()
+        return HttpResponse()
+
+
 class EmailVerificationView(TemplateView):
     template_name = 'email_verification.html'
 
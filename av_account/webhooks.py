@@ -0,0 +1,76 @@
+from django.db import IntegrityError, transaction
+
+from av_account.models import Firm, StripeEvent, Subscription, from_stripe_timestamp
+from av_account.utils import sync_subscription
+from av_core import logger
+
+
+def apply_subscription(firm, subscription):
+    if subscription.trial_end is not None:
+        firm.trial_end = from_stripe_timestamp(subscription.trial_end)
+    firm.is_paid = subscription.status in Subscription.PAID_STATUSES
+    sync_subscription(firm, subscription)
+
+
+def apply_subscription_deleted(firm, subscription):
+    firm.is_paid = False
+    sync_subscription(firm, subscription)
+
+
+def apply_invoice_paid(firm, invoice):
+    firm.is_paid = True
+
+
+def apply_invoice_failed(firm, invoice):
+    # access is revoked by the subscription status change stripe sends once retries run out
+    logger.warn('Stripe invoice {} payment failed for firm {}'.format(invoice.id, firm.id))
+
+
+HANDLERS = {
+    'customer.subscription.created': apply_subscription,
+    'customer.subscription.updated': apply_subscription,
+    'customer.subscription.deleted': apply_subscription_deleted,
+    'invoice.payment_succeeded': apply_invoice_paid,
+    'invoice.payment_failed': apply_invoice_failed,
+}
+
+
+def handle_event(event):
+    """
+    Applies a verified stripe event to the customer's firm
+    Each event is applied at most once, and events older than the last one applied to the same
+    subscription or invoice are ignored
+    :param event: stripe.Event
+    :return: True if the firm was updated
+    :raises Firm.DoesNotExist: no firm has the event's customer yet, e.g. its checkout is still saving it,
+        the event is not recorded so that stripe delivers it again
+    """
+    handler = HANDLERS.get(event.type)
+    if handler is None:
+        return False
+
+    obj = event.data.object
+    created = from_stripe_timestamp(event.created)
+
+    with transaction.atomic():
+        firm = Firm.objects.select_for_update().filter(stripe_id=obj.customer).first()
+        if firm is None:
+            raise Firm.DoesNotExist('No firm for stripe event {} customer {}'.format(event.id, obj.customer))
+
+        try:
+            with transaction.atomic():
+                StripeEvent.objects.create(stripe_id=event.id, type=event.type, object_id=obj.id, created=created)
+        except IntegrityError:
+            logger.info('Skipping duplicate stripe event {}'.format(event.id))
+            return False
+
+        # the firm's lock orders the events of all its objects
+        if StripeEvent.objects.filter(object_id=obj.id, created__gt=created).exists():
+            logger.info('Skipping out of order stripe event {}'.format(event.id))
+            return False
+
+        handler(firm, obj)
+        firm.save()
+
+    logger.info('Applied stripe event {} {} to firm {}'.format(event.type, event.id, firm.id))
+    return True
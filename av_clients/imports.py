@@ -0,0 +1,303 @@
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from actstream.models import Action, Follow
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from av_account.models import AvUser
+from av_account.signals import change_seats
+from av_clients import validation
+from av_clients.models import ClientImport
+from av_core import logger
+from av_emails.utils import send_invitation_emails
+from av_uploads.models import S3Deletion
+from av_uploads.utils import get_s3direct_destinations
+
+# clients created, followed and queued an email together, in one transaction
+BATCH_SIZE = 200
+
+# imports running at once in a web process
+IMPORT_THREADS = 2
+
+# jobs whose heartbeat stopped this long ago lost their process, see resume()
+STALE_AFTER = timedelta(minutes=10)
+
+# how often a process working on a job refreshes its heartbeat, see heartbeat()
+HEARTBEAT = timedelta(seconds=30)
+
+# uploads never invited are deleted after this long, see expire()
+EXPIRE_AFTER = timedelta(days=1)
+
+_threads = None
+_threads_lock = threading.Lock()
+
+
+def claim(job, current, **fields):
+    """
+    Takes a job over in a single update, only if its status is still current and no process has moved it on
+    or beaten since it was read, so two processes never work on the same job
+    Within a transaction the claim holds until it commits, whoever claims meanwhile waits and then fails
+    :return: whether the job was claimed, its date_modified, heartbeat and fields are then set to match
+    """
+    fields['date_modified'] = fields['heartbeat'] = timezone.now()
+    claimed = ClientImport.objects.filter(id=job.id, status=current, date_modified=job.date_modified,
+                                          heartbeat=job.heartbeat).update(**fields)
+    if claimed:
+        for name, value in fields.items():
+            setattr(job, name, value)
+    return bool(claimed)
+
+
+def heartbeat(job):
+    """
+    :return: callable to call as work on a claimed job progresses, it refreshes the job's heartbeat at most
+        every HEARTBEAT, so however long the work takes the job is not resumed elsewhere meanwhile
+    """
+    last = [time.monotonic()]
+
+    def beat():
+        if time.monotonic() - last[0] < HEARTBEAT.total_seconds():
+            return
+        last[0] = time.monotonic()
+        now = timezone.now()
+        # only while the claim is this process's
+        if ClientImport.objects.filter(id=job.id, date_modified=job.date_modified).update(heartbeat=now):
+            job.heartbeat = now
+    return beat
+
+
+def create_users(users):
+    """
+    Inserts the users in one query, or one at a time if an email registered since it was looked up
+    :return: the users inserted, the ones registered meanwhile are left out
+    """
+    try:
+        with transaction.atomic():
+            return AvUser.objects.bulk_create(users)
+    except IntegrityError:
+        pass
+
+    created = []
+    for user in users:
+        try:
+            with transaction.atomic():
+                AvUser.objects.bulk_create([user])
+        except IntegrityError:
+            logger.info('Skipping client {} who registered during the import'.format(user.email))
+            continue
+        created.append(user)
+    return created
+
+
+def invite_batch(job, cpa, rows):
+    """
+    Invites a batch of (first name, last name, email) rows in a constant number of queries
+    Emails taken since the preview are skipped
+    :return: number of clients invited, None if another process took the job over
+    """
+    date_modified, beaten = job.date_modified, job.heartbeat
+    try:
+        with transaction.atomic():
+            # claimed again first, a process that took the job over since the last batch stops this one here
+            if not claim(job, ClientImport.RUNNING):
+                return None
+
+            existing = set(AvUser.objects.filter(email__in=[email for _, _, email in rows])
+                           .values_list('email', flat=True))
+            users = []
+            for first_name, last_name, email in rows:
+                # also skips repeats within the rows
+                if email in existing:
+                    continue
+                user = AvUser(first_name=first_name, last_name=last_name, email=email, firm_id=cpa.firm_id)
+                user.set_email_code()
+                users.append(user)
+                existing.add(email)
+
+            # bulk_create skips the signals, so seats, follows and their actions are written here too
+            users = create_users(users)
+            users = list(AvUser.objects.filter(email__in=[user.email for user in users]).select_related('firm'))
+            change_seats(cpa.firm_id, False, len(users))
+
+            user_type = ContentType.objects.get_for_model(AvUser)
+            now = timezone.now()
+            Follow.objects.bulk_create([
+                Follow(user=cpa, content_type=user_type, object_id=user.pk, actor_only=False, started=now)
+                for user in users])
+            Action.objects.bulk_create([
+                Action(actor_content_type=user_type, actor_object_id=cpa.pk, verb='started following',
+                       target_content_type=user_type, target_object_id=user.pk, timestamp=now)
+                for user in users])
+
+            # queued in the outbox, the email worker sends them concurrently
+            send_invitation_emails(users)
+
+            ClientImport.objects.filter(id=job.id).update(
+                processed=F('processed') + len(rows), invited=F('invited') + len(users))
+    except Exception:
+        # the claim rolled back with the batch
+        job.date_modified, job.heartbeat = date_modified, beaten
+        raise
+    return len(users)
+
+
+def upload(cpa, file):
+    """
+    Streams an uploaded csv into the 'imports' destination, where any process can read it
+    :return: ClientImport being validated for the preview
+    """
+    destination = get_s3direct_destinations()['imports']
+    bucket = destination.get('bucket') or settings.AWS_BUCKET_NAME
+    key = '{}/{}/{}.csv'.format(destination['key'].rstrip('/'), cpa.id, uuid.uuid4())
+    job = ClientImport(cpa=cpa, s3_bucket=bucket, s3_key=key)
+    file.seek(0)
+    job.get_storage().put_file(key, file, 'text/csv')
+    job.save()
+    in_background(validate, job)
+    return job
+
+
+def validate(job):
+    """
+    Validates an uploaded csv into the rows the preview shows, cached next to it, see validation.load()
+    Leaves the job READY with the number of rows to invite, or INVALID with why not
+    """
+    if job.status not in (ClientImport.PENDING, ClientImport.VALIDATING) or \
+            not claim(job, job.status, status=ClientImport.VALIDATING):
+        logger.info('Client import {} is no longer this process\'s to validate'.format(job.id))
+        return
+    try:
+        total = sum(1 for row in load(job, heartbeat(job)) if row.invitable)
+        claim(job, ClientImport.VALIDATING, status=ClientImport.READY, total=total)
+    except UnicodeDecodeError:
+        claim(job, ClientImport.VALIDATING, status=ClientImport.INVALID,
+              error='Your upload does not appear to be UTF-8 text.', date_finished=timezone.now())
+    except Exception as e:
+        logger.error('Client import {} could not be validated: {}'.format(job.id, e))
+        claim(job, ClientImport.VALIDATING, status=ClientImport.INVALID,
+              error='Your upload could not be read.', date_finished=timezone.now())
+
+
+def load(job, progress=None):
+    return validation.load(job.get_storage(), job.s3_key, progress)
+
+
+def remove(job):
+    # through the deletion outbox like deleted uploads, drained by the s3_deletions command
+    S3Deletion.objects.bulk_create([S3Deletion(s3_bucket=job.s3_bucket, s3_key=key)
+                                    for key in (job.s3_key, job.s3_key + validation.CACHE_SUFFIX)])
+
+
+def run(job):
+    """
+    Invites the rows the preview showed as invitable, batch by batch from where the job got to
+    Each batch commits together with the job's progress, so a resumed job carries on exactly
+    """
+    cpa = job.cpa
+    try:
+        # a job already finished, or taken over by another process, is left to it
+        if not claim(job, ClientImport.RUNNING):
+            logger.info('Client import {} is no longer this process\'s to run'.format(job.id))
+            return
+        rows = [(row.first_name, row.last_name, row.email) for row in load(job, heartbeat(job)) if row.invitable]
+        for index in range(job.processed, len(rows), BATCH_SIZE):
+            if invite_batch(job, cpa, rows[index:index + BATCH_SIZE]) is None:
+                logger.info('Client import {} was taken over at {} of {}'.format(job.id, index, len(rows)))
+                return
+        with transaction.atomic():
+            if claim(job, ClientImport.RUNNING, status=ClientImport.DONE, date_finished=timezone.now()):
+                remove(job)
+    except Exception as e:
+        logger.error('Client import {} failed: {}'.format(job.id, e))
+        claim(job, ClientImport.RUNNING, status=ClientImport.FAILED, error=str(e), date_finished=timezone.now())
+
+
+def in_thread(work, job_id):
+    try:
+        work(ClientImport.objects.select_related('cpa').get(id=job_id))
+    finally:
+        # worker threads get their own database connection
+        connection.close()
+
+
+def in_background(work, job):
+    """
+    Runs work(job) without waiting on it, unless settings.CLIENT_IMPORT_BACKGROUND is off
+    """
+    global _threads
+    if not settings.CLIENT_IMPORT_BACKGROUND:
+        work(job)
+        return
+
+    with _threads_lock:
+        if _threads is None:
+            _threads = ThreadPoolExecutor(max_workers=IMPORT_THREADS)
+    # the job's status has to be visible to the thread
+    transaction.on_commit(lambda: _threads.submit(in_thread, work, job.id))
+
+
+def start(job):
+    """
+    Invites the invitable rows of a validated import without waiting on it
+    :return: whether the import was started
+    """
+    # a preview committed twice starts the import once
+    if not claim(job, ClientImport.READY, status=ClientImport.RUNNING):
+        return False
+    in_background(run, job)
+    return True
+
+
+def resume(stale_after=STALE_AFTER):
+    """
+    Restarts imports whose process went away, e.g. with a restarting dyno, in this process
+    Uploads left unvalidated are validated again, running imports carry on from their last batch
+    :return: Counter of resumed jobs and the rows they had left, and of validations
+    """
+    stats = Counter()
+    jobs = ClientImport.objects.select_related('cpa').filter(
+        status__in=(ClientImport.PENDING, ClientImport.VALIDATING, ClientImport.RUNNING),
+        heartbeat__lt=timezone.now() - stale_after)
+    for job in jobs:
+        # still stale only if no other process claimed or beat since it was read
+        if not claim(job, job.status):
+            continue
+        if job.status != ClientImport.RUNNING:
+            logger.info('Validating client import {} again'.format(job.id))
+            stats['validations'] += 1
+            validate(job)
+            continue
+        logger.info('Resuming client import {} at {} of {}'.format(job.id, job.processed, job.total))
+        stats['jobs'] += 1
+        stats['rows'] += job.total - job.processed
+        run(job)
+    return stats
+
+
+def expire(expire_after=EXPIRE_AFTER):
+    """
+    Deletes uploads whose preview was never committed, queueing their csv and cached rows for deletion
+    The 'imports' destination is left out of reconcile, so nothing else cleans these up
+    :return: Counter of expired uploads
+    """
+    stats = Counter()
+    with transaction.atomic():
+        # locked, so the preview can no longer start them, and claims made meanwhile wait and then fail
+        jobs = list(ClientImport.objects
+                    .select_for_update(skip_locked=True)
+                    .filter(status__in=(ClientImport.PENDING, ClientImport.VALIDATING,
+                                        ClientImport.READY, ClientImport.INVALID),
+                            date_modified__lt=timezone.now() - expire_after))
+        for job in jobs:
+            remove(job)
+        ClientImport.objects.filter(id__in=[job.id for job in jobs]).delete()
+    stats['expired'] += len(jobs)
+    return stats
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from av_clients.imports import EXPIRE_AFTER, STALE_AFTER, expire, resume
+
+
+class Command(BaseCommand):
+    help = 'Resumes client imports and validations whose web process went away before they finished, ' \
+           'and expires uploads never invited'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-minutes', type=int, default=int(STALE_AFTER.total_seconds() // 60),
+                            help='Minutes an import may go without progress before it is resumed')
+        parser.add_argument('--expire-hours', type=int, default=int(EXPIRE_AFTER.total_seconds() // 3600),
+                            help='Hours an upload may wait to be invited before it is deleted')
+
+    def handle(self, *args, **options):
+        stats = resume(timedelta(minutes=options['stale_minutes']))
+        stats.update(expire(timedelta(hours=options['expire_hours'])))
+        self.stdout.write(self.style.SUCCESS(
+            'Resumed {jobs} imports with {rows} rows left and {validations} validations, '
+            'expired {expired} uploads.'.format_map(stats)))
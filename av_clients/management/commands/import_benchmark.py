@@ -0,0 +1,50 @@
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from av_clients import validation
+from av_uploads.storage import LocalStorage
+
+
+class Command(BaseCommand):
+    help = 'Times validating generated client import csvs, cold and from the cached result, nothing is imported'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000], help='Rows of each csv')
+
+    def handle(self, *args, **options):
+        location = tempfile.mkdtemp()
+        storage = LocalStorage('benchmark', location=location)
+        try:
+            for count in options['rows']:
+                self.benchmark(storage, count)
+        finally:
+            shutil.rmtree(location)
+
+    def benchmark(self, storage, count):
+        lines = []
+        for i in range(count):
+            # one row in a hundred repeats an earlier email, one in a hundred is malformed
+            email = 'client{}@example.com'.format(i // 2 if i % 100 == 1 else i)
+            if i % 100 == 2:
+                email = 'client{}.example.com'.format(i)
+            lines.append('First {}, "Last, {}", {}\n'.format(i, i, email))
+        key = 'imports/{}.csv'.format(count)
+        storage.put(key, ''.join(lines).encode(), 'text/csv')
+
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            rows = validation.load(storage, key)
+        cold = time.perf_counter() - started
+
+        started = time.perf_counter()
+        validation.load(storage, key)
+        cached = time.perf_counter() - started
+
+        self.stdout.write(self.style.SUCCESS(
+            '{} rows: validated in {:.2f}s with {} queries, {:.2f}s from cache, {} invitable'.format(
+                count, cold, len(queries), cached, sum(1 for row in rows if row.invitable))))
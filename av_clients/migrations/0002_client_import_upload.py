@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 11:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_clients', '0001_client_import'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clientimport',
+            name='date_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='clientimport',
+            name='s3_bucket',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='clientimport',
+            name='s3_key',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name='clientimport',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Uploaded'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=16),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 12:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_clients', '0002_client_import_upload'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='clientimport',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Uploaded'), ('VALIDATING', 'Validating'), ('READY', 'Validated'), ('INVALID', 'Invalid'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=16),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 12:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_clients', '0003_client_import_validation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clientimport',
+            name='heartbeat',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
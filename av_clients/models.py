@@ -1,3 +1,58 @@
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+from av_uploads.storage import get_storage
+
+
+class ClientImport(models.Model):
+    """
+    A csv of clients kept in the 'imports' destination, validated and invited in the background
+    The preview and the import page poll its progress
+    """
+    PENDING = 'PENDING'
+    VALIDATING = 'VALIDATING'
+    READY = 'READY'
+    INVALID = 'INVALID'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    STATUS_CHOICES = (
+        (PENDING, "Uploaded"),
+        (VALIDATING, "Validating"),
+        (READY, "Validated"),
+        (INVALID, "Invalid"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    cpa = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='client_imports')
+    s3_bucket = models.TextField(blank=True)
+    s3_key = models.TextField(blank=True)
+    # rows to invite, processed so far, and invited out of those, the rest turned out to exist already
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    invited = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    date_created = models.DateTimeField(default=timezone.now)
+    # moved on by every claim, so a process can tell whether the job is still the one it took over
+    date_modified = models.DateTimeField(default=timezone.now)
+    # refreshed as the claiming process makes progress, a job whose heartbeat stopped lost its process and is resumed
+    heartbeat = models.DateTimeField(default=timezone.now)
+    date_finished = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return '{} import of {} clients'.format(self.cpa, self.total)
+
+    def get_storage(self):
+        return get_storage(self.s3_bucket, self.s3_key)
+
+    def progress(self):
+        return {
+            'status': self.status,
+            'total': self.total,
+            'processed': self.processed,
+            'invited': self.invited,
+            'skipped': self.processed - self.invited,
+        }
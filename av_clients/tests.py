@@ -1,25 +1,62 @@
+import json
+import shutil
+import tempfile
 import urllib
-from unittest.mock import patch
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest.mock import Mock, patch
+
+from actstream.models import Follow, user_stream
 
 from django.contrib import auth
 from django.core import mail
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from rest_framework import status
 
 from av_account.models import AvUser, Firm
+from av_clients import imports, validation, views
+from av_clients.models import ClientImport
 from av_clients.views import UploadFileForm
 from av_core import settings
+from av_emails.models import OutboxEmail
 from av_returns.models import Return, Expense
-from av_uploads.models import S3File
+from av_uploads.models import S3Deletion, S3File
+from av_uploads.storage import LocalStorage
 from av_utils.stripe import *
+from av_utils.testing import CommitCallbacksMixin
+
+
+class LocalImportsMixin(object):
+    """
+    Keeps import csvs in a temporary directory instead of s3
+    """
+    def setUp(self):
+        super(LocalImportsMixin, self).setUp()
+        self.location = tempfile.mkdtemp()
+        destinations = dict(settings.AWS_DESTINATIONS)
+        destinations['imports'] = dict(destinations['imports'], storage='local', location=self.location)
+        self.settings_override = override_settings(AWS_DESTINATIONS=destinations)
+        self.settings_override.enable()
 
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.location)
+        super(LocalImportsMixin, self).tearDown()
 
-class ImportTestCase(TestCase):
+    def upload_import(self, user, lines):
+        return imports.upload(user, BytesIO('\n'.join(lines).encode()))
+
+
+class ImportTestCase(CommitCallbacksMixin, LocalImportsMixin, TestCase):
 
     def setUp(self):
+        super(ImportTestCase, self).setUp()
         # stripe mocks
         metadata = MetaData('Proprietor', 'email', 1, 100)
         plan = Plan('plan_xxx', metadata)
@@ -55,6 +92,24 @@ class ImportTestCase(TestCase):
         user = auth.get_user(self.client)
         assert user.is_authenticated()
 
+    @patch("stripe.Customer.retrieve")
+    def test_subscription_mirror(self, retrieve_mock):
+        retrieve_mock.return_value = self.customer
+
+        self.login()
+
+        response = self.client.get(reverse('invite'))
+        self.assertEqual(response.context['max_client'], 100)
+
+        # plan limits are now read from the local mirror
+        response = self.client.get(reverse('import'))
+        self.assertEqual(response.context['max_client'], 100)
+        self.assertEqual(retrieve_mock.call_count, 1)
+
+        subscription = Firm.objects.get(id=self.firm.id).subscription
+        self.assertEqual(subscription.plan_id, 'plan_xxx')
+        self.assertEqual(subscription.max_cpa, 1)
+
     def test_form_bad_extension(self):
         file = open('av_clients/test_files/plain')
         data = {'file', file}
@@ -201,6 +256,271 @@ class ImportTestCase(TestCase):
         # ensure invitation emails were sent
         self.assertEqual(len(mail.outbox), 1)
 
+    @patch("stripe.Customer.retrieve")
+    def test_bulk_invite(self, retrieve_mock):
+        retrieve_mock.return_value = self.customer
+
+        self.login()
+        mail.outbox = []
+
+        file = open('av_clients/test_files/hundred.csv')
+        self.client.post(reverse('import'), {'file': file})
+        response = self.client.post(reverse('preview'), follow=True)
+        self.assertContains(response, 'Invited 100 of 100 clients')
+
+        job = ClientImport.objects.get(cpa=self.user)
+        response = self.client.get(reverse('import-progress', args=[job.id]))
+        self.assertEqual(json.loads(response.content.decode()), {
+            'status': 'DONE', 'total': 100, 'processed': 100, 'invited': 100, 'skipped': 0})
+
+        self.assertEqual(len(mail.outbox), 100)
+        self.assertEqual(Firm.objects.get(id=self.firm.id).client_count, 100)
+        self.assertEqual(Follow.objects.filter(user=self.user).count(), 100)
+        self.assertEqual(len(user_stream(self.user)), 100)
+        user = AvUser.objects.get(email='aa@a.com')
+        self.assertEqual((user.firm, user.is_email_verified, len(user.email_verification_code)), (self.firm, False, 16))
+
+    @override_settings(EMAIL_OUTBOX_SYNC=False)
+    def test_bulk_invite_queries(self):
+        # the same queries however many clients are in a batch, and emails taken since the preview are skipped
+        counts = []
+        for count in (1, 10, 20):
+            job = self.upload_import(self.user, ['first, last, client{}-{}@a.com'.format(count, i) for i in range(count)])
+            AvUser.objects.create_user(email='client{}-0@a.com'.format(count), password=self.password)
+            with CaptureQueriesContext(connection) as queries:
+                imports.start(job)
+            counts.append(len(queries))
+            job.refresh_from_db()
+            self.assertEqual(job.progress(), {
+                'status': 'DONE', 'total': count, 'processed': count, 'invited': count - 1, 'skipped': 1})
+        # after the first import has looked up the site and content type
+        self.assertEqual(counts[1], counts[2])
+        self.assertEqual(OutboxEmail.objects.count(), 28)
+        # the csv and its validated rows are deleted once done
+        self.assertEqual(S3Deletion.objects.count(), 6)
+
+        # only the cpa who started an import sees its progress
+        other = AvUser.objects.create_user(email='other@example.com', password=self.password, is_cpa=True)
+        other.phone, other.is_verified, other.is_email_verified, other.firm = '(310) 666-3913', True, True, self.firm
+        other.save()
+        self.client.login(username=other.email, password=self.password)
+        self.client.get(reverse('force_trust'))
+        self.assertEqual(self.client.get(reverse('import-progress', args=[job.id])).status_code, 404)
+
+    def test_resume(self):
+        job = self.upload_import(self.user, ['first, last, client{}@a.com'.format(i) for i in range(5)])
+        with patch('av_clients.imports.BATCH_SIZE', 2), patch('av_clients.imports.invite_batch',
+                                                             side_effect=[2, Exception('dyno restarting')]):
+            imports.start(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ClientImport.FAILED)
+
+        # as if the first batch made it before the process went away
+        AvUser.objects.create_user(email='client0@a.com', password=self.password)
+        ClientImport.objects.filter(id=job.id).update(
+            status=ClientImport.RUNNING, processed=2, heartbeat=timezone.now() - timedelta(minutes=5))
+        call_command('client_imports', stdout=StringIO())
+        self.assertEqual(ClientImport.objects.get(id=job.id).status, ClientImport.RUNNING)
+
+        ClientImport.objects.filter(id=job.id).update(heartbeat=timezone.now() - timedelta(minutes=15))
+        out = StringIO()
+        call_command('client_imports', stdout=out)
+        self.assertIn('Resumed 1 imports with 3 rows left', out.getvalue())
+
+        job.refresh_from_db()
+        self.assertEqual(job.progress(), {'status': 'DONE', 'total': 5, 'processed': 5, 'invited': 3, 'skipped': 2})
+        self.assertFalse(AvUser.objects.filter(email='client1@a.com').exists())
+        self.assertTrue(AvUser.objects.filter(email='client4@a.com').exists())
+
+    def test_heartbeat(self):
+        job = self.upload_import(self.user, ['first, last, client{}@a.com'.format(i) for i in range(5)])
+        claimed = timezone.now() - timedelta(minutes=15)
+        ClientImport.objects.filter(id=job.id).update(status=ClientImport.RUNNING, date_modified=claimed,
+                                                      heartbeat=claimed)
+        job.refresh_from_db()
+        stale = ClientImport.objects.get(id=job.id)
+
+        # claimed long ago but still making progress, so not resumed, not even by a resume that read it before
+        with patch('av_clients.imports.HEARTBEAT', timedelta(0)):
+            imports.heartbeat(job)()
+        out = StringIO()
+        call_command('client_imports', stdout=out)
+        self.assertIn('Resumed 0 imports', out.getvalue())
+        self.assertFalse(imports.claim(stale, ClientImport.RUNNING))
+        self.assertEqual(ClientImport.objects.get(id=job.id).progress()['processed'], 0)
+
+        # beats are throttled
+        beat = imports.heartbeat(job)
+        with self.assertNumQueries(0):
+            beat()
+
+    def test_registered_meanwhile(self):
+        # an email registered after the batch looked it up is skipped, the rest of the batch is still invited
+        AvUser.objects.create_user(email='taken@a.com', password=self.password)
+        users = [AvUser(email=email, firm=self.firm) for email in ('new@a.com', 'taken@a.com', 'other@a.com')]
+        created = imports.create_users(users)
+        self.assertEqual([user.email for user in created], ['new@a.com', 'other@a.com'])
+        self.assertEqual(AvUser.objects.filter(firm=self.firm, email__in=['new@a.com', 'other@a.com']).count(), 2)
+
+    def test_claim(self):
+        job = self.upload_import(self.user, ['first, last, client{}@a.com'.format(i) for i in range(5)])
+        stale = ClientImport.objects.get(id=job.id)
+        self.assertTrue(imports.start(job))
+        self.assertEqual(ClientImport.objects.get(id=job.id).status, ClientImport.DONE)
+
+        # neither started again nor run once done, its csv may be gone by now
+        self.assertFalse(imports.start(stale))
+        with patch('av_clients.imports.load') as load_mock:
+            imports.run(stale)
+        self.assertFalse(load_mock.called)
+        self.assertEqual(ClientImport.objects.get(id=job.id).status, ClientImport.DONE)
+
+    def test_claim_lost(self):
+        job = self.upload_import(self.user, ['first, last, client{}@a.com'.format(i) for i in range(5)])
+
+        def taken_over(users):
+            # as if a resume in another process claimed the job during the first batch
+            ClientImport.objects.filter(id=job.id).update(date_modified=timezone.now() + timedelta(seconds=1))
+
+        with patch('av_clients.imports.BATCH_SIZE', 2), \
+                patch('av_clients.imports.send_invitation_emails', side_effect=taken_over):
+            imports.start(job)
+        self.assertEqual(ClientImport.objects.get(id=job.id).progress(), {
+            'status': 'RUNNING', 'total': 5, 'processed': 2, 'invited': 2, 'skipped': 0})
+        self.assertFalse(AvUser.objects.filter(email='client2@a.com').exists())
+
+    @patch("stripe.Customer.retrieve")
+    def test_validating(self, retrieve_mock):
+        retrieve_mock.return_value = self.customer
+
+        self.login()
+
+        # as if the validating thread has yet to get to it
+        file = open('av_clients/test_files/ok.csv')
+        with patch('av_clients.imports.validate'):
+            self.client.post(reverse('import'), {'file': file})
+        job = ClientImport.objects.get(cpa=self.user)
+        response = self.client.get(reverse('preview'))
+        self.assertContains(response, 'Checking your upload')
+        self.assertIsNone(response.context['form'])
+        self.assertEqual(self.client.post(reverse('preview')).status_code, 302)
+        self.assertEqual(ClientImport.objects.get(id=job.id).status, ClientImport.PENDING)
+
+        # carried on by the client_imports command once its process is gone
+        ClientImport.objects.filter(id=job.id).update(heartbeat=timezone.now() - timedelta(minutes=15))
+        out = StringIO()
+        call_command('client_imports', stdout=out)
+        self.assertIn('and 1 validations', out.getvalue())
+        self.assertEqual(ClientImport.objects.get(id=job.id).progress()['status'], 'READY')
+
+        response = self.client.get(reverse('preview'))
+        self.assertContains(response, 'imported', count=1)
+        self.assertContains(response, '2 clients will be invited.')
+
+    def test_expire(self):
+        old, recent, done = [self.upload_import(self.user, ['first, last, client{}@a.com'.format(i)])
+                             for i in range(3)]
+        ClientImport.objects.filter(id=done.id).update(status=ClientImport.DONE)
+        ClientImport.objects.filter(id__in=[old.id, done.id]).update(date_modified=timezone.now() - timedelta(days=2))
+
+        out = StringIO()
+        call_command('client_imports', stdout=out)
+        self.assertIn('expired 1 uploads', out.getvalue())
+
+        # the never invited upload is gone, its csv and cached rows are queued for deletion
+        self.assertEqual(set(ClientImport.objects.values_list('id', flat=True)), {recent.id, done.id})
+        self.assertEqual(set(S3Deletion.objects.values_list('s3_key', flat=True)),
+                         {old.s3_key, old.s3_key + validation.CACHE_SUFFIX})
+
+    @patch("stripe.Customer.retrieve")
+    def test_large(self, retrieve_mock):
+        retrieve_mock.return_value = self.customer
+
+        self.login()
+
+        # larger than a single upload chunk, which used to be turned down
+        content = ''.join('first, last, client{}@a.com\n'.format(i) for i in range(100000)).encode()
+        self.assertGreater(len(content), 2.5 * 1024 * 1024)
+        response = self.client.post(reverse('import'), {'file': SimpleUploadedFile('clients.csv', content)})
+        self.assertRedirects(response, reverse('preview'), fetch_redirect_response=False)
+
+        job = ClientImport.objects.get(cpa=self.user)
+        self.assertEqual(job.get_storage().head(job.s3_key)['size'], len(content))
+        with patch('av_clients.views.ClientImportPreView.preview_rows', 10):
+            response = self.client.get(reverse('preview'))
+        self.assertContains(response, 'And 99990 more rows.')
+        self.assertContains(response, '100000 clients will be invited.')
+
+        with self.settings(CLIENT_IMPORT_MAX_SIZE=1024):
+            response = self.client.post(reverse('import'), {'file': SimpleUploadedFile('clients.csv', content)})
+        self.assertFalse(response.context['form'].is_valid())
+
+    @patch("stripe.Customer.retrieve")
+    def test_not_utf8(self, retrieve_mock):
+        retrieve_mock.return_value = self.customer
+
+        self.login()
+
+        file = SimpleUploadedFile('clients.csv', 'zoë, émile, zoe@a.com'.encode('latin-1'))
+        response = self.client.post(reverse('import'), {'file': file}, follow=True)
+        self.assertContains(response, 'does not appear to be UTF-8')
+        self.assertIsNone(response.context['form'])
+
+
+class ValidationTestCase(TestCase):
+
+    def setUp(self):
+        AvUser.objects.create_user(email='taken@a.com', password='password')
+        self.csv = '\r\n'.join([
+            'fred, fredson, fred@a.com',
+            '"lucas", "kuzma, jr", lucas@a.com',
+            'fred, fredson ii, fred@a.com',
+            'only, two',
+            'taken, user, taken@a.com',
+            '"bad", "multi\nline", bad.a.com',
+            'zoë, émile, zoe@a.com',
+        ]).encode()
+        self.location = tempfile.mkdtemp()
+        self.storage = LocalStorage('test-bucket', location=self.location)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    @patch('av_clients.validation.EXISTING_CHUNK', 2)
+    def test_validate(self):
+        # read in chunks splitting lines and characters, existing emails are looked up two at a time
+        chunks = [self.csv[index:index + 7] for index in range(0, len(self.csv), 7)]
+        with self.assertNumQueries(3):
+            rows = validation.validate(chunks)
+        self.assertEqual(rows, [
+            ('fred', 'fredson', 'fred@a.com', False, False, False),
+            ('lucas', 'kuzma, jr', 'lucas@a.com', False, False, False),
+            ('fred', 'fredson ii', 'fred@a.com', False, True, False),
+            ('taken', 'user', 'taken@a.com', True, False, False),
+            ('bad', 'multi\nline', 'bad.a.com', False, False, True),
+            ('zoë', 'émile', 'zoe@a.com', False, False, False),
+        ])
+        self.assertEqual([row.email for row in rows if row.invitable], ['fred@a.com', 'lucas@a.com', 'zoe@a.com'])
+
+        # progress is reported with each chunk and each lookup, so long validations keep their heartbeat
+        progress = Mock()
+        validation.validate(chunks, progress)
+        self.assertEqual(progress.call_count, len(chunks) + 3)
+
+        with self.assertRaises(UnicodeDecodeError):
+            validation.validate([b'caf\xe9, bar, cafe@a.com'])
+
+    def test_load(self):
+        self.storage.put('imports/1.csv', self.csv, 'text/csv')
+        rows = validation.load(self.storage, 'imports/1.csv')
+        self.assertIsNotNone(self.storage.head('imports/1.csv' + validation.CACHE_SUFFIX))
+
+        # the commit reads the cached rows instead of the upload
+        with patch('av_clients.validation.validate') as validate_mock, self.assertNumQueries(0):
+            self.assertEqual(validation.load(self.storage, 'imports/1.csv'), rows)
+        self.assertFalse(validate_mock.called)
+        self.assertTrue(validation.load(self.storage, 'imports/1.csv')[0].invitable)
+
 
 class ClientsTestCase(TestCase):
     
@@ -255,6 +575,8 @@ class ClientsTestCase(TestCase):
             type='txt',
             size='444',
             tax_return=self.my_return,
+            s3_bucket='test-bucket',
+            s3_key='uploads/1/x',
         )
         self.file.save()
 
@@ -292,10 +614,11 @@ class ClientsTestCase(TestCase):
         response = self.client.get(url, follow=True)
         self.assertRedirects(response, '{}?next={}'.format(settings.LOGIN_URL, url))
 
-        # attempt to get own file
+        # attempt to get own file, redirects to a presigned url
         self.login()
-        response = self.client.get(url, follow=True)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertIn('uploads/1/x', response['Location'])
         
         # another's file
         file = S3File(
@@ -317,8 +640,8 @@ class ClientsTestCase(TestCase):
         url = reverse('upload-url', args=[self.file.id])
         
         # client is in CPA's firm
-        response = self.client.get(url, follow=True)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
 
         self.change_cpa_firm()
 
@@ -347,3 +670,57 @@ class ClientsTestCase(TestCase):
         # client is not in CPA's firm
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_client_list_pages(self):
+        names = ['delta', 'Alpha', 'charlie', 'alpha', 'Echo', 'bravo']
+        for index, name in enumerate(names):
+            client = AvUser.objects.create_user(email='{}{}@example.com'.format(name.lower(), index), password='x')
+            client.firm = self.firm
+            client.last_name = name
+            client.is_verified = index % 2 == 0
+            client.save()
+        self.login_cpa()
+
+        def walk(params):
+            clients, url = [], reverse('clients') + params
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                clients.extend(response.context['object_list'])
+                url = response.context.get('next_url') and reverse('clients') + response.context['next_url']
+            return clients
+
+        everyone = list(AvUser.objects.filter(firm=self.firm, is_cpa=False))
+        with patch('av_clients.views.CLIENTS_PER_PAGE', 2):
+            # ties on the lowered name go by id, in the direction of the sort
+            clients = walk('?sort=last&desc=no')
+            self.assertEqual([client.last_name.lower() for client in clients],
+                             ['', 'alpha', 'alpha', 'bravo', 'charlie', 'delta', 'echo'])
+            self.assertLess(clients[1].id, clients[2].id)
+            clients = walk('?sort=last&desc=yes')
+            self.assertEqual([client.last_name.lower() for client in clients][:3], ['echo', 'delta', 'charlie'])
+            self.assertGreater(clients[4].id, clients[5].id)
+
+            for params in ('', '?sort=first&desc=no', '?sort=email&desc=yes', '?sort=reg&desc=no', '?sort=reg'):
+                clients = walk(params)
+                self.assertEqual(len(clients), len(everyone))
+                self.assertEqual(set(clients), set(everyone))
+            self.assertEqual([client.is_verified for client in walk('?sort=reg')], [True] * 4 + [False] * 3)
+
+            response = self.client.get(reverse('clients') + '?sort=last&desc=no&after=bogus')
+            self.assertEqual(len(response.context['object_list']), 2)
+            self.assertIn('first_url', response.context)
+
+    def test_client_list_indexes(self):
+        clients = AvUser.objects.filter(firm=self.firm, is_cpa=False)
+        for sort in ('last', 'first', 'email'):
+            key, _ = views.client_sort(sort, 'no')
+            page = views.keyset_filter(clients.annotate(sort_key=key), 'a', 1, False)
+            sql, params = page.order_by('sort_key', 'id').query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = ' '.join(str(row) for row in cursor.fetchall())
+            # a range of the index starting at the previous page's last client
+            self.assertIn('av_account_avuser_clients_', plan)
+            self.assertIn('>?', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
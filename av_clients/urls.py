@@ -70,4 +70,9 @@ urlpatterns = [
         view=ClientImportPreView.as_view(),
         name='preview',
     ),
+    url(
+        regex=r'^import/(?P<pk>[0-9]+)$',
+        view=ClientImportProgressView.as_view(),
+        name='import-progress',
+    ),
 ]
\ No newline at end of file
@@ -0,0 +1,114 @@
+import codecs
+import csv
+import json
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+
+from av_account.models import AvUser
+
+# emails looked up per query when flagging clients that exist already
+EXISTING_CHUNK = 1000
+
+# the validated rows are kept next to the upload, so neither the commit nor the import parse it again
+CACHE_SUFFIX = '.rows.json'
+
+
+class ImportRow(namedtuple('ImportRow', 'first_name last_name email existing duplicate malformed')):
+    """
+    A csv row as the preview shows it, invited on commit unless flagged
+    """
+    __slots__ = ()
+
+    @property
+    def invitable(self):
+        return not (self.existing or self.duplicate or self.malformed)
+
+
+def read_lines(chunks):
+    """
+    Yields the lines of utf-8 text arriving in chunks of bytes, each with its line break, as a file opened with
+    newline='' would for the csv module
+    :raise UnicodeDecodeError: if the text is not utf-8
+    """
+    pending = ''
+    for text in codecs.iterdecode(chunks, 'utf-8-sig'):
+        lines = (pending + text).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def parse(chunks):
+    """
+    Yields (first name, last name, email) of the rows having 3 columns, reading the csv as it arrives
+    """
+    for row in csv.reader(read_lines(chunks), delimiter=',', quotechar='"', skipinitialspace=True):
+        if len(row) == 3:
+            yield row[0].strip(), row[1].strip(), row[2].strip()
+
+
+def is_email(email):
+    try:
+        validate_email(email)
+        return True
+    except ValidationError:
+        return False
+
+
+def with_progress(chunks, progress):
+    for chunk in chunks:
+        progress()
+        yield chunk
+
+
+def existing_emails(emails, progress=None):
+    emails = sorted(emails)
+    existing = set()
+    for index in range(0, len(emails), EXISTING_CHUNK):
+        if progress is not None:
+            progress()
+        existing.update(AvUser.objects.filter(email__in=emails[index:index + EXISTING_CHUNK])
+                        .values_list('email', flat=True))
+    return existing
+
+
+def validate(chunks, progress=None):
+    """
+    Flags repeated emails after their first row, malformed emails, and emails of existing users
+    :param chunks: iterable of the csv's bytes
+    :param progress: called with each chunk read and each query made, for long validations
+    :return: list of ImportRow, in file order
+    """
+    if progress is not None:
+        chunks = with_progress(chunks, progress)
+    rows = []
+    seen = set()
+    for first_name, last_name, email in parse(chunks):
+        rows.append((first_name, last_name, email, email in seen, not is_email(email)))
+        seen.add(email)
+
+    existing = existing_emails(seen, progress)
+    return [ImportRow(first_name, last_name, email, email in existing, duplicate, malformed)
+            for first_name, last_name, email, duplicate, malformed in rows]
+
+
+def load(storage, key, progress=None):
+    """
+    Validated rows of an uploaded csv, validating it only the first time
+    Existing users are as of then, the import skips any added since
+    :param progress: called as the csv or its cached rows are read, see validate()
+    """
+    cache_key = key + CACHE_SUFFIX
+    if storage.head(cache_key) is not None:
+        chunks = storage.stream(cache_key)
+        if progress is not None:
+            chunks = with_progress(chunks, progress)
+        return [ImportRow(*row) for row in json.loads(b''.join(chunks).decode())]
+
+    rows = validate(storage.stream(key), progress)
+    storage.put(cache_key, json.dumps(rows).encode(), 'application/json')
+    return rows
@@ -1,40 +1,45 @@
-import csv
-
-import io
-import os
+import json
+from datetime import datetime
 from actstream import action
 from actstream.actions import follow
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Submit
 from django import forms
+from django.conf import settings
 from django.contrib import messages
+from django.core import signing
 from django.core.exceptions import ValidationError
-from django.core.validators import validate_email
+from django.db.models import F, Q
 from django.db.models.functions import Lower
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse_lazy
 from django.views.generic import ListView, FormView, DetailView, DeleteView
 from django.views.generic.base import View, ContextMixin, logger
-from tempfile import NamedTemporaryFile
 
 from av_account.models import AvUser
 from av_account.utils import CPARequiredMixin, StripeMixin, UserViewMixin
+from av_clients import imports
+from av_clients.models import ClientImport
 from av_core.views import AbstractTableView
 from av_returns.models import Return, Expense
 from av_uploads.models import S3File
-from av_utils.utils import get_object_or_None
 
 
-def order_by_lower(sort, desc):
+# clients listed per page of the client list
+CLIENTS_PER_PAGE = 100
+
+
+def client_sort(sort, desc):
     """
-    creates ordering function
+    creates the client list's sort key
     note that postgres cannot handle ORDER BY LOWER("av_account_avuser"."date_created") or LOWER("av_account_avuser"."is_verified")
     :param sort: sort field choice
     :param desc: descending?
-    :return: ordering function
+    :return: (sort key expression, descending), each has an index on (firm_id, is_cpa, <sort key>, id)
     """
     if sort == 'reg':
-        order = 'is_verified' if desc == 'no' else '-is_verified'
+        return F('is_verified'), desc != 'no'
 
     field = {
         'last': 'last_name',
@@ -43,26 +48,72 @@ def order_by_lower(sort, desc):
     }.get(sort)
 
     if field:
-        order = Lower(field) if desc == 'no' else Lower(field).desc()
-    else:
-        order = 'date_created'
+        return Lower(field), desc != 'no'
+    return F('date_created'), False
+
 
-    return order
+def keyset_filter(clients, value, pk, descending):
+    """
+    Clients after the one with sort key value and id pk in the sort's order
+    The redundant bound on the sort key alone is what the database turns into a range of the index,
+    the OR that breaks ties by id on its own would be scanned from the start of the firm's clients
+    """
+    if descending:
+        return clients.filter(Q(sort_key__lt=value) | Q(sort_key=value, id__lt=pk), sort_key__lte=value)
+    return clients.filter(Q(sort_key__gt=value) | Q(sort_key=value, id__gt=pk), sort_key__gte=value)
 
 
 class ClientListView(CPARequiredMixin, ListView):
+    """
+    Pages through the clients by the sort key and id of the last client shown, rather than an offset,
+    so any page is a range of the sort's index however far in
+    """
     model = AvUser
     template_name = 'av_clients/list.html'
+    salt = 'av_clients.views.ClientListView'
+    next_page = None
+
+    def get_after(self):
+        """
+        :return: [sort key, id] of the last client on the previous page, None on the first page
+        """
+        try:
+            return signing.loads(self.request.GET.get('after', ''), salt=self.salt)
+        except signing.BadSignature:
+            return None
 
     def get_queryset(self):
-        sort = self.request.GET.get('sort')
-        desc = self.request.GET.get('desc')
-        return AvUser.objects.filter(firm=self.request.user.firm, is_cpa=False).order_by(order_by_lower(sort, desc))
+        key, descending = client_sort(self.request.GET.get('sort'), self.request.GET.get('desc'))
+        clients = AvUser.objects.filter(firm=self.request.user.firm, is_cpa=False).annotate(sort_key=key)
+
+        after = self.get_after()
+        if after is not None:
+            value, pk = after
+            clients = keyset_filter(clients, value, pk, descending)
+
+        # ties go by id in the same direction, so the index is read one way
+        order = ('-sort_key', '-id') if descending else ('sort_key', 'id')
+        # one client more tells whether there is a next page
+        clients = list(clients.order_by(*order)[:CLIENTS_PER_PAGE + 1])
+        if len(clients) > CLIENTS_PER_PAGE:
+            clients = clients[:CLIENTS_PER_PAGE]
+            last = clients[-1]
+            value = last.sort_key.isoformat() if isinstance(last.sort_key, datetime) else last.sort_key
+            self.next_page = signing.dumps([value, last.id], salt=self.salt)
+        return clients
 
     def get_context_data(self, **kwargs):
         context = super(ClientListView, self).get_context_data(**kwargs)
         context['sort'] = self.request.GET.get('sort')
         context['desc'] = self.request.GET.get('desc')
+        if self.next_page:
+            params = self.request.GET.copy()
+            params['after'] = self.next_page
+            context['next_url'] = '?' + params.urlencode()
+        if 'after' in self.request.GET:
+            params = self.request.GET.copy()
+            del params['after']
+            context['first_url'] = '?' + params.urlencode()
         return context
 
 
@@ -136,6 +187,11 @@ class ClientDetailUploadsView(AbstractClientReturnView, AbstractTableView):
     template_name = 'av_clients/uploads.html'
     model = S3File
     fields = [
+        {
+            'name': 'Preview',
+            'field': 'get_preview_url',
+            'image': True,
+        },
         {
             'name': 'Name',
             'field': 'name',
@@ -206,10 +262,8 @@ class ClientInviteView(CPARequiredMixin, FormView, StripeMixin):
     def get_context_data(self, **kwargs):
         context = super(ClientInviteView, self).get_context_data(**kwargs)
 
-        plan = self.get_subscription().plan
-
         context['client_count'] = self.request.user.client_count()
-        context['max_client'] = int(plan.metadata.max_client)
+        context['max_client'] = self.get_local_subscription().max_client
 
         return context
 
@@ -230,7 +284,7 @@ class UploadFileForm(forms.Form):
             raise ValidationError('Your upload does not appear to be a CSV file.')
 
         # too big
-        if file.multiple_chunks():
+        if file.size > settings.CLIENT_IMPORT_MAX_SIZE:
             raise ValidationError('Your upload is too big. (%.2f MB)' % (file.size / (1024 * 1024)))
 
         return file
@@ -244,68 +298,28 @@ class CommitUploadForm(forms.Form):
         self.helper.add_input(Submit('submit', 'Invite'))
 
 
-def generate_users(file_name, request):
-    csv_file = open(file_name)
-    file_data = csv_file.read()
-    io_string = io.StringIO(file_data)
-    users = []
-    for row in csv.reader(io_string, delimiter=',', quotechar='"', skipinitialspace=True):
-        if len(row) == 3:
-            email = row[2].strip()
-            try:
-                validate_email(email)
-                valid_email = True
-            except ValidationError:
-                valid_email = False
-
-            user = AvUser(
-                first_name=row[0].strip(),
-                last_name=row[1].strip(),
-                email=email,
-                firm=request.user.firm,
-            )
-
-            existing = get_object_or_None(AvUser, email=user.email)
-            if existing is not None:
-                setattr(user, 'existing', True)
-
-            for u in users:
-                if u.email == email:
-                    setattr(user, 'duplicate', True)
-                    break
-
-            if not valid_email:
-                setattr(user, 'malformed', True)
-
-            users.append(user)
-
-    return users
-
-
 class ClientImportView(CPARequiredMixin, FormView, StripeMixin):
     form_class = UploadFileForm
     template_name = 'av_clients/import.html'
     success_url = reverse_lazy('preview')
 
     def form_valid(self, form):
-        csv_file = self.request.FILES['file']
-        decoded_file = csv_file.read().decode('utf-8')
-
-        temp = NamedTemporaryFile(delete=False)
-        temp.write(bytes(decoded_file, 'UTF-8'))
-        temp.seek(0)
-
-        self.request.session['import_file'] = temp.name
+        job = imports.upload(self.request.user, form.cleaned_data['file'])
+        self.request.session['import_job'] = job.id
 
         return super(ClientImportView, self).form_valid(form)
 
     def get_context_data(self, **kwargs):
         context = super(ClientImportView, self).get_context_data(**kwargs)
 
-        plan = self.get_subscription().plan
-
         context['client_count'] = self.request.user.client_count()
-        context['max_client'] = int(plan.metadata.max_client)
+        context['max_client'] = self.get_local_subscription().max_client
+
+        job_id = self.request.session.get('import_job')
+        if job_id is not None:
+            context['import_job'] = ClientImport.objects.filter(
+                id=job_id, cpa=self.request.user,
+                status__in=(ClientImport.RUNNING, ClientImport.DONE, ClientImport.FAILED)).first()
 
         return context
 
@@ -315,50 +329,61 @@ class ClientImportPreView(CPARequiredMixin, FormView, StripeMixin):
     template_name = 'av_clients/import.html'
     success_url = reverse_lazy('import')
 
+    # rows shown in the preview, larger imports are summed up
+    preview_rows = 1000
+
+    def get_import(self):
+        return ClientImport.objects.filter(
+            id=self.request.session.get('import_job'), cpa=self.request.user,
+            status__in=(ClientImport.PENDING, ClientImport.VALIDATING, ClientImport.READY, ClientImport.INVALID)
+        ).first()
+
     def form_valid(self, form):
-        file_name = self.request.session['import_file']
+        job = self.get_import()
 
-        if file_name is None:
+        if job is None or not imports.start(job):
             messages.error(self.request, 'Import failed.')
             return super(ClientImportPreView, self).form_valid(form)
 
-        users = generate_users(file_name, self.request)
-        invite_count = 0
-        for user in users:
-            existing = get_object_or_None(AvUser, email=user.email)
-            if existing is None and not getattr(user, 'malformed', False):
-                user.send_invitation_code()
-                user.save()
-                follow(self.request.user, user, actor_only=False)
-                invite_count += 1
-
-        os.remove(file_name)
-        self.request.session['import_file'] = None
-
-        messages.success(self.request, 'Invitations have been sent to {} users.'.format(invite_count))
+        messages.success(self.request, 'Invitations are being sent to {} users.'.format(job.total))
         return super(ClientImportPreView, self).form_valid(form)
 
     def get_context_data(self, **kwargs):
         context = super(ClientImportPreView, self).get_context_data(**kwargs)
-        file_name = self.request.session['import_file']
+        job = self.get_import()
 
-        if file_name is None:
+        if job is None:
             context['form'] = None
             messages.error(self.request, 'Nothing to preview.')
             return context
 
-        # this can be helpful in debugging
-        # context['name'] = file_name
+        rows = []
+        if job.status in (ClientImport.PENDING, ClientImport.VALIDATING):
+            # large uploads take a while to validate, the page polls until they are done
+            context['validating_job'] = job
+            context['form'] = None
+        elif job.status == ClientImport.INVALID:
+            messages.error(self.request, job.error)
+        else:
+            # the rows cached by validation
+            rows = imports.load(job)
 
-        context['users'] = generate_users(file_name, self.request)
+        context['users'] = rows[:self.preview_rows]
+        context['more_rows'] = len(rows) - len(context['users'])
+        context['invite_count'] = job.total
 
-        if len(context['users']) == 0:
+        if len(context['users']) == 0 and 'validating_job' not in context:
             context['form'] = None
             messages.error(self.request, 'Nothing to import.')
 
-        plan = self.get_subscription().plan
-
         context['client_count'] = self.request.user.client_count()
-        context['max_client'] = int(plan.metadata.max_client)
+        context['max_client'] = self.get_local_subscription().max_client
 
         return context
+
+
+class ClientImportProgressView(CPARequiredMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        job = get_object_or_404(ClientImport, id=kwargs['pk'], cpa=request.user)
+        return HttpResponse(json.dumps(job.progress()), content_type='application/json')
@@ -2,10 +2,11 @@ from django.core import mail
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 
+from av_utils.testing import CommitCallbacksMixin
 from .models import Contact
 
 
-class ContactTestCase(TestCase):
+class ContactTestCase(CommitCallbacksMixin, TestCase):
 
     def test_new_contact(self):
         data = {
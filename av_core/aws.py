@@ -0,0 +1,28 @@
+import threading
+
+import boto3
+from django.conf import settings
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service='s3', region=None):
+    """
+    Process wide boto3 client, built once per service and region
+    Creating a client resolves credentials and endpoints which is slow, but a created client is thread safe
+    """
+    key = (service, region or settings.AWS_REGION)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = boto3.client(
+                    service,
+                    aws_access_key_id=settings.AWS_ACCESS_KEY,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                    region_name=key[1],
+                    endpoint_url=settings.AWS_S3_ENDPOINT_URL if service == 's3' else None,
+                )
+    return client
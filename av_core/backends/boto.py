@@ -1,23 +1,78 @@
 # based on https://github.com/azavea/django-amazon-ses
 """Boto3 email backend class for Amazon SES."""
-import boto3
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
 from django.conf import settings
 from django.core.mail.backends.base import BaseEmailBackend
 from django.core.mail.message import sanitize_address
 from django.dispatch import Signal
 
+from av_core import logger
+from av_core.aws import get_client
+
 pre_send = Signal(providing_args=['message'])
 post_send = Signal(providing_args=['message', 'message_id'])
 
+# errors worth another try, after backing off
+RETRY_CODES = {'Throttling', 'ThrottlingException', 'ServiceUnavailable', 'RequestTimeout', 'InternalFailure'}
+RETRIES = 4
+RETRY_DELAY = 0.5
+
+
+class TokenBucket(object):
+    """Hands out up to rate tokens a second, with bursts of up to capacity.
+
+    Shared by all threads, and by all backends of the process through
+    get_bucket(), since the SES sending rate is per account.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_bucket = None
+_bucket_lock = threading.Lock()
+
+
+def get_bucket():
+    global _bucket
+    with _bucket_lock:
+        if _bucket is None or _bucket.rate != settings.AWS_SES_MAX_SEND_RATE:
+            _bucket = TokenBucket(settings.AWS_SES_MAX_SEND_RATE)
+        return _bucket
+
 
 class EmailBackend(BaseEmailBackend):
     """An email backend for use with Amazon SES.
 
+    Messages of a batch are sent by up to AWS_SES_SEND_THREADS threads at
+    once, no faster than AWS_SES_MAX_SEND_RATE messages a second.
+
     Attributes:
-        conn: A client connection for Amazon SES.
+        conn: A client connection for Amazon SES, shared by the process.
+        summary: Counter of sent, failed and retries for the last batch.
     """
     def __init__(self, fail_silently=False, **kwargs):
         """Creates a client for the Amazon SES API.
@@ -29,12 +84,9 @@ class EmailBackend(BaseEmailBackend):
         """
         super(EmailBackend, self).__init__(fail_silently=fail_silently)
 
-        self.conn = boto3.client(
-            'ses',
-            aws_access_key_id=settings.AWS_ACCESS_KEY,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_SES_REGION,
-        )
+        self.conn = get_client('ses', settings.AWS_SES_REGION)
+        self.summary = Counter()
+        self.summary_lock = threading.Lock()
 
     def send_messages(self, email_messages):
         """Sends one or more EmailMessage objects and returns the
@@ -46,17 +98,51 @@ class EmailBackend(BaseEmailBackend):
             An integer count of the messages sent.
         Raises:
             ClientError: An interaction with the Amazon SES HTTP API
-                failed.
+                failed, raised once the rest of the batch was sent.
         """
         if not email_messages:
             return
 
-        sent_message_count = 0
+        errors = self.send_each(email_messages)
+        for error in errors:
+            if isinstance(error, (BotoCoreError, ClientError)) and not self.fail_silently:
+                raise error
+        return errors.count(None)
+
+    def send_each(self, email_messages):
+        """Sends a batch of EmailMessage objects concurrently, reporting
+        on each of them rather than raising.
 
-        for email_message in email_messages:
-            if self._send(email_message):
-                sent_message_count += 1
-        return sent_message_count
+        Args:
+            email_messages: A list of Django EmailMessage objects.
+        Returns:
+            A list with, in order, None for each message sent and the
+            exception for each that was not.
+        """
+        started = time.time()
+        self.summary = Counter()
+
+        def send(email_message):
+            try:
+                if self._send(email_message):
+                    return None
+                return ValueError('Message has no recipients.')
+            except (BotoCoreError, ClientError) as e:
+                return e
+
+        threads = min(settings.AWS_SES_SEND_THREADS, len(email_messages))
+        if threads <= 1:
+            errors = [send(email_message) for email_message in email_messages]
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                errors = list(executor.map(send, email_messages))
+
+        self.summary['sent'] += errors.count(None)
+        self.summary['failed'] += len(email_messages) - errors.count(None)
+        self.summary['seconds'] = round(time.time() - started, 1)
+        if len(email_messages) > 1:
+            logger.info('SES batch: {}'.format(dict(self.summary)))
+        return errors
 
     def _send(self, email_message):
         """Sends an individual message via the Amazon SES HTTP API.
@@ -64,10 +150,11 @@ class EmailBackend(BaseEmailBackend):
         Args:
             email_message: A single Django EmailMessage object.
         Returns:
-            True if the EmailMessage was sent successfully, otherwise False.
+            True if the EmailMessage was sent successfully, False if it
+            has no recipients.
         Raises:
             ClientError: An interaction with the Amazon SES HTTP API
-                failed.
+                failed, whether or not failing silently.
         """
         pre_send.send(self.__class__, message=email_message)
 
@@ -81,21 +168,37 @@ class EmailBackend(BaseEmailBackend):
         message = email_message.message().as_bytes(linesep='\r\n')
 
         try:
-            result = self.conn.send_raw_email(
-                Source=from_email,
-                Destinations=recipients,
-                RawMessage={
-                    'Data': message
-                }
-            )
+            result = self._send_raw(from_email, recipients, message)
             message_id = result['MessageId']
             post_send.send(
                 self.__class__,
                 message=email_message,
                 message_id=message_id
             )
-        except ClientError:
-            if not self.fail_silently:
-                raise
-            return False
+        except (BotoCoreError, ClientError) as e:
+            logger.error('SES could not send to {}: {}'.format(recipients, e))
+            raise
         return True
+
+    def _send_raw(self, from_email, recipients, message):
+        """Calls send_raw_email at the allowed rate, backing off and
+        retrying while SES is throttling or unavailable.
+        """
+        bucket = get_bucket()
+        for attempt in range(RETRIES + 1):
+            bucket.acquire()
+            try:
+                return self.conn.send_raw_email(
+                    Source=from_email,
+                    Destinations=recipients,
+                    RawMessage={
+                        'Data': message
+                    }
+                )
+            except (BotoCoreError, ClientError) as e:
+                code = e.response['Error']['Code'] if isinstance(e, ClientError) else None
+                if attempt == RETRIES or (isinstance(e, ClientError) and code not in RETRY_CODES):
+                    raise
+                with self.summary_lock:
+                    self.summary['retries'] += 1
+                time.sleep(RETRY_DELAY * 2 ** attempt * (1 + random.random()))
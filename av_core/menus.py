@@ -70,7 +70,10 @@ def is_cpa(request):
 
 
 def is_admin(request):
-    return not request.user.is_anonymous() and request.user.is_admin()
+    # validators run on every render, so this reads the request's auth snapshot instead of querying
+    # imported late since settings star imports this module before apps are loaded
+    from av_account.middleware import get_auth_snapshot
+    return get_auth_snapshot(request).is_admin
 
 
 def is_not_cpa(request):
@@ -121,6 +121,9 @@ MIDDLEWARE = [
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'ip_restriction.IpWhitelister',
     'django_agent_trust.middleware.AgentMiddleware',
+
+    # after auth and agent trust
+    'av_account.middleware.AuthSnapshotMiddleware',
 ]
 
 ROOT_URLCONF = 'av_core.urls'
@@ -220,6 +223,16 @@ LOGGING = {
     }
 }
 
+# Cache
+# shared between dynos via the database, create the table with `python manage.py createcachetable`
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'av_cache',
+    }
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.11/topics/i18n/
 
@@ -274,21 +287,57 @@ AWS_ACCESS_KEY = os.environ.get('AWS_ACCESS_KEY', 'test-key')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', 'test-secret')
 AWS_BUCKET_NAME = os.environ.get('AWS_BUCKET_NAME', 'test-bucket')
 AWS_REGION = os.environ.get('AWS_REGION', 'us-test-1')
+# point s3 calls at a local stand-in such as minio, unset for aws
+AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL') or None
 
 AWS_DESTINATIONS = {
     'uploads': {
         'auth': lambda u: u.is_authenticated(),
         'content_length_range': (1, 10000000),
+        # larger files go through the multipart upload endpoints
+        'multipart_length_range': (1, 2 * 1024 ** 3),
         'acl': 'private',
         'cache_control': 'max-age=2592000',  # 60x60x24x30
         'server_side_encryption': 'AES256',
         'key': 'uploads',
+        # 'local' keeps files under LOCAL_STORAGE_ROOT instead, to run without s3
+        'storage': os.environ.get('UPLOADS_STORAGE', 's3'),
+    },
+    'imports': {
+        # client import csvs, written by the app only, see av_clients.imports
+        'auth': lambda u: False,
+        'server_side_encryption': 'AES256',
+        'key': 'imports',
+        'storage': os.environ.get('UPLOADS_STORAGE', 's3'),
+        # holds no S3Files, so reconcile_uploads leaves it out
+        'reconcile': False,
     },
 }
+# where destinations with 'storage': 'local' keep their files, see av_uploads.storage
+LOCAL_STORAGE_ROOT = os.environ.get('LOCAL_STORAGE_ROOT', os.path.join(BASE_DIR, 'storage'))
+# threads per gunicorn worker process, the Procfile runs gthread workers with as many
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))
+# stream downloads through the app rather than redirecting to s3, and how many at once per worker process
+# a share of its threads, so the rest keep serving pages, which only threaded workers can do
+UPLOAD_PROXY_DOWNLOADS = os.environ.get('UPLOAD_PROXY_DOWNLOADS') == '1'
+UPLOAD_PROXY_CONCURRENCY = int(os.environ.get('UPLOAD_PROXY_CONCURRENCY', max(1, WEB_THREADS // 2)))
+# queue thumbnails of uploaded pdfs and images for the previews process, see av_uploads.previews
+UPLOAD_PREVIEWS = not TESTING
 
 # ses
 EMAIL_BACKEND = 'av_core.backends.boto.EmailBackend'
 AWS_SES_REGION = os.environ.get('AWS_SES_REGION', 'us-east-1')
+# the account's maximum send rate, messages a second, and how many are sent at once
+AWS_SES_MAX_SEND_RATE = float(os.environ.get('AWS_SES_MAX_SEND_RATE', 14))
+AWS_SES_SEND_THREADS = int(os.environ.get('AWS_SES_SEND_THREADS', 8))
+
+# csv imports invite their clients in a background thread, the import page polls for progress
+CLIENT_IMPORT_BACKGROUND = not TESTING
+# largest client import csv accepted, about 1.5 million rows
+CLIENT_IMPORT_MAX_SIZE = 50 * 1024 * 1024
+
+# emails wait in the outbox for the send_emails worker, set to send them from the request instead
+EMAIL_OUTBOX_SYNC = TESTING or os.environ.get('EMAIL_OUTBOX_SYNC') == '1'
 
 # phonenumber_field
 PHONENUMBER_DB_FORMAT = 'NATIONAL'
@@ -316,6 +365,12 @@ DJANGO_MESSAGES_NOTIFY = False  # disable built-in emails
 STRIPE_PUBLIC_KEY = os.environ.get("STRIPE_PUBLIC_KEY", "")
 STRIPE_SECRET_KEY = os.environ.get("STRIPE_SECRET_KEY", "")
 
+# signing secret of the webhook endpoint, events are rejected until this is set
+if TESTING:
+    STRIPE_WEBHOOK_SECRET = 'whsec_test'
+else:
+    STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET", "")
+
 STRIPE_PLANS = {
     'yearly': {
         'a': os.environ.get("STRIPE_PLAN_A_Y", "plan_low_ay"),
@@ -331,6 +386,11 @@ STRIPE_PLANS = {
 
 STRIPE_DEFAULT_PLAN = STRIPE_PLANS['monthly']['c']
 
+# plan catalog is refreshed in the background after this long
+STRIPE_PLANS_CACHE_SECONDS = int(os.environ.get("STRIPE_PLANS_CACHE_SECONDS", 60 * 60))
+# how long a process trusts its own copy before checking the shared cache, bounds invalidation delay
+STRIPE_PLANS_LOCAL_SECONDS = 60
+
 # notifications
 NOTIFICATION_NUMBERS = (
     '+13106663912',
@@ -5,6 +5,15 @@ import createHash from 'sha.js';
 
 import { checkStatus } from '../utils';
 
+// files above the single upload limit go up in parts, several at a time
+export const MULTIPART_THRESHOLD = 10000000;
+const PART_CONCURRENCY = 4;
+const SIGN_BATCH = 500;
+
+// strings evaporate asks to have signed in the same tick, signed with one request, see flushSignatures
+const MAX_SIGNATURES = 1000;
+let pendingSignatures = [];
+
 export default class S3UploadService {
   /*
   The only function that should be treated as public. Returns a promise
@@ -13,10 +22,90 @@ export default class S3UploadService {
   static upload({
     file, year, target, onProgress,
   }) {
-    return S3UploadService.getParams({ file, year, target })
-      .then(params => S3UploadService.postToS3({ file, onProgress, params }))
-      .then(awsS3ObjectKey => S3UploadService.postToComplete(awsS3ObjectKey))
-      .then(objectKey => objectKey);
+    if (file.size > MULTIPART_THRESHOLD) {
+      return S3UploadService.uploadMultipart({
+        file, year, target, onProgress,
+      });
+    }
+
+    return S3UploadService.hashFile(file)
+      .then(sha256 => S3UploadService.getParams({
+        file, year, target, sha256,
+      }))
+      .then((params) => {
+        // the same content is already on the return, nothing to upload
+        if (params.duplicate) return params.object_key;
+        return S3UploadService.postToS3({ file, onProgress, params })
+          .then(awsS3ObjectKey => S3UploadService.postToComplete(awsS3ObjectKey));
+      });
+  }
+
+  /*
+  Resolves with the hex sha-256 of a small file, or an empty string where
+  the browser can't hash it, which just means it is uploaded regardless.
+  */
+  static hashFile(file) {
+    const subtle = window.crypto && window.crypto.subtle;
+    if (!subtle || file.size > MULTIPART_THRESHOLD) return Promise.resolve('');
+
+    return new Promise((resolve, reject) => {
+      const reader = new FileReader();
+      reader.onload = () => resolve(reader.result);
+      reader.onerror = () => reject(reader.error);
+      reader.readAsArrayBuffer(file);
+    })
+      .then(data => subtle.digest('SHA-256', data))
+      .then(digest => Array.from(new Uint8Array(digest))
+        .map(byte => `0${byte.toString(16)}`.slice(-2))
+        .join(''))
+      .catch(() => '');
+  }
+
+  /*
+  Uploads many small files with a single params request: every file comes
+  back with a signed POST policy, and one request confirms them all.
+  Resolves with the keys of the uploaded files.
+  */
+  static uploadMany({
+    files, year, target, onProgress,
+  }) {
+    return Promise.all(files.map(S3UploadService.hashFile))
+      .then(hashes => S3UploadService.post('/api/uploads/params', {
+        destination: 'uploads',
+        presigned: 1,
+        file_name: files.map(file => file.name),
+        file_type: files.map(file => file.type),
+        file_size: files.map(file => file.size),
+        file_sha256: hashes,
+        year,
+        target,
+      }))
+      .then(({ files: posts }) => Promise.all(posts.map((post, index) => {
+        // duplicates point at a file already on the return
+        if (post.duplicate) return null;
+        return S3UploadService.postToPresigned(files[index], post, progress => onProgress(files[index], progress));
+      })).then(uploadedKeys => ({ posts, uploadedKeys: uploadedKeys.filter(objectKey => objectKey) })))
+      .then(({ posts, uploadedKeys }) => {
+        const objectKeys = posts.map(post => post.object_key);
+        if (!uploadedKeys.length) return objectKeys;
+        return S3UploadService.post('/api/uploads/complete', { object_key: uploadedKeys }).then(() => objectKeys);
+      });
+  }
+
+  // xhr rather than fetch, for upload progress
+  static postToPresigned(file, post, onProgress) {
+    return new Promise((resolve, reject) => {
+      const formData = new FormData();
+      Object.keys(post.fields).forEach(name => formData.append(name, post.fields[name]));
+      formData.append('file', file);
+
+      const xhr = new XMLHttpRequest();
+      xhr.upload.onprogress = event => onProgress(event.loaded / event.total);
+      xhr.onload = () => (xhr.status < 300 ? resolve(post.object_key) : reject(new Error(xhr.statusText)));
+      xhr.onerror = () => reject(new Error(xhr.statusText));
+      xhr.open('POST', post.url);
+      xhr.send(formData);
+    });
   }
 
   static computeMd5(data) {
@@ -38,28 +127,36 @@ export default class S3UploadService {
   }
 
   static getAwsV4Signature(signParams, signHeaders, stringToSign, signatureDateTime) {
-    const formData = new FormData();
-    formData.append('to_sign', stringToSign);
-    formData.append('datetime', signatureDateTime);
+    return new Promise((resolve, reject) => {
+      if (!pendingSignatures.length) setTimeout(S3UploadService.flushSignatures, 0);
+      pendingSignatures.push({
+        stringToSign, signatureDateTime, resolve, reject,
+      });
+    });
+  }
 
-    return fetch('/api/uploads/signature', {
-      body: formData,
-      credentials: 'same-origin',
-      headers: {
-        'X-CSRFToken': Cookies.get('csrftoken'),
-      },
-      method: 'POST',
+  static flushSignatures() {
+    const batch = pendingSignatures.slice(0, MAX_SIGNATURES);
+    pendingSignatures = pendingSignatures.slice(MAX_SIGNATURES);
+    if (pendingSignatures.length) setTimeout(S3UploadService.flushSignatures, 0);
+
+    return S3UploadService.post('/api/uploads/signatures', {
+      to_sign: batch.map(request => request.stringToSign),
+      datetime: batch.map(request => request.signatureDateTime),
     })
-      .then(checkStatus)
-      .then(response => response.text());
+      .then(({ signatures }) => batch.forEach((request, index) => request.resolve(signatures[index])))
+      .catch(error => batch.forEach(request => request.reject(error)));
   }
 
-  static getParams({ file, year, target }) {
+  static getParams({
+    file, year, target, sha256,
+  }) {
     const formData = new FormData();
     formData.append('destination', 'uploads');
     formData.append('file_name', file.name);
     formData.append('file_size', file.size);
     formData.append('file_type', file.type);
+    if (sha256) formData.append('file_sha256', sha256);
     formData.append('year', year);
     formData.append('target', target);
 
@@ -130,4 +227,115 @@ export default class S3UploadService {
       .then(checkStatus)
       .then(() => objectKey);
   }
+
+  // array values become repeated params
+  static post(url, fields) {
+    const formData = new FormData();
+    Object.keys(fields).forEach(name => [].concat(fields[name]).forEach(value => formData.append(name, value)));
+
+    return fetch(url, {
+      body: formData,
+      credentials: 'same-origin',
+      headers: {
+        'X-CSRFToken': Cookies.get('csrftoken'),
+      },
+      method: 'POST',
+    })
+      .then(checkStatus)
+      .then(response => response.json());
+  }
+
+  // remembers the object key of an unfinished upload, so picking the same file again resumes it
+  static resumeKey(file) {
+    return `multipart:${file.name}:${file.size}:${file.lastModified}`;
+  }
+
+  static startMultipart({ file, year, target }) {
+    const objectKey = window.localStorage.getItem(S3UploadService.resumeKey(file));
+    const start = () => S3UploadService.post('/api/uploads/multipart', {
+      destination: 'uploads',
+      file_name: file.name,
+      file_size: file.size,
+      file_type: file.type,
+      year,
+      target,
+    }).then((params) => {
+      window.localStorage.setItem(S3UploadService.resumeKey(file), params.object_key);
+      return { objectKey: params.object_key, partSize: params.part_size, uploaded: [] };
+    });
+
+    if (!objectKey) {
+      return start();
+    }
+
+    return fetch(`/api/uploads/multipart/parts?object_key=${encodeURIComponent(objectKey)}`, {
+      credentials: 'same-origin',
+    })
+      .then(checkStatus)
+      .then(response => response.json())
+      .then(params => ({
+        objectKey,
+        partSize: params.part_size,
+        uploaded: params.parts.filter(part => part.size > 0).map(part => part.part_number),
+      }))
+      .catch(start);
+  }
+
+  static uploadMultipart({
+    file, year, target, onProgress,
+  }) {
+    return S3UploadService.startMultipart({ file, year, target })
+      .then(({ objectKey, partSize, uploaded }) => {
+        const partCount = Math.max(1, Math.ceil(file.size / partSize));
+        const remaining = [];
+        for (let number = 1; number <= partCount; number += 1) {
+          if (uploaded.indexOf(number) < 0) remaining.push(number);
+        }
+
+        let done = partCount - remaining.length;
+        onProgress(done / partCount);
+
+        const putPart = (number, url) => fetch(url, {
+          body: file.slice((number - 1) * partSize, number * partSize),
+          method: 'PUT',
+        }).then((response) => {
+          if (!response.ok) return Promise.reject(new Error(`Part ${number} failed.`));
+          done += 1;
+          onProgress(done / partCount);
+          return response;
+        });
+
+        // sign a batch of parts with one request, then put them a few at a time
+        const uploadBatch = (batch) => {
+          if (!batch.length) return Promise.resolve();
+          return S3UploadService.post('/api/uploads/multipart/sign', {
+            object_key: objectKey,
+            part_numbers: batch.join(','),
+          }).then(({ urls }) => {
+            const queue = batch.slice();
+            const worker = () => {
+              const number = queue.shift();
+              return number ? putPart(number, urls[number]).then(worker) : Promise.resolve();
+            };
+            return Promise.all(Array.from({ length: PART_CONCURRENCY }, worker));
+          });
+        };
+
+        let uploading = Promise.resolve();
+        for (let index = 0; index < remaining.length; index += SIGN_BATCH) {
+          const batch = remaining.slice(index, index + SIGN_BATCH);
+          uploading = uploading.then(() => uploadBatch(batch));
+        }
+
+        return uploading
+          .then(() => S3UploadService.post('/api/uploads/multipart/complete', {
+            object_key: objectKey,
+            part_count: partCount,
+          }))
+          .then(() => {
+            window.localStorage.removeItem(S3UploadService.resumeKey(file));
+            return objectKey;
+          });
+      });
+  }
 }
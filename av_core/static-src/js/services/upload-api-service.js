@@ -9,11 +9,20 @@ export default class UploadApiService {
       filesUrl = `/api/returns/${year}/${target}/files/?only_uploaded=1`;
     }
 
-    return fetch(filesUrl, {
+    return UploadApiService.getPages(filesUrl, []);
+  }
+
+  // files are paginated with a cursor, follow next links until the last page
+  static getPages(url, files) {
+    return fetch(url, {
       credentials: 'same-origin',
     })
       .then(checkStatus)
-      .then(response => response.json());
+      .then(response => response.json())
+      .then((page) => {
+        const all = files.concat(page.results);
+        return page.next ? UploadApiService.getPages(page.next, all) : all;
+      });
   }
 
   static deleteFile(url) {
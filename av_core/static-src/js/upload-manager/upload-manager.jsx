@@ -3,7 +3,7 @@ import PropTypes from 'prop-types';
 import Dropzone from 'react-dropzone';
 
 import UploadApiService from '../services/upload-api-service';
-import S3UploadService from '../services/s3-upload-service';
+import S3UploadService, { MULTIPART_THRESHOLD } from '../services/s3-upload-service';
 import File from '../shared/file/file';
 import ProgressBar from '../shared/progress-bar/progress-bar';
 import DeleteConfirmationModal from '../shared/delete-confirmation-modal/delete-confirmation-modal';
@@ -44,9 +44,24 @@ export default class UploadManager extends React.Component {
   onDroppedFiles(files) {
     this.setState({ error: null });
 
+    // small files share one presigned request, large ones go up in parts
+    const smallFiles = [];
     const uploadPromises = [];
     for (let i = 0; i < files.length; i += 1) {
-      uploadPromises.push(this.uploadFile(files[i]));
+      if (files[i].size > MULTIPART_THRESHOLD) {
+        uploadPromises.push(this.uploadFile(files[i]));
+      } else {
+        smallFiles.push(files[i]);
+        this.setFileProgress(files[i].name, 0);
+      }
+    }
+    if (smallFiles.length) {
+      uploadPromises.push(S3UploadService.uploadMany({
+        files: smallFiles,
+        onProgress: (file, progress) => this.onUploadProgress(file, progress),
+        year: this.props.year,
+        target: this.props.target,
+      }));
     }
 
     Promise.all(uploadPromises)
@@ -15,7 +15,12 @@ def table(object_list, fields):
             value = getattr(obj, field['field'])
             if callable(value):
                 value = value()
-            if 'link' in field:
+            if field.get('image'):
+                cols.append({
+                    'is_image': True,
+                    'image': value,
+                })
+            elif 'link' in field:
                 url = getattr(obj, field['link'], None)
                 if callable(url):
                     url = url()
@@ -15,7 +15,8 @@ from av_core import settings
 from av_core.views import HomeView, ClientHomeView, CpaHomeView
 from av_returns.api import ExpenseViewSet, CommonExpenseViewSet, ReturnViewSet
 from av_uploads.views import UploadParamsView, UploadSignatureView, UploadCompleteView, FileViewSet, CpaFileViewSet, \
-    DownloadsViewSet
+    DownloadsViewSet, UploadSignaturesView, MultipartUploadView, MultipartSignView, MultipartPartsView, MultipartCompleteView, \
+    MultipartAbortView
 
 
 @login_required
@@ -83,7 +84,13 @@ urlpatterns = [
     # image upload api
     url(r'^api/uploads/params$', UploadParamsView.as_view(), name='upload_params'),
     url(r'^api/uploads/signature$', UploadSignatureView.as_view(), name='upload_signature'),
+    url(r'^api/uploads/signatures$', UploadSignaturesView.as_view(), name='upload_signatures'),
     url(r'^api/uploads/complete', UploadCompleteView.as_view(), name='upload_complete'),
+    url(r'^api/uploads/multipart$', MultipartUploadView.as_view(), name='upload_multipart'),
+    url(r'^api/uploads/multipart/sign$', MultipartSignView.as_view(), name='upload_multipart_sign'),
+    url(r'^api/uploads/multipart/parts$', MultipartPartsView.as_view(), name='upload_multipart_parts'),
+    url(r'^api/uploads/multipart/complete$', MultipartCompleteView.as_view(), name='upload_multipart_complete'),
+    url(r'^api/uploads/multipart/abort$', MultipartAbortView.as_view(), name='upload_multipart_abort'),
 
     # admin etc.
     url(r'^admin/', admin.site.urls),
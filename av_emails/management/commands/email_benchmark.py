@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+
+from av_account.models import AvUser, Firm
+from av_emails.rendering import get_url, render_bulk
+
+TEMPLATE = 'av_emails/invitation.html'
+
+
+class Command(BaseCommand):
+    help = 'Times rendering invitation emails one by one against rendering them as a batch, nothing is sent'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500, help='Emails rendered each way')
+
+    def handle(self, *args, **options):
+        firm = Firm(name='Benchmark CPA')
+        users = [AvUser(email='client{}@example.com'.format(i), firm=firm, email_verification_code='{:016d}'.format(i))
+                 for i in range(options['count'])]
+
+        # the first render of each way compiles templates and looks up the site
+        list(render_bulk(TEMPLATE, [(users[0].email, {'user': users[0]})]))
+        render_to_string(TEMPLATE, {'user': users[0], 'site_url': get_url(), 'recipient': users[0].email})
+
+        started = time.perf_counter()
+        for user in users:
+            render_to_string(TEMPLATE, {'user': user, 'site_url': get_url(), 'recipient': user.email})
+        single = (time.perf_counter() - started) / len(users)
+
+        started = time.perf_counter()
+        for _ in render_bulk(TEMPLATE, ((user.email, {'user': user}) for user in users)):
+            pass
+        bulk = (time.perf_counter() - started) / len(users)
+
+        self.stdout.write('render_to_string: {:.0f}us per email'.format(single * 1e6))
+        self.stdout.write(self.style.SUCCESS('render_bulk: {:.0f}us per email, {:.1f}x faster'.format(
+            bulk * 1e6, single / bulk)))
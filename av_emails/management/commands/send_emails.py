@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from av_emails.outbox import BATCH_SIZE, drain
+
+
+class Command(BaseCommand):
+    help = 'Sends the emails waiting in the outbox, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Emails locked and sent at a time')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep draining every so many seconds instead of exiting, for a worker dyno')
+
+    def handle(self, *args, **options):
+        while True:
+            stats = drain(options['batch_size'])
+            if stats['batches'] or not options['interval']:
+                self.stdout.write(self.style.SUCCESS(
+                    'Sent {sent} emails in {batches} batches and {seconds}s, '
+                    '{failed} failed, {dead} dead, {pending} pending.'.format_map(stats)))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
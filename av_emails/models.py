@@ -0,0 +1,26 @@
+from django.db import models
+from django.utils import timezone
+
+
+class OutboxEmail(models.Model):
+    """
+    Outbox of rendered emails, written by send_email in the caller's transaction
+    Drained in batches by the send_emails management command, sent rows are deleted
+    Rows failing MAX_ATTEMPTS times are marked dead and left for a human to look at
+    """
+    subject = models.TextField()
+    from_email = models.TextField()
+    recipient = models.TextField()
+    body = models.TextField()
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    dead = models.BooleanField(default=False)
+    # not sent before this, pushed back after each failure
+    next_attempt = models.DateTimeField(default=timezone.now)
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['dead', 'next_attempt'])]
+
+    def __str__(self):
+        return '{}: {}'.format(self.recipient, self.subject)
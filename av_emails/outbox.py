@@ -0,0 +1,112 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from av_core import logger
+from av_emails.models import OutboxEmail
+
+BATCH_SIZE = 100
+
+# a failed email is tried again after RETRY_DELAY, doubling with each attempt
+RETRY_DELAY = timedelta(minutes=1)
+
+# emails that failed this many times are dead lettered
+MAX_ATTEMPTS = 6
+
+
+def get_message(email):
+    message = EmailMultiAlternatives(email.subject, email.body, email.from_email, [email.recipient])
+    message.attach_alternative(email.body, 'text/html')
+    return message
+
+
+def send_each(connection, messages):
+    """
+    Sends the messages through one connection
+    The ses backend sends them concurrently at the account's rate, others one at a time
+    :return: list with None for each message sent and the error for each that was not
+    """
+    if hasattr(connection, 'send_each'):
+        return connection.send_each(messages)
+
+    errors = []
+    for message in messages:
+        try:
+            connection.send_messages([message])
+            errors.append(None)
+        except Exception as e:
+            errors.append(e)
+    return errors
+
+
+def deliver(emails, stats):
+    """
+    Sends the emails, deleting those sent and pushing back or dead lettering the rest
+    """
+    try:
+        errors = send_each(get_connection(), [get_message(email) for email in emails])
+    except Exception as e:
+        # e.g. no backend to send with, the whole batch waits for its next attempt
+        errors = [e] * len(emails)
+
+    now = timezone.now()
+    sent = []
+    for email, error in zip(emails, errors):
+        if error is None:
+            logger.info('sent from:{} to:{} subject:{}'.format(email.from_email, email.recipient, email.subject))
+            sent.append(email.id)
+            continue
+
+        attempts = email.attempts + 1
+        dead = attempts >= MAX_ATTEMPTS
+        log = logger.error if dead else logger.warn
+        log('Email {} to {} failed, attempt {}: {}'.format(email.id, email.recipient, attempts, error))
+        OutboxEmail.objects.filter(id=email.id).update(
+            attempts=F('attempts') + 1, last_error=str(error), dead=dead,
+            next_attempt=now + RETRY_DELAY * 2 ** email.attempts)
+        stats['dead' if dead else 'failed'] += 1
+
+    OutboxEmail.objects.filter(id__in=sent).delete()
+    stats['sent'] += len(sent)
+
+
+def drain_batch(stats, after=0, batch_size=BATCH_SIZE):
+    """
+    Sends the next batch of due emails, locking the rows so concurrent workers take other batches
+    :param after: only outbox rows with a higher id are taken
+    :return: highest outbox id handled, None once there is nothing left
+    """
+    with transaction.atomic():
+        emails = list(OutboxEmail.objects
+                      .select_for_update(skip_locked=True)
+                      .filter(id__gt=after, dead=False, next_attempt__lte=timezone.now())
+                      .order_by('id')[:batch_size])
+        if not emails:
+            return None
+
+        deliver(emails, stats)
+        stats['batches'] += 1
+        return emails[-1].id
+
+
+def drain(batch_size=BATCH_SIZE):
+    """
+    Walks the due emails once in id order, emails failing in this run wait for their next attempt
+    :return: Counter of batches, sent, failed, dead and pending emails
+    """
+    started = time.time()
+    stats = Counter()
+    after = 0
+    while after is not None:
+        after = drain_batch(stats, after, batch_size)
+
+    stats['pending'] = OutboxEmail.objects.filter(dead=False).count()
+    stats['seconds'] = round(time.time() - started, 1)
+    if stats['batches']:
+        logger.info('Email outbox drained: {}'.format(dict(stats)))
+    return stats
@@ -1,9 +1,26 @@
+import time
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from django.contrib.sites.models import Site
 from django.core import mail
-from django.test import TestCase
+from django.core.mail import EmailMessage
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from django_messages.models import Message
 
 from av_account.models import AvUser
+from av_core import aws
+from av_core.backends import boto
+from av_emails import outbox
+from av_emails.models import OutboxEmail
+from av_emails.rendering import render, render_bulk
+from av_emails.utils import send_bulk, send_email
 from av_returns.models import Return
+from av_utils.testing import CommitCallbacksMixin
 
 
 class EmailTest(TestCase):
@@ -54,3 +71,162 @@ class EmailTest(TestCase):
     #     self.my_return.save()
     #     self.assertEqual(len(mail.outbox), 1)
     #     self.assertEqual(mail.outbox[0].to[0], self.cpa.email)
+
+
+class OutboxTestCase(CommitCallbacksMixin, TestCase):
+
+    def test_sync(self):
+        send_email(subject='Hello', recipient='client@example.com')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].alternatives[0][1], 'text/html')
+        self.assertFalse(OutboxEmail.objects.exists())
+
+        # sent once the transaction commits, and not at all if it rolls back
+        with transaction.atomic():
+            send_email(subject='Hello', recipient='client1@example.com')
+            self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(len(mail.outbox), 2)
+        try:
+            with transaction.atomic():
+                send_email(subject='Hello', recipient='client2@example.com')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertFalse(OutboxEmail.objects.exists())
+
+    @override_settings(EMAIL_OUTBOX_SYNC=False)
+    def test_drain(self):
+        for i in range(3):
+            send_email(subject='Hello', recipient='client{}@example.com'.format(i))
+        self.assertEqual(len(mail.outbox), 0)
+
+        stats = outbox.drain(batch_size=2)
+        self.assertEqual((stats['sent'], stats['batches'], stats['pending']), (3, 2, 0))
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['client0@example.com', 'client1@example.com', 'client2@example.com'])
+        self.assertFalse(OutboxEmail.objects.exists())
+
+    @override_settings(EMAIL_OUTBOX_SYNC=False)
+    def test_rollback(self):
+        try:
+            with transaction.atomic():
+                send_email(subject='Hello', recipient='client@example.com')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(OutboxEmail.objects.exists())
+
+    @override_settings(EMAIL_OUTBOX_SYNC=False)
+    def test_dead_letter(self):
+        send_email(subject='Hello', recipient='client@example.com')
+        with patch('av_emails.outbox.get_connection', side_effect=ConnectionError('ses is down')):
+            stats = outbox.drain()
+            self.assertEqual((stats['sent'], stats['failed'], stats['pending']), (0, 1, 1))
+            # not due again before its next attempt
+            self.assertEqual(outbox.drain()['batches'], 0)
+
+            OutboxEmail.objects.update(attempts=outbox.MAX_ATTEMPTS - 1, next_attempt=timezone.now())
+            self.assertEqual(outbox.drain()['dead'], 1)
+
+        email = OutboxEmail.objects.get()
+        self.assertEqual((email.dead, email.last_error), (True, 'ses is down'))
+        self.assertEqual(outbox.drain()['batches'], 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class RenderingTestCase(TestCase):
+
+    def setUp(self):
+        self.users = [AvUser(email='client{}@example.com'.format(i), email_verification_code='CODE{:012d}'.format(i))
+                      for i in range(3)]
+
+    def test_render(self):
+        # the snippets pasted in at compile time render the same as including them
+        user = self.users[0]
+        html = render('av_emails/invitation.html', user.email, {'user': user})
+        self.assertEqual(html, render_to_string('av_emails/invitation.html', {
+            'user': user, 'recipient': user.email, 'site_url': 'http://example.com'}))
+        self.assertNotIn('include', html)
+
+    def test_render_bulk(self):
+        rendered = list(render_bulk('av_emails/invitation.html', [(user.email, {'user': user}) for user in self.users]))
+        self.assertEqual([recipient for recipient, html in rendered], [user.email for user in self.users])
+        for user, (recipient, html) in zip(self.users, rendered):
+            self.assertIn('http://example.com/account/invitation/{}/'.format(user.email_verification_code), html)
+            # nothing leaks from the previous recipient
+            self.assertEqual(html.count('CODE'), 2)
+
+    @override_settings(EMAIL_OUTBOX_SYNC=False)
+    def test_send_bulk(self):
+        # one site lookup and one insert, however many recipients
+        Site.objects.clear_cache()
+        with self.assertNumQueries(2):
+            send_bulk('Welcome', 'av_emails/invitation.html', [(user.email, {'user': user}) for user in self.users])
+        self.assertEqual(sorted(OutboxEmail.objects.values_list('recipient', flat=True)),
+                         [user.email for user in self.users])
+
+        send_bulk('Welcome', 'av_emails/invitation.html', [])
+        self.assertEqual(OutboxEmail.objects.count(), 3)
+
+
+@override_settings(AWS_SES_MAX_SEND_RATE=1000, AWS_SES_SEND_THREADS=4)
+@patch('av_core.backends.boto.RETRY_DELAY', 0)
+class SesBackendTestCase(TestCase):
+
+    def setUp(self):
+        aws._clients.clear()
+        self.backend = boto.EmailBackend()
+        self.stubber = Stubber(self.backend.conn)
+        self.stubber.activate()
+        self.messages = [EmailMessage('Invitation', 'Hi', 'from@example.com', ['client{}@example.com'.format(i)])
+                         for i in range(20)]
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        aws._clients.clear()
+
+    def test_batch(self):
+        self.stubber.add_client_error('send_raw_email', 'Throttling', 'Maximum sending rate exceeded.')
+        self.stubber.add_client_error('send_raw_email', 'Throttling', 'Maximum sending rate exceeded.')
+        for i in range(20):
+            self.stubber.add_response('send_raw_email', {'MessageId': str(i)})
+
+        self.assertEqual(self.backend.send_messages(self.messages), 20)
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual((self.backend.summary['sent'], self.backend.summary['retries']), (20, 2))
+
+    def test_rejected(self):
+        self.stubber.add_client_error('send_raw_email', 'MessageRejected', 'Email address is not verified.')
+        for i in range(2):
+            self.stubber.add_response('send_raw_email', {'MessageId': str(i)})
+
+        # the rest of the batch still goes out before the error is raised
+        with self.assertRaises(ClientError):
+            self.backend.send_messages(self.messages[:3])
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual((self.backend.summary['sent'], self.backend.summary['failed']), (2, 1))
+
+        self.backend.fail_silently = True
+        self.stubber.add_client_error('send_raw_email', 'MessageRejected', 'Email address is not verified.')
+        self.assertEqual(self.backend.send_messages(self.messages[:1]), 0)
+
+    @override_settings(AWS_SES_SEND_THREADS=1)
+    def test_send_each(self):
+        self.stubber.add_response('send_raw_email', {'MessageId': '0'})
+        self.stubber.add_client_error('send_raw_email', 'MessageRejected', 'Email address is not verified.')
+        self.stubber.add_response('send_raw_email', {'MessageId': '2'})
+
+        # the outbox learns which messages of the batch went out, nothing is raised
+        errors = outbox.send_each(self.backend, self.messages[:3])
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], ClientError)
+        self.assertIsNone(errors[2])
+
+    def test_rate(self):
+        bucket = boto.TokenBucket(50, capacity=1)
+        started = time.monotonic()
+        for i in range(11):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.19)
+
@@ -1,8 +1,11 @@
-from django.contrib.sites.models import Site
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+from collections import Counter
 
-from av_core import settings, logger
+from django.conf import settings
+from django.db import transaction
+
+from av_emails.models import OutboxEmail
+from av_emails.outbox import deliver
+from av_emails.rendering import render_bulk
 
 
 def send_new_message_email(message):
@@ -51,6 +54,14 @@ def send_invitation_email(user):
     )
 
 
+def send_invitation_emails(users):
+    send_bulk(
+        subject='Welcome to Account Vision',
+        template='av_emails/invitation.html',
+        recipients=[(user.email, {'user': user}) for user in users],
+    )
+
+
 def send_team_invitation_email(user):
     send_email(
         subject='Welcome to Account Vision',
@@ -144,27 +155,27 @@ def send_trial_final_email(user, plan, amount):
 # ------------------------------------------------------------------------------------------
 
 
-def get_url():
-    default_protocol = getattr(settings, 'DEFAULT_HTTP_PROTOCOL', 'http')
-    current_domain = Site.objects.get_current().domain
-    return '%s://%s' % (default_protocol, current_domain)
-
-
 def send_email(subject="Account Vision", recipient=None, context=None, template='av_emails/base.html'):
-
-    if context is None:
-        context = {}
-
-    context['site_url'] = get_url()
-    context['recipient'] = recipient
-    message = render_to_string(template_name=template, context=context)
-
-    try:
-        if not settings.MAIL_OFF:
-            send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [recipient, ], html_message=message)
-        if not settings.TESTING:
-            logger.info('sent from:{} to:{} subject:{}'.format(settings.DEFAULT_FROM_EMAIL, recipient, subject))
-    except Exception as e:
-        logger.warn('Email send failure')
-        logger.warn(e)
-        logger.info(message)
+    send_bulk(subject, template, [(recipient, context or {})])
+
+
+def send_bulk(subject, template, recipients):
+    """
+    Renders the template for each recipient into the outbox, in the current transaction so they are only sent if
+    that commits
+    The send_emails worker sends them, unless settings.EMAIL_OUTBOX_SYNC has them sent right away
+    :param recipients: iterable of (email address, context dict), each context on top of the shared site_url
+    """
+    emails = [OutboxEmail(subject=subject, from_email=settings.DEFAULT_FROM_EMAIL, recipient=recipient, body=body)
+              for recipient, body in render_bulk(template, recipients)]
+    if settings.MAIL_OFF or not emails:
+        return
+
+    if settings.EMAIL_OUTBOX_SYNC:
+        # saved one at a time, bulk_create leaves ids unset outside of postgres
+        for email in emails:
+            email.save()
+        # like the worker, only once the caller's transaction committed
+        transaction.on_commit(lambda: deliver(emails, Counter()))
+    else:
+        OutboxEmail.objects.bulk_create(emails)
@@ -9,7 +9,7 @@ from django.views.generic import TemplateView, FormView
 from django.utils import timezone
 
 from av_account.models import Communications, Firm, AvUser, Address
-from av_account.utils import VerifiedAndTrustedRequiredMixin
+from av_account.utils import VerifiedAndTrustedRequiredMixin, sync_subscription
 from av_core import settings, logger
 from av_payment.forms import TermsForm
 from av_returns.models import Return, Expense, Spouse, Dependent
@@ -98,6 +98,7 @@ class CheckoutView(VerifiedAndTrustedRequiredMixin, TemplateView):
             firm.is_paid = True
             firm.trial_end = datetime.datetime.fromtimestamp(subscription.trial_end, datetime.timezone.utc)
             firm.save()
+            sync_subscription(firm, subscription)
             self.create_example_client(self.request.user)
             return redirect(reverse('ready'))
         else:
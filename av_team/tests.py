@@ -226,3 +226,17 @@ class TeamTestCase(TestCase):
         
         found = AvUser.objects.filter(email=data['email']).count()
         self.assertEqual(found, 0)
+
+    def test_list_queries(self):
+        self.login_cpa()
+        # session, user, agent trust settings twice, firm with groups, unread messages,
+        # then the listed members with their firm and groups
+        with self.assertNumQueries(9):
+            response = self.client.get(reverse('team'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        snapshot = response.wsgi_request.auth_snapshot
+        self.assertTrue(snapshot.is_admin)
+        self.assertTrue(snapshot.is_full_cred)
+        self.assertEqual(snapshot.groups, {'admin'})
+        self.assertEqual(snapshot.firm.id, self.firm.id)
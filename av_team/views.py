@@ -92,10 +92,8 @@ class TeamInviteView(CPAAdminRequiredMixin, FormView, StripeMixin):
     def get_context_data(self, **kwargs):
         context = super(TeamInviteView, self).get_context_data(**kwargs)
         
-        plan = self.get_subscription().plan
-
         context['cpa_count'] = self.request.user.cpa_count()
-        context['max_cpa'] = int(plan.metadata.max_cpa)
+        context['max_cpa'] = self.get_local_subscription().max_cpa
         
         return context
 
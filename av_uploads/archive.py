@@ -0,0 +1,126 @@
+import queue
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.utils import timezone
+
+from av_core import logger
+from av_uploads.storage import get_file_storage
+
+# bytes read from s3 at a time
+CHUNK_SIZE = 1024 * 1024
+
+# files downloaded ahead of the one being zipped, and chunks buffered for each
+# so at most PREFETCH_FILES * (PREFETCH_CHUNKS + 1) * CHUNK_SIZE bytes are held however large the zip gets
+PREFETCH_FILES = 4
+PREFETCH_CHUNKS = 4
+
+_DONE = object()
+
+
+class ZipBuffer(object):
+    """
+    Write only file for ZipFile, handing out what was written so far instead of keeping it
+    Having no seek() makes ZipFile write sizes after each entry, so nothing needs to be rewritten
+    """
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def put(chunks, item, cancelled):
+    # blocks while the writer is behind, unless the download was abandoned
+    while not cancelled.is_set():
+        try:
+            chunks.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def fetch(file, chunks, cancelled):
+    """
+    Runs in a worker thread, reading an s3 object into a bounded queue of chunks
+    """
+    try:
+        for chunk in get_file_storage(file).stream(file.s3_key):
+            if not put(chunks, chunk, cancelled):
+                return
+        put(chunks, _DONE, cancelled)
+    except Exception as e:
+        put(chunks, e, cancelled)
+
+
+def unique_names(files):
+    seen = set()
+    for file in files:
+        name = file.name.replace('/', '_') or str(file.id)
+        base, dot, ext = name.rpartition('.')
+        count = 1
+        while name in seen:
+            count += 1
+            name = '{} ({}).{}'.format(base, count, ext) if dot else '{} ({})'.format(ext, count)
+        seen.add(name)
+        yield name
+
+
+def stream_zip(files):
+    """
+    Yields a zip of the given S3Files as it is written, while the next few files download concurrently
+    """
+    files = list(files)
+    buffer = ZipBuffer()
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=PREFETCH_FILES)
+
+    def start(file):
+        chunks = queue.Queue(maxsize=PREFETCH_CHUNKS)
+        executor.submit(fetch, file, chunks, cancelled)
+        return chunks
+
+    try:
+        pending = deque(start(file) for file in files[:PREFETCH_FILES])
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for index, (file, name) in enumerate(zip(files, unique_names(files))):
+                chunks = pending.popleft()
+                if index + PREFETCH_FILES < len(files):
+                    pending.append(start(files[index + PREFETCH_FILES]))
+
+                info = zipfile.ZipInfo(name, timezone.localtime(file.date_created).timetuple()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                # a known size lets ZipFile decide on zip64 up front
+                info.file_size = file.size
+                with archive.open(info, 'w') as entry:
+                    while True:
+                        chunk = chunks.get()
+                        if chunk is _DONE:
+                            break
+                        if isinstance(chunk, Exception):
+                            logger.error('Zip download of file {} failed: {}'.format(file.id, chunk))
+                            raise chunk
+                        entry.write(chunk)
+                        yield buffer.pop()
+                yield buffer.pop()
+        yield buffer.pop()
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False)
@@ -0,0 +1,89 @@
+import time
+from collections import Counter, defaultdict
+
+from botocore.exceptions import BotoCoreError, ClientError
+from django.db import transaction
+from django.db.models import F
+
+from av_core import logger
+from av_uploads.models import S3Deletion
+from av_uploads.storage import get_storage
+
+# DeleteObjects accepts at most this many keys per call
+BATCH_SIZE = 1000
+
+# a failing batch is retried right away this many times, backing off in between
+RETRIES = 3
+RETRY_DELAY = 0.5
+
+# objects that failed this many drains are left in the outbox for a human to look at
+MAX_ATTEMPTS = 5
+
+
+def delete_objects(storage, keys, stats):
+    """
+    Deletes up to BATCH_SIZE keys from a bucket with a single DeleteObjects call, retrying on errors
+    :return: {key: error message} of keys that could not be deleted
+    """
+    for attempt in range(RETRIES + 1):
+        try:
+            return storage.delete(keys)
+        except (BotoCoreError, ClientError, OSError) as e:
+            if attempt == RETRIES:
+                logger.error('S3 DeleteObjects on {} failed for {} keys: {}'.format(storage.bucket, len(keys), e))
+                return {key: str(e) for key in keys}
+            stats['retries'] += 1
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+def drain_batch(stats, after=0, batch_size=BATCH_SIZE):
+    """
+    Deletes the next batch of outbox objects from s3, locking the rows so concurrent drains take other batches
+    :param after: only outbox rows with a higher id are taken
+    :return: highest outbox id handled, None once there is nothing left
+    """
+    with transaction.atomic():
+        deletions = list(S3Deletion.objects
+                         .select_for_update(skip_locked=True)
+                         .filter(id__gt=after, attempts__lt=MAX_ATTEMPTS)
+                         .order_by('id')[:batch_size])
+        if not deletions:
+            return None
+
+        # one call per bucket, or per destination where they keep their objects in different storages
+        by_storage = defaultdict(list)
+        for deletion in deletions:
+            by_storage[get_storage(deletion.s3_bucket, deletion.s3_key)].append(deletion)
+
+        done = []
+        for storage, storage_deletions in by_storage.items():
+            errors = delete_objects(storage, sorted({deletion.s3_key for deletion in storage_deletions}), stats)
+            for deletion in storage_deletions:
+                error = errors.get(deletion.s3_key)
+                if error is None:
+                    done.append(deletion.id)
+                else:
+                    S3Deletion.objects.filter(id=deletion.id).update(attempts=F('attempts') + 1, last_error=error)
+                    stats['failed'] += 1
+
+        S3Deletion.objects.filter(id__in=done).delete()
+        stats['deleted'] += len(done)
+        stats['batches'] += 1
+        return deletions[-1].id
+
+
+def drain(batch_size=BATCH_SIZE):
+    """
+    Walks the outbox once in id order, objects failing in this run are tried again by the next one
+    :return: Counter of batches, deleted, failed, retries and stuck objects
+    """
+    started = time.time()
+    stats = Counter()
+    after = 0
+    while after is not None:
+        after = drain_batch(stats, after, batch_size)
+
+    stats['stuck'] = S3Deletion.objects.filter(attempts__gte=MAX_ATTEMPTS).count()
+    stats['seconds'] = round(time.time() - started, 1)
+    logger.info('S3 deletions drained: {}'.format(dict(stats)))
+    return stats
@@ -0,0 +1,150 @@
+import calendar
+import re
+import threading
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotFound, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+# seconds a browser turned away by a busy worker is asked to wait
+RETRY_AFTER = 5
+
+_slots = None
+_slots_lock = threading.Lock()
+
+
+def get_slots():
+    """
+    Proxied downloads this worker process may stream at once, so a few large downloads can't tie up all its threads
+    """
+    global _slots
+    with _slots_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(settings.UPLOAD_PROXY_CONCURRENCY)
+        return _slots
+
+
+class SlotStream(object):
+    """
+    Iterates chunks while holding a download slot, given back once the response is closed however it ended
+    Django closes the streaming content with the response, even when the client went away halfway
+    """
+    def __init__(self, chunks, slots):
+        self.chunks = chunks
+        self.slots = slots
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        if self.slots is not None:
+            self.slots.release()
+            self.slots = None
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class SlotFile(SlotStream):
+    """
+    An open file holding a download slot, left as a file so the server can still send it with sendfile
+    The server closes it in place of the response in that case
+    """
+    def __getattr__(self, name):
+        return getattr(self.chunks, name)
+
+
+class DummySlots(object):
+
+    def release(self):
+        pass
+
+
+def parse_range(header, size):
+    """
+    :return: (start, end) of a single bytes range, end included, None to send the whole object
+    :raise ValueError: if the range is out of bounds
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    # several ranges are allowed to get the whole object instead
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise ValueError('Range not satisfiable')
+    return start, end
+
+
+def range_applies(request, etag, last_modified):
+    # If-Range asks for the range only while the object is unchanged, and for all of it otherwise
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def object_response(request, storage, key, content_type, disposition, slots=None):
+    """
+    Streams an object through the app, answering conditional and single range requests the way s3 would
+    :param slots: semaphore limiting concurrent downloads, 503 once all are taken
+    """
+    head = storage.head(key)
+    if head is None:
+        return HttpResponseNotFound()
+
+    size = head['size']
+    etag = '"{}"'.format(head['etag'])
+    last_modified = calendar.timegm(head['last_modified'].utctimetuple())
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        response['ETag'] = etag
+        return response
+
+    try:
+        byte_range = None
+        if range_applies(request, etag, last_modified):
+            byte_range = parse_range(request.META.get('HTTP_RANGE', ''), size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+
+    if slots is not None and not slots.acquire(blocking=False):
+        response = HttpResponse('Too many downloads, try again shortly.', status=503)
+        response['Retry-After'] = RETRY_AFTER
+        return response
+
+    held = slots if slots is not None else DummySlots()
+    try:
+        if byte_range is None:
+            # a real file lets the server hand it to sendfile, anything else is forwarded chunk by chunk as read
+            file = storage.open_file(key)
+            if file is not None:
+                response = FileResponse(SlotFile(file, held))
+            else:
+                response = StreamingHttpResponse(SlotStream(storage.stream(key), held))
+            response['Content-Length'] = size
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(SlotStream(storage.stream(key, start, end), held), status=206)
+            response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+            response['Content-Length'] = end - start + 1
+    except BaseException:
+        held.release()
+        raise
+
+    response['Content-Type'] = content_type or 'application/octet-stream'
+    response['Content-Disposition'] = disposition
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
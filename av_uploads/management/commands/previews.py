@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from av_uploads.previews import BATCH_SIZE, backfill, drain
+
+
+class Command(BaseCommand):
+    help = 'Renders previews of uploaded pdfs and images that are still missing one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Files read from the database at a time')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep rendering the previews of new uploads every so many seconds instead of '
+                                 'checking every file once, for a worker dyno')
+
+    def handle(self, *args, **options):
+        if not options['interval']:
+            stats = backfill(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(
+                'Checked {files} files in {seconds}s, generated {generated} previews, {failed} could not render, '
+                '{errors} errors.'.format_map(stats)))
+            return
+
+        while True:
+            stats = drain(options['batch_size'])
+            if stats['batches']:
+                self.stdout.write(self.style.SUCCESS(
+                    'Rendered {generated} of {files} new uploads in {seconds}s, {failed} could not render, '
+                    '{errors} errors.'.format_map(stats)))
+            time.sleep(options['interval'])
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from av_uploads.reconcile import STALE_AFTER, reconcile
+
+
+class Command(BaseCommand):
+    help = 'Reconciles uploaded file rows with the objects listed in s3'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-hours', type=int, default=int(STALE_AFTER.total_seconds() // 3600),
+                            help='Prune pending uploads and report orphan objects older than this')
+        parser.add_argument('--delete-orphans', action='store_true', help='Queue orphan objects for deletion')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would change')
+
+    def handle(self, *args, **options):
+        stats, orphans = reconcile(timedelta(hours=options['stale_hours']), options['delete_orphans'],
+                                   options['dry_run'])
+
+        for bucket, key in orphans:
+            self.stdout.write('Orphan object {}/{}'.format(bucket, key))
+        self.stdout.write(self.style.SUCCESS(
+            'Listed {objects} objects in {seconds}s, confirmed {confirmed} uploads, backfilled {backfilled}, '
+            'pruned {pruned} pending rows, found {orphans} orphans.'.format_map(stats)))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from av_uploads.deletions import BATCH_SIZE, drain
+
+
+class Command(BaseCommand):
+    help = 'Deletes s3 objects of deleted files from the outbox, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Keys per DeleteObjects call, at most 1000')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep draining every so many seconds instead of exiting, for a worker dyno')
+
+    def handle(self, *args, **options):
+        batch_size = min(options['batch_size'], BATCH_SIZE)
+        while True:
+            stats = drain(batch_size)
+            self.stdout.write(self.style.SUCCESS(
+                'Deleted {deleted} objects in {batches} batches and {seconds}s, '
+                '{failed} failed, {retries} retries, {stuck} stuck.'.format_map(stats)))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
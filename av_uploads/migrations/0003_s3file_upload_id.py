@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 11:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_uploads', '0002_s3_deletion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='s3file',
+            name='upload_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 11:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_uploads', '0004_s3file_etag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='s3file',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='s3file',
+            index=models.Index(fields=['tax_return', 'sha256'], name='av_uploads__tax_ret_a21f50_idx'),
+        ),
+    ]
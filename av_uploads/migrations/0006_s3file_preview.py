@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 11:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_uploads', '0005_s3file_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='s3file',
+            name='preview_failed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='s3file',
+            name='preview_key',
+            field=models.TextField(blank=True),
+        ),
+    ]
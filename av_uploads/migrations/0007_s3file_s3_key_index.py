@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 11:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('av_uploads', '0006_s3file_preview'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='s3file',
+            index=models.Index(fields=['s3_key'], name='av_uploads__s3_key_5630c9_idx'),
+        ),
+    ]
@@ -1,8 +1,10 @@
 from django.conf import settings
 from django.db import models
 from django.urls import reverse_lazy
+from django.utils import timezone
 
 from av_returns.models import Return
+from av_uploads.utils import get_preview_url
 from av_utils.utils import TimeStampedModel
 
 
@@ -18,10 +20,29 @@ class S3File(TimeStampedModel):
     s3_region = models.TextField()
     description = models.TextField(blank=True)
     uploaded = models.BooleanField(default=False)
+    # s3 multipart upload in progress, blank otherwise
+    upload_id = models.CharField(max_length=255, blank=True)
+    # as listed by s3, filled in by the reconcile_uploads command
+    etag = models.CharField(max_length=64, blank=True)
+    # hex sha-256 of the content as computed by the browser, used to skip uploading the same file twice
+    sha256 = models.CharField(max_length=64, blank=True)
+    # small jpeg rendered next to the original, see av_uploads.previews
+    preview_key = models.TextField(blank=True)
+    preview_failed = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['tax_return', 'sha256']),
+            # several files may share an object, see UploadParamsView
+            models.Index(fields=['s3_key']),
+        ]
     
     def get_absolute_url(self):
         return reverse_lazy('upload-url', args=[self.id])
 
+    def get_preview_url(self):
+        return get_preview_url(self)
+
     def __str__(self):
         return self.name
 
@@ -30,3 +51,30 @@ class S3File(TimeStampedModel):
 
     def get_stream_url(self):
         return self.get_absolute_url()
+
+
+class S3Deletion(models.Model):
+    """
+    Outbox of s3 objects left behind by deleted S3Files, written in the deleting transaction
+    Drained in batches by the s3_deletions management command
+    """
+    s3_bucket = models.TextField()
+    s3_key = models.TextField()
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    date_created = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return '{}/{}'.format(self.s3_bucket, self.s3_key)
+
+
+class PreviewRequest(models.Model):
+    """
+    Queue of uploaded files waiting for a preview, written as their upload completes
+    Drained by the previews command in the worker, see av_uploads.previews
+    """
+    file = models.ForeignKey(S3File, on_delete=models.CASCADE)
+    date_created = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return str(self.file_id)
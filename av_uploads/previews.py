@@ -0,0 +1,190 @@
+import multiprocessing
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+from django.db import connection, transaction
+
+from av_core import logger
+from av_uploads.models import PreviewRequest, S3File
+from av_uploads.storage import get_file_storage
+from av_uploads.thumbnails import IMAGE_TYPES, PDF_TYPES, PREVIEW_TIMEOUT, render
+
+# previews are written next to the original, as <key>.preview.jpg
+PREVIEW_SUFFIX = '.preview.jpg'
+
+# larger files are not downloaded for a preview
+PREVIEW_MAX_SIZE = 50 * 1024 * 1024
+
+# rendering is cpu bound so it runs in a few processes, downloads and uploads in threads feeding them
+PREVIEW_PROCESSES = 2
+PREVIEW_THREADS = 4
+
+# preview requests taken off the queue at a time
+BATCH_SIZE = 100
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def previewable(file):
+    return file.type in IMAGE_TYPES | PDF_TYPES and 0 < file.size <= PREVIEW_MAX_SIZE
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # started afresh rather than forked, the threads and database connections of this process stay here
+            _pool = ProcessPoolExecutor(max_workers=PREVIEW_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def reset_pool(pool):
+    # a crashed render breaks the whole pool, the next file gets a fresh one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def generate(file, stats):
+    """
+    Downloads the file to a temporary file, renders its preview in the process pool and uploads it next to the original
+    Files that can't be rendered are marked, so they are not tried again
+    """
+    storage = get_file_storage(file)
+    with tempfile.NamedTemporaryFile() as original:
+        try:
+            for chunk in storage.stream(file.s3_key):
+                original.write(chunk)
+            original.flush()
+        except (BotoCoreError, ClientError, OSError) as e:
+            logger.warn('Preview of file {} could not download: {}'.format(file.id, e))
+            stats['errors'] += 1
+            return
+
+        pool = get_pool()
+        try:
+            preview = pool.submit(render, file.type, original.name).result(timeout=PREVIEW_TIMEOUT * 2)
+        except BrokenProcessPool as e:
+            reset_pool(pool)
+            logger.error('Preview of file {} crashed the pool: {}'.format(file.id, e))
+            preview = None
+        except Exception as e:
+            logger.warn('Preview of file {} could not render: {}'.format(file.id, e))
+            preview = None
+
+    if preview is None:
+        S3File.objects.filter(id=file.id).update(preview_failed=True)
+        stats['failed'] += 1
+        return
+
+    key = file.s3_key + PREVIEW_SUFFIX
+    try:
+        storage.put(key, preview, 'image/jpeg')
+    except (BotoCoreError, ClientError, OSError) as e:
+        logger.warn('Preview of file {} could not upload: {}'.format(file.id, e))
+        stats['errors'] += 1
+        return
+
+    S3File.objects.filter(id=file.id).update(preview_key=key)
+    file.preview_key = key
+    stats['generated'] += 1
+
+
+def generate_many(file_ids):
+    """
+    Runs in a worker thread, an error with one file leaves the others to go on
+    :return: Counter of generated, failed and errors
+    """
+    stats = Counter()
+    try:
+        files = S3File.objects.filter(id__in=file_ids, uploaded=True, preview_key='', preview_failed=False)
+        for file in files:
+            if not previewable(file):
+                continue
+            try:
+                generate(file, stats)
+            except Exception as e:
+                logger.error('Preview of file {} failed: {}'.format(file.id, e))
+                stats['errors'] += 1
+    except Exception as e:
+        logger.error('Previews of files {} failed: {}'.format(file_ids, e))
+        stats['errors'] += 1
+    finally:
+        # worker threads get their own database connection
+        connection.close()
+    return stats
+
+
+def generate_all(executor, file_ids, stats):
+    chunks = [file_ids[index::PREVIEW_THREADS] for index in range(PREVIEW_THREADS)]
+    for chunk_stats in executor.map(generate_many, [chunk for chunk in chunks if chunk]):
+        stats.update(chunk_stats)
+
+
+def schedule(files):
+    """
+    Queues preview generation for just uploaded files, in the caller's transaction
+    The previews command renders them in the worker, web processes neither download nor render anything
+    """
+    if not settings.UPLOAD_PREVIEWS:
+        return
+    PreviewRequest.objects.bulk_create([PreviewRequest(file=file) for file in files if previewable(file)])
+
+
+def drain(batch_size=BATCH_SIZE):
+    """
+    Renders the queued previews a batch at a time across the worker threads
+    Requests are taken off the queue before rendering, any lost with the worker are left to backfill()
+    :return: Counter of batches, files, generated, failed and errors
+    """
+    started = time.time()
+    stats = Counter()
+    with ThreadPoolExecutor(max_workers=PREVIEW_THREADS) as executor:
+        while True:
+            with transaction.atomic():
+                requests = list(PreviewRequest.objects.select_for_update(skip_locked=True).order_by('id')[:batch_size])
+                PreviewRequest.objects.filter(id__in=[request.id for request in requests]).delete()
+            if not requests:
+                break
+            file_ids = sorted({request.file_id for request in requests})
+            stats['batches'] += 1
+            stats['files'] += len(file_ids)
+            generate_all(executor, file_ids, stats)
+
+    stats['seconds'] = round(time.time() - started, 1)
+    return stats
+
+
+def backfill(batch_size=BATCH_SIZE):
+    """
+    Generates previews for uploaded files still missing one, a batch of files at a time across the worker threads
+    :return: Counter of files, generated, failed and errors
+    """
+    started = time.time()
+    stats = Counter()
+    pending = (S3File.objects
+               .filter(uploaded=True, preview_key='', preview_failed=False, type__in=IMAGE_TYPES | PDF_TYPES,
+                       size__gt=0, size__lte=PREVIEW_MAX_SIZE)
+               .order_by('id'))
+    after = 0
+    with ThreadPoolExecutor(max_workers=PREVIEW_THREADS) as executor:
+        while True:
+            file_ids = list(pending.filter(id__gt=after).values_list('id', flat=True)[:batch_size])
+            if not file_ids:
+                break
+            after = file_ids[-1]
+            stats['files'] += len(file_ids)
+            generate_all(executor, file_ids, stats)
+
+    stats['seconds'] = round(time.time() - started, 1)
+    logger.info('Upload previews backfilled: {}'.format(dict(stats)))
+    return stats
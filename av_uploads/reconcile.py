@@ -0,0 +1,148 @@
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from av_core import logger
+from av_core.aws import get_client
+from av_uploads.models import S3File, S3Deletion
+from av_uploads.previews import PREVIEW_SUFFIX
+from av_uploads.storage import get_storage
+from av_uploads.utils import get_s3direct_destinations
+from av_utils.utils import bulk_update
+
+# pending rows are given this long to be uploaded before they are pruned, orphan objects before they are reported
+STALE_AFTER = timedelta(hours=24)
+
+PAGE_SIZE = 1000
+
+# how many orphan keys are listed in the report
+ORPHAN_SAMPLES = 20
+
+
+def destination_prefixes():
+    """
+    :return: set of (bucket, key prefix) that uploads are written to
+    """
+    prefixes = set()
+    for destination in get_s3direct_destinations().values():
+        # destinations whose objects are not S3Files opt out
+        if destination.get('key') and destination.get('reconcile', True):
+            prefixes.add((destination.get('bucket') or settings.AWS_BUCKET_NAME, destination['key'].rstrip('/') + '/'))
+    return prefixes
+
+
+def list_objects(bucket, prefix):
+    """
+    Yields pages of up to PAGE_SIZE objects under the prefix, in key order
+    """
+    return get_storage(bucket, prefix).list(prefix, PAGE_SIZE)
+
+
+def reconcile_page(bucket, objects, cutoff, stats, orphans, dry_run=False):
+    """
+    Matches one listing page against S3File with a single query
+    Pending rows whose object exists are confirmed, and sizes and etags are taken from the listing
+    """
+    objects = {obj['Key']: obj for obj in objects}
+    # previews belong to the file they are named after
+    previews = {key: key[:-len(PREVIEW_SUFFIX)] for key in objects if key.endswith(PREVIEW_SUFFIX)}
+    # files uploaded twice to a return share an object
+    files = defaultdict(list)
+    for file in S3File.objects.filter(s3_bucket=bucket, s3_key__in=set(objects.keys()) | set(previews.values())):
+        files[file.s3_key].append(file)
+
+    confirmed = []
+    changed = []
+    for key, obj in objects.items():
+        if key in previews:
+            if previews[key] not in files and obj['LastModified'] < cutoff:
+                orphans.append((bucket, key))
+            continue
+
+        if key not in files:
+            if obj['LastModified'] < cutoff:
+                orphans.append((bucket, key))
+            continue
+
+        etag = obj['ETag'].strip('"')
+        for file in files[key]:
+            if not file.uploaded:
+                # the browser never reported back, but the object made it
+                file.uploaded = True
+                file.upload_id = ''
+                file.size, file.etag = obj['Size'], etag
+                confirmed.append(file)
+            elif (file.size, file.etag) != (obj['Size'], etag):
+                file.size, file.etag = obj['Size'], etag
+                changed.append(file)
+
+    stats['objects'] += len(objects) - len(previews)
+    stats['confirmed'] += len(confirmed)
+    stats['backfilled'] += len(changed)
+    if dry_run:
+        return
+
+    with transaction.atomic():
+        for file in confirmed:
+            # saved one by one so the upload shows in activity streams
+            file.save()
+        bulk_update(S3File, changed, ['size', 'etag'])
+
+
+def prune_pending(cutoff, stats, dry_run=False):
+    """
+    Deletes rows still pending after cutoff, paging through them in key order
+    Runs after the listing pass, so any of them with an object in s3 has been confirmed already
+    """
+    pending = S3File.objects.filter(uploaded=False, date_created__lt=cutoff).order_by('s3_key', 'id')
+    last = None
+    while True:
+        page = pending if last is None else pending.filter(s3_key__gt=last)
+        page = list(page[:PAGE_SIZE])
+        if not page:
+            return
+        last = page[-1].s3_key
+
+        stats['pruned'] += len(page)
+        if dry_run:
+            continue
+
+        for file in page:
+            if file.upload_id:
+                try:
+                    get_client('s3').abort_multipart_upload(
+                        Bucket=file.s3_bucket, Key=file.s3_key, UploadId=file.upload_id)
+                except ClientError as e:
+                    logger.warn('S3 multipart upload of {} could not abort: {}'.format(file.s3_key, e))
+        S3File.objects.filter(id__in=[file.id for file in page]).delete()
+
+
+def reconcile(stale_after=STALE_AFTER, delete_orphans=False, dry_run=False):
+    """
+    Reconciles S3File rows with the objects in s3
+    :return: Counter of objects, confirmed, backfilled, pruned and orphans, plus a sample of orphan keys
+    """
+    started = time.time()
+    cutoff = timezone.now() - stale_after
+    stats = Counter()
+    orphans = []
+
+    for bucket, prefix in sorted(destination_prefixes()):
+        for objects in list_objects(bucket, prefix):
+            reconcile_page(bucket, objects, cutoff, stats, orphans, dry_run)
+
+    prune_pending(cutoff, stats, dry_run)
+
+    stats['orphans'] = len(orphans)
+    if orphans and delete_orphans and not dry_run:
+        S3Deletion.objects.bulk_create([S3Deletion(s3_bucket=bucket, s3_key=key) for bucket, key in orphans])
+        stats['orphans_queued'] = len(orphans)
+
+    stats['seconds'] = round(time.time() - started, 1)
+    logger.info('Uploads reconciled: {}'.format(dict(stats)))
+    return stats, orphans[:ORPHAN_SAMPLES]
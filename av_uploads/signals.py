@@ -3,8 +3,8 @@ from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
 from av_core import logger
-from av_uploads.models import S3File
-from av_uploads.utils import delete_s3_object
+from av_uploads.models import S3File, S3Deletion
+from av_uploads.utils import forget_s3_urls
 
 
 @receiver(post_save, sender=S3File)
@@ -16,6 +16,13 @@ def s3file_post_save(sender, instance, created, *args, **kwargs):
 
 @receiver(post_delete, sender=S3File)
 def s3file_post_delete(sender, instance, *args, **kwargs):
-    delete_s3_object(instance)
+    # the object itself is removed later by the s3_deletions command, and only if this transaction commits
+    forget_s3_urls(instance)
+    # files uploaded twice to a return share the object, it goes with the last of them
+    shared = S3File.objects.filter(s3_bucket=instance.s3_bucket, s3_key=instance.s3_key).exists()
+    if instance.s3_bucket and instance.s3_key and not shared:
+        S3Deletion.objects.create(s3_bucket=instance.s3_bucket, s3_key=instance.s3_key)
+        if instance.preview_key:
+            S3Deletion.objects.create(s3_bucket=instance.s3_bucket, s3_key=instance.preview_key)
     action.send(instance.user, verb='deleted a file', target=instance)
     logger.info('action: {}, {}, {}'.format(instance.user, 'deleted', instance))
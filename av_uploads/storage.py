@@ -0,0 +1,337 @@
+import mmap
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core import signing
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from av_core.aws import get_client
+from av_uploads.utils import get_s3direct_destinations
+
+# bytes read at a time when streaming an object
+CHUNK_SIZE = 1024 * 1024
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+class Storage(object):
+    """
+    Where the objects behind S3Files live, one instance per bucket
+    Destinations in settings.AWS_DESTINATIONS pick theirs with 'storage', 's3' unless given
+    """
+    def __init__(self, bucket, region=None, **options):
+        self.bucket = bucket
+        self.region = region
+        self.options = options
+
+    def presign_get(self, key, content_disposition, expires, content_type=None):
+        """
+        :return: url the browser can download the object from until expires seconds from now
+        """
+        raise NotImplementedError
+
+    def presign_post(self, key, fields, conditions, expires):
+        """
+        :return: {'url', 'fields'} for a browser form POST of the object, as with an s3 POST policy
+        """
+        raise NotImplementedError
+
+    def head(self, key):
+        """
+        :return: {'size', 'etag', 'last_modified'} of the object, None if it does not exist
+        """
+        raise NotImplementedError
+
+    def list(self, prefix, page_size=1000):
+        """
+        Yields pages of up to page_size objects under the prefix, in key order, each object a dict shaped like
+        a list_objects_v2 entry, with Key, Size, ETag and LastModified
+        """
+        raise NotImplementedError
+
+    def delete(self, keys):
+        """
+        Deletes up to 1000 objects at once, raising on failure of the whole call
+        :return: {key: error message} of keys that could not be deleted
+        """
+        raise NotImplementedError
+
+    def stream(self, key, start=0, end=None):
+        """
+        Yields the object's bytes from start up to and including end, in chunks of up to CHUNK_SIZE
+        """
+        raise NotImplementedError
+
+    def put(self, key, data, content_type, **extra):
+        raise NotImplementedError
+
+    def put_file(self, key, file, content_type):
+        """
+        Writes an open file as the object, a chunk at a time however large it is
+        """
+        self.put(key, iter(lambda: file.read(CHUNK_SIZE), b''), content_type)
+
+    def open_file(self, key):
+        """
+        :return: the object as an open file, for storages keeping real files, None otherwise
+        """
+        return None
+
+
+class S3Storage(Storage):
+
+    @property
+    def client(self):
+        return get_client('s3', self.region)
+
+    def presign_get(self, key, content_disposition, expires, content_type=None):
+        return self.client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={
+                'Bucket': self.bucket,
+                'Key': key,
+                'ResponseContentDisposition': content_disposition,
+            },
+            ExpiresIn=expires,
+        )
+
+    def presign_post(self, key, fields, conditions, expires):
+        post = self.client.generate_presigned_post(
+            Bucket=self.bucket, Key=key, Fields=fields, Conditions=conditions, ExpiresIn=expires)
+        return {'url': post['url'], 'fields': post['fields']}
+
+    def head(self, key):
+        try:
+            obj = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return {'size': obj['ContentLength'], 'etag': obj['ETag'].strip('"'), 'last_modified': obj['LastModified']}
+
+    def list(self, prefix, page_size=1000):
+        params = {'Bucket': self.bucket, 'Prefix': prefix, 'MaxKeys': page_size}
+        while True:
+            response = self.client.list_objects_v2(**params)
+            yield response.get('Contents', [])
+            if not response.get('IsTruncated'):
+                return
+            params['ContinuationToken'] = response['NextContinuationToken']
+
+    def delete(self, keys):
+        response = self.client.delete_objects(
+            Bucket=self.bucket,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+        )
+        return {error['Key']: '{} {}'.format(error.get('Code'), error.get('Message')).strip()
+                for error in response.get('Errors', [])}
+
+    def stream(self, key, start=0, end=None):
+        params = {'Bucket': self.bucket, 'Key': key}
+        if start or end is not None:
+            params['Range'] = 'bytes={}-{}'.format(start, '' if end is None else end)
+        body = self.client.get_object(**params)['Body']
+        return iter(lambda: body.read(CHUNK_SIZE), b'')
+
+    def put(self, key, data, content_type, **extra):
+        # encrypted like the destination's uploads
+        if self.options.get('server_side_encryption'):
+            extra.setdefault('ServerSideEncryption', self.options['server_side_encryption'])
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=content_type, **extra)
+
+    def put_file(self, key, file, content_type):
+        # multipart once the file is large enough, with a few parts uploading at once
+        extra = {'ContentType': content_type}
+        if self.options.get('server_side_encryption'):
+            extra['ServerSideEncryption'] = self.options['server_side_encryption']
+        self.client.upload_fileobj(file, self.bucket, key, ExtraArgs=extra)
+
+
+class LocalStorage(Storage):
+    """
+    Objects kept as files under <location>/<bucket>/<key>, for running and benchmarking uploads without s3
+    Presigned urls point at LocalStorageView, carrying what s3 would have signed in a signed token
+    Uploads go through presigned POSTs only, multipart uploads and the evaporate uploader need s3
+    """
+    salt = 'av_uploads.storage.LocalStorage'
+
+    def __init__(self, bucket, region=None, location=None, **options):
+        super(LocalStorage, self).__init__(bucket, region, **options)
+        self.location = location or settings.LOCAL_STORAGE_ROOT
+        self.root = os.path.abspath(os.path.join(self.location, bucket))
+
+    def path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError('Key {} is outside of the bucket'.format(key))
+        return path
+
+    def sign(self, **params):
+        params['bucket'] = self.bucket
+        return signing.dumps(params, salt=self.salt, compress=True)
+
+    @classmethod
+    def unsign(cls, token):
+        """
+        :return: the signed params, with storage set to the bucket's LocalStorage
+        :raise signing.BadSignature: if the token was tampered with or expired
+        """
+        params = signing.loads(token, salt=cls.salt)
+        if params.get('expires', 0) < time.time():
+            raise signing.SignatureExpired('Token expired')
+        storage = get_storage(params['bucket'], params['key'])
+        if not isinstance(storage, cls):
+            raise signing.BadSignature('Bucket is not stored locally')
+        params['storage'] = storage
+        return params
+
+    def presign_get(self, key, content_disposition, expires, content_type=None):
+        token = self.sign(key=key, disposition=content_disposition, type=content_type, expires=time.time() + expires)
+        return reverse('upload-local', args=[token])
+
+    def presign_post(self, key, fields, conditions, expires):
+        length_range = None
+        for condition in conditions:
+            if isinstance(condition, list) and condition[0] == 'content-length-range':
+                length_range = condition[1:]
+        policy = self.sign(key=key, type=fields.get('Content-Type'), length_range=length_range,
+                           expires=time.time() + expires)
+        return {'url': reverse('upload-local-post'), 'fields': dict(fields, key=key, policy=policy)}
+
+    def head(self, key):
+        try:
+            stat = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        return {
+            'size': stat.st_size,
+            # like s3, unique per write rather than a hash of the content
+            'etag': '{:x}-{:x}'.format(stat.st_mtime_ns, stat.st_size),
+            'last_modified': datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+        }
+
+    def list(self, prefix, page_size=1000):
+        keys = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.startswith('.partial-'):
+                    continue
+                key = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        keys.sort()
+
+        for index in range(0, len(keys), page_size) or [0]:
+            page = []
+            for key in keys[index:index + page_size]:
+                head = self.head(key)
+                if head is not None:
+                    page.append({'Key': key, 'Size': head['size'], 'ETag': '"{}"'.format(head['etag']),
+                                 'LastModified': head['last_modified']})
+            yield page
+
+    def delete(self, keys):
+        errors = {}
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                # s3 does not mind either
+                pass
+            except (OSError, ValueError) as e:
+                errors[key] = str(e)
+        return errors
+
+    def open_file(self, key):
+        return open(self.path(key), 'rb')
+
+    def open(self, key):
+        """
+        :return: read only memory map of the object, None when it is empty, since empty files can't be mapped
+        """
+        with open(self.path(key), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def stream(self, key, start=0, end=None):
+        data = self.open(key)
+        if data is None:
+            return
+        try:
+            end = len(data) - 1 if end is None else min(end, len(data) - 1)
+            view = memoryview(data)
+            try:
+                for offset in range(start, end + 1, CHUNK_SIZE):
+                    yield bytes(view[offset:min(offset + CHUNK_SIZE, end + 1)])
+            finally:
+                # also when the reader stops early, the map can't be closed while viewed
+                view.release()
+        finally:
+            data.close()
+
+    def put(self, key, data, content_type, **extra):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and moved into place, so readers never see half a file
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.partial-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    for chunk in data:
+                        f.write(chunk)
+            os.replace(partial, path)
+        except BaseException:
+            os.remove(partial)
+            raise
+
+
+STORAGES = {
+    's3': S3Storage,
+    'local': LocalStorage,
+}
+
+
+def get_storage(bucket, key=''):
+    """
+    Storage of the destination whose bucket and key prefix match, plain s3 for anything else
+    Storages are built once per destination, any other storage class can be named by its dotted path
+    """
+    name, options = None, {}
+    for destination_name, destination in sorted(get_s3direct_destinations().items()):
+        prefix = destination.get('key', '').rstrip('/') + '/'
+        if (destination.get('bucket') or settings.AWS_BUCKET_NAME) == bucket and key.startswith(prefix):
+            name, options = destination_name, destination
+            break
+
+    cache_key = (name, bucket)
+    storage = _storages.get(cache_key)
+    if storage is None:
+        storage_name = options.get('storage', 's3')
+        storage_class = STORAGES[storage_name] if storage_name in STORAGES else import_string(storage_name)
+        with _storages_lock:
+            storage = _storages.setdefault(cache_key, storage_class(bucket, **options))
+    return storage
+
+
+def get_file_storage(file):
+    return get_storage(file.s3_bucket, file.s3_key)
+
+
+@receiver(setting_changed)
+def forget_storages(setting, **kwargs):
+    if setting in ('AWS_DESTINATIONS', 'AWS_BUCKET_NAME', 'LOCAL_STORAGE_ROOT'):
+        with _storages_lock:
+            _storages.clear()
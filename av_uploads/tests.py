@@ -1,12 +1,36 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from collections import Counter
+from io import BytesIO, StringIO
+from unittest.mock import patch
+
+import boto3
+from PIL import Image
+from botocore.response import StreamingBody
+from botocore.stub import ANY, Stubber
+from django.conf import settings
 from django.contrib import auth
 from django.contrib.auth.models import Group
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
 from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
 
 from av_account.models import AvUser
+from av_core import aws
 from av_returns.models import Return
-from av_uploads.models import S3File
+from av_uploads import archive, deletions, previews, reconcile, storage, thumbnails, utils
+from av_uploads.models import PreviewRequest, S3Deletion, S3File
 
 
 class UploadAPITestCase(APITestCase):
@@ -86,6 +110,193 @@ class UploadAPITestCase(APITestCase):
         response = self.client.post(url, data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_presigned(self):
+        self.login()
+        data = {
+            'file_name': ['a.pdf', 'b.pdf', 'c.jpg'],
+            'file_type': ['application/pdf', 'application/pdf', 'image/jpeg'],
+            'file_size': ['100', '200', '300'],
+            'destination': 'uploads',
+            'year': self.my_return.year,
+            'presigned': '1',
+        }
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('upload_params'), data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        inserts = [query for query in queries.captured_queries if query['sql'].startswith('INSERT INTO "av_uploads_s3file"')]
+        self.assertEqual(len(inserts), 1)
+
+        posts = response.json()['files']
+        self.assertEqual([post['name'] for post in posts], data['file_name'])
+        self.assertEqual(posts[2]['fields']['Content-Type'], 'image/jpeg')
+        self.assertEqual(posts[2]['fields']['key'], posts[2]['object_key'])
+        self.assertIn('policy', posts[2]['fields'])
+        self.assertEqual(S3File.objects.filter(uploaded=False).count(), 3)
+
+        # one call confirms them all
+        response = self.client.post(reverse('upload_complete'), {'object_key': [post['object_key'] for post in posts]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(S3File.objects.filter(uploaded=True).count(), 3)
+
+    def test_presigned_mismatch(self):
+        self.login()
+        response = self.client.post(reverse('upload_params'), {
+            'file_name': ['a.pdf', 'b.pdf'],
+            'file_type': ['application/pdf'],
+            'file_size': ['100', '200'],
+            'destination': 'uploads',
+            'year': self.my_return.year,
+            'presigned': '1',
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(S3File.objects.exists())
+
+    def test_duplicate(self):
+        self.login()
+        sha256 = 'ab' * 32
+        data = {
+            'file_name': 'w2.pdf',
+            'file_type': 'application/pdf',
+            'file_size': '444',
+            'file_sha256': sha256.upper(),
+            'destination': 'uploads',
+            'year': self.my_return.year,
+        }
+        response = self.client.post(reverse('upload_params'), data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('duplicate', response.json())
+        object_key = response.json()['object_key']
+        self.assertEqual(S3File.objects.get().sha256, sha256)
+
+        # not a duplicate until the first copy made it to s3
+        response = self.client.post(reverse('upload_params'), data)
+        self.assertNotIn('duplicate', response.json())
+        S3File.objects.exclude(s3_key=object_key).delete()
+        with patch('av_uploads.storage.S3Storage.head', return_value={'size': 444, 'etag': 'e1', 'last_modified': None}):
+            self.client.post(reverse('upload_complete'), {'object_key': object_key})
+
+        response = self.client.post(reverse('upload_params'), data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.json()['duplicate'])
+        self.assertEqual(response.json()['object_key'], object_key)
+        self.assertEqual(S3File.objects.count(), 1)
+
+        # under another name it is a file of its own, sharing the object
+        response = self.client.post(reverse('upload_params'), dict(data, file_name='copy of w2.pdf'))
+        self.assertTrue(response.json()['duplicate'])
+        self.assertEqual(response.json()['object_key'], object_key)
+        copy = S3File.objects.get(name='copy of w2.pdf')
+        self.assertEqual((copy.s3_key, copy.uploaded), (object_key, True))
+
+        # the object stays until its last file is deleted
+        S3File.objects.get(name='w2.pdf').delete()
+        self.assertFalse(S3Deletion.objects.filter(s3_key=object_key).exists())
+        copy.delete()
+        self.assertEqual(S3Deletion.objects.filter(s3_key=object_key).count(), 1)
+
+        # another return does not share uploads
+        other_return = Return.objects.create(user=self.user, year=self.year + 1)
+        response = self.client.post(reverse('upload_params'), dict(data, year=other_return.year))
+        self.assertNotIn('duplicate', response.json())
+
+    def test_duplicate_verified(self):
+        self.login()
+        data = {
+            'file_name': 'w2.pdf',
+            'file_type': 'application/pdf',
+            'file_size': '444',
+            'file_sha256': 'ab' * 32,
+            'destination': 'uploads',
+            'year': self.my_return.year,
+        }
+
+        # the object is not the size declared, so its hash is not trusted for reuse
+        object_key = self.client.post(reverse('upload_params'), data).json()['object_key']
+        with patch('av_uploads.storage.S3Storage.head', return_value={'size': 1, 'etag': 'e1', 'last_modified': None}):
+            self.client.post(reverse('upload_complete'), {'object_key': object_key})
+        self.assertEqual(S3File.objects.get(s3_key=object_key).sha256, '')
+        self.assertNotIn('duplicate', self.client.post(reverse('upload_params'), data).json())
+
+        # a checked object is shared, though not with a file of another size
+        S3File.objects.filter(s3_key=object_key).update(sha256='ab' * 32, etag='e1', size=444)
+        self.assertNotIn('duplicate', self.client.post(reverse('upload_params'), dict(data, file_size='445')).json())
+        response = self.client.post(reverse('upload_params'), dict(data, file_name='copy of w2.pdf'))
+        self.assertEqual(response.json()['object_key'], object_key)
+
+        # completing a key shared by several files again is fine
+        response = self.client.post(reverse('upload_complete'), {'object_key': object_key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_presigned_duplicate(self):
+        self.login()
+        S3File.objects.create(user=self.user, tax_return=self.my_return, name='a.pdf', type='application/pdf',
+                              size=100, sha256='a' * 64, s3_key='uploads/1/a', etag='e1', uploaded=True)
+
+        response = self.client.post(reverse('upload_params'), {
+            'file_name': ['a again.pdf', 'b.pdf', 'c.pdf'],
+            'file_type': ['application/pdf'] * 3,
+            'file_size': ['100', '200', '300'],
+            'file_sha256': ['a' * 64, 'b' * 64, ''],
+            'destination': 'uploads',
+            'year': self.my_return.year,
+            'presigned': '1',
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        posts = response.json()['files']
+        self.assertEqual(posts[0], {'name': 'a again.pdf', 'object_key': 'uploads/1/a', 'duplicate': True})
+        self.assertIn('fields', posts[1])
+        self.assertIn('fields', posts[2])
+        self.assertEqual(S3File.objects.count(), 4)
+        self.assertTrue(S3File.objects.get(name='a again.pdf').uploaded)
+        self.assertEqual(S3File.objects.get(s3_key=posts[1]['object_key']).sha256, 'b' * 64)
+
+    def test_cpa_duplicate(self):
+        # the client's own upload
+        client_file = S3File.objects.create(
+            user=self.user, tax_return=self.my_return, name='w2.pdf', type='application/pdf', size=444,
+            sha256='ab' * 32, s3_bucket='test-bucket', s3_key='uploads/{}/w2'.format(self.user.id), etag='e1',
+            uploaded=True)
+
+        self.client.login(username=self.cpa.email, password='password')
+        self.client.get(reverse('force_trust'))
+        response = self.client.post(reverse('upload_params'), {
+            'file_name': 'w2.pdf',
+            'file_type': 'application/pdf',
+            'file_size': '444',
+            'file_sha256': 'ab' * 32,
+            'destination': 'uploads',
+            'year': self.year,
+            'target': self.user.id,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.json()['duplicate'])
+        self.assertEqual(response.json()['object_key'], client_file.s3_key)
+
+        # not uploaded again, but listed as the cpa's own upload for the client
+        response = self.client.get('/api/returns/{}/{}/files/'.format(self.year, self.user.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        files = response.json()['results'] if isinstance(response.json(), dict) else response.json()
+        self.assertEqual([file['name'] for file in files], ['w2.pdf'])
+        cpa_file = S3File.objects.get(user=self.cpa)
+        self.assertEqual((cpa_file.target_user, cpa_file.s3_key), (self.user, client_file.s3_key))
+
+        # the client's file is untouched
+        self.assertEqual(S3File.objects.get(id=client_file.id).user, self.user)
+
+    def test_bad_sha256(self):
+        self.login()
+        response = self.client.post(reverse('upload_params'), {
+            'file_name': 'x.pdf',
+            'file_type': 'application/pdf',
+            'file_size': '444',
+            'file_sha256': 'not a hash',
+            'destination': 'uploads',
+            'year': self.my_return.year,
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(S3File.objects.exists())
+
     def test_signature_protected(self):
         url = reverse('upload_signature')
 
@@ -126,6 +337,41 @@ class UploadAPITestCase(APITestCase):
         response = self.client.post(url, data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_signatures(self):
+        self.login()
+        messages = ['blah', 'more', 'other']
+
+        response = self.client.post(reverse('upload_signatures'), {
+            'to_sign': messages,
+            'datetime': '20080903T205635Z',
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        signatures = response.json()['signatures']
+
+        for message, signature in zip(messages, signatures):
+            response = self.client.post(reverse('upload_signature'), {
+                'to_sign': message,
+                'datetime': '20080903T205635Z',
+            })
+            self.assertEqual(response.content.decode(), signature)
+
+        # datetimes must pair up with the strings
+        response = self.client.post(reverse('upload_signatures'), {
+            'to_sign': messages,
+            'datetime': ['20080903T205635Z', '20080903T205636Z'],
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_signing_key_cache(self):
+        utils.derive_aws_v4_signing_key.cache_clear()
+        day = datetime.datetime(2008, 9, 3, 20, 56, 35)
+        key = utils.get_aws_v4_signing_key('secret', day, 'us-east-1', 's3')
+        self.assertEqual(utils.get_aws_v4_signing_key('secret', day + datetime.timedelta(hours=3), 'us-east-1', 's3'), key)
+        self.assertEqual(utils.derive_aws_v4_signing_key.cache_info().misses, 1)
+
+        # a new key after utc midnight
+        self.assertNotEqual(utils.get_aws_v4_signing_key('secret', day + datetime.timedelta(hours=4), 'us-east-1', 's3'), key)
+
     def test_complete_protected(self):
         url = reverse('upload_complete')
 
@@ -284,3 +530,738 @@ class UploadAPITestCase(APITestCase):
 
         file = S3File.objects.first()
         self.assertEqual(data['description'], file.description)
+
+
+    def create_files(self, count):
+        S3File.objects.bulk_create([S3File(
+            user=self.user,
+            target_user=self.cpa,
+            tax_return=self.my_return,
+            name='file{}.pdf'.format(i),
+            s3_key='uploads/{}'.format(i),
+            s3_bucket='bucket',
+            uploaded=True,
+        ) for i in range(S3File.objects.count(), count)])
+
+    def test_list_queries(self):
+        self.login()
+        url = reverse('s3file-list', args=[self.year])
+        for count in (1, 100, 1000):
+            self.create_files(count)
+            # session, user, agent trust settings twice and the page of files, however many there are
+            with self.assertNumQueries(5):
+                response = self.client.get(url, {'page_size': 1000})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.data['results']), count)
+
+        file = response.data['results'][0]
+        self.assertTrue(file['url'].endswith('/api/returns/1984/files/{}/'.format(S3File.objects.latest('id').id)))
+        self.assertTrue(file['tax_return'].endswith('/api/returns/{}/'.format(self.my_return.id)))
+        self.assertTrue(file['user'].endswith('/api/users/{}/'.format(self.user.id)))
+
+    def test_list_pages(self):
+        self.create_files(150)
+        self.client.login(username=self.cpa.email, password='password')
+        self.client.get(reverse('force_trust'))
+
+        response = self.client.get(reverse('download-list', args=[self.year]))
+        self.assertEqual(len(response.data['results']), 100)
+        with self.assertNumQueries(5):
+            response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 50)
+        self.assertIsNone(response.data['next'])
+
+
+@override_settings(TESTING=False)
+class S3UrlTestCase(TestCase):
+
+    def setUp(self):
+        aws._clients.clear()
+        utils._urls.clear()
+        self.files = [S3File(id=i, name='file{}.pdf'.format(i), s3_bucket='bucket', s3_key='key{}'.format(i))
+                      for i in range(200)]
+
+    @patch('boto3.client', wraps=boto3.client)
+    def test_client_reused(self, client_mock):
+        urls = [utils.get_s3_url(file) for file in self.files]
+        self.assertEqual(client_mock.call_count, 1)
+        self.assertIn('key199', urls[-1])
+
+        # listing again hits the cache
+        with patch.object(aws.get_client('s3'), 'generate_presigned_url') as sign_mock:
+            self.assertEqual([utils.get_s3_url(file) for file in self.files], urls)
+            self.assertFalse(sign_mock.called)
+
+    def test_url_cache(self):
+        file = self.files[0]
+        url = utils.get_s3_url(file)
+        self.assertIn('attachment', url)
+        self.assertNotEqual(utils.get_s3_url(file, 'inline'), url)
+
+        # a changed key is signed again
+        file.s3_key = 'other'
+        self.assertIn('other', utils.get_s3_url(file))
+
+        # urls are not handed out once too little of their validity is left
+        with patch('time.time', return_value=time.time() + utils.S3_URL_EXPIRES - utils.S3_URL_MIN_VALIDITY + 1):
+            with patch.object(aws.get_client('s3'), 'generate_presigned_url', return_value='fresh'):
+                self.assertEqual(utils.get_s3_url(file), 'fresh')
+
+        utils.forget_s3_urls(file)
+        self.assertFalse(utils._urls)
+
+
+class S3DeletionTestCase(TestCase):
+
+    def setUp(self):
+        aws._clients.clear()
+        self.user = AvUser.objects.create_user(email='test@example.com', password='password')
+        self.tax_return = Return.objects.create(user=self.user, year=1984)
+        for i in range(3):
+            S3File.objects.create(user=self.user, tax_return=self.tax_return, name='file{}'.format(i),
+                                  s3_bucket='bucket', s3_key='key{}'.format(i))
+
+        self.stubber = Stubber(aws.get_client('s3'))
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        aws._clients.clear()
+
+    def expect_delete(self, keys, errors=()):
+        self.stubber.add_response('delete_objects', {'Errors': list(errors)}, {
+            'Bucket': 'bucket',
+            'Delete': {'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+        })
+
+    @patch('av_uploads.deletions.RETRY_DELAY', 0)
+    def test_outbox(self):
+        # deleting only queues the objects, the stubber would complain about any s3 call
+        self.user.delete()
+        self.assertEqual(set(S3Deletion.objects.values_list('s3_key', flat=True)), {'key0', 'key1', 'key2'})
+
+        keys = list(S3Deletion.objects.order_by('id').values_list('s3_key', flat=True))
+        self.expect_delete(sorted(keys[:2]))
+        self.expect_delete(keys[2:], errors=[{'Key': keys[2], 'Code': 'AccessDenied', 'Message': 'Access Denied'}])
+        out = StringIO()
+        call_command('s3_deletions', batch_size=2, stdout=out)
+        self.stubber.assert_no_pending_responses()
+
+        self.assertIn('Deleted 2 objects in 2 batches', out.getvalue())
+        deletion = S3Deletion.objects.get()
+        self.assertEqual((deletion.s3_key, deletion.attempts), (keys[2], 1))
+        self.assertIn('AccessDenied', deletion.last_error)
+
+    @patch('av_uploads.deletions.RETRY_DELAY', 0)
+    def test_retries(self):
+        S3File.objects.all().delete()
+
+        for attempt in range(deletions.RETRIES):
+            self.stubber.add_client_error('delete_objects', 'InternalError')
+        self.expect_delete(['key0', 'key1', 'key2'])
+
+        stats = deletions.drain()
+        self.assertEqual((stats['deleted'], stats['retries'], stats['failed']), (3, deletions.RETRIES, 0))
+        self.assertFalse(S3Deletion.objects.exists())
+
+    @patch('av_uploads.deletions.RETRY_DELAY', 0)
+    def test_stuck(self):
+        S3File.objects.all().delete()
+        S3Deletion.objects.update(attempts=deletions.MAX_ATTEMPTS - 1)
+
+        for attempt in range(deletions.RETRIES + 1):
+            self.stubber.add_client_error('delete_objects', 'InternalError')
+
+        stats = deletions.drain()
+        self.assertEqual((stats['failed'], stats['stuck']), (3, 3))
+
+        # stuck objects are left alone
+        self.assertEqual(deletions.drain()['batches'], 0)
+
+
+class FakeS3(object):
+    """Streams objects from a dict of key to bytes, in any order from any thread"""
+    def __init__(self, objects):
+        self.objects = objects
+
+    def stream(self, key):
+        body = BytesIO(self.objects[key])
+        return iter(lambda: body.read(archive.CHUNK_SIZE), b'')
+
+
+class UploadZipTestCase(TestCase):
+
+    def setUp(self):
+        self.user = AvUser.objects.create_user(email='test@example.com', password='password')
+        self.user.is_email_verified = True
+        self.user.save()
+        self.tax_return = Return.objects.create(user=self.user, year=1984)
+
+        self.objects = {}
+        self.files = []
+        for i in range(10):
+            key = 'uploads/{}'.format(i)
+            # larger than a chunk, so entries are streamed in pieces
+            self.objects[key] = bytes([i]) * (archive.CHUNK_SIZE + i)
+            self.files.append(S3File.objects.create(
+                user=self.user, tax_return=self.tax_return, name='same.pdf' if i < 2 else 'file{}.pdf'.format(i),
+                s3_bucket='bucket', s3_key=key, size=len(self.objects[key]), uploaded=True))
+
+    def get_zip(self, *args, **kwargs):
+        self.client.login(username=self.user.email, password='password')
+        self.client.get(reverse('force_trust'))
+        with patch('av_uploads.archive.get_file_storage', return_value=FakeS3(self.objects)):
+            response = self.client.get(*args, **kwargs)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return zipfile.ZipFile(BytesIO(b''.join(response.streaming_content)))
+
+    def test_zip(self):
+        with patch('av_uploads.archive.PREFETCH_FILES', 3):
+            zip_file = self.get_zip(reverse('upload-zip', args=[self.tax_return.id]))
+
+        names = zip_file.namelist()
+        self.assertEqual(names[:3], ['same.pdf', 'same (2).pdf', 'file2.pdf'])
+        self.assertEqual(len(names), 10)
+        for name, file in zip(names, self.files):
+            self.assertEqual(zip_file.read(name), self.objects[file.s3_key])
+
+    def test_selection(self):
+        zip_file = self.get_zip(reverse('upload-zip', args=[self.tax_return.id]),
+                                {'id': [self.files[3].id, self.files[5].id]})
+        self.assertEqual(zip_file.namelist(), ['file3.pdf', 'file5.pdf'])
+
+    def test_forbidden(self):
+        other = AvUser.objects.create_user(email='other@example.com', password='password')
+        other.is_email_verified = True
+        other.save()
+        self.client.login(username=other.email, password='password')
+        self.client.get(reverse('force_trust'))
+
+        response = self.client.get(reverse('upload-zip', args=[self.tax_return.id]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class MultipartUploadTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = AvUser.objects.create_user(email='test@example.com', password='password')
+        self.my_return = Return.objects.create(user=self.user, year=1984)
+
+        aws._clients.clear()
+        self.stubber = Stubber(aws.get_client('s3'))
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        aws._clients.clear()
+
+    def login(self):
+        self.client.login(username=self.user.email, password='password')
+        self.client.get(reverse('force_trust'))
+
+    def start(self, size=50 * 1024 * 1024):
+        self.stubber.add_response('create_multipart_upload', {'UploadId': 'upload-1'})
+        self.login()
+        response = self.client.post(reverse('upload_multipart'), {
+            'file_name': 'statements.pdf',
+            'file_type': 'application/pdf',
+            'file_size': size,
+            'destination': 'uploads',
+            'year': self.my_return.year,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def expect_parts(self, file, numbers, size=50 * 1024 * 1024):
+        # whole parts up to the size, the last one takes the rest
+        sizes = {number: min(utils.S3_PART_SIZE, size - (number - 1) * utils.S3_PART_SIZE) for number in numbers}
+        self.stubber.add_response('list_parts', {
+            'Parts': [{'PartNumber': number, 'ETag': '"etag{}"'.format(number), 'Size': sizes[number]}
+                      for number in numbers],
+            'IsTruncated': False,
+        }, {'Bucket': file.s3_bucket, 'Key': file.s3_key, 'UploadId': 'upload-1'})
+
+    def test_upload(self):
+        params = self.start()
+        self.assertEqual((params['upload_id'], params['part_count']), ('upload-1', 3))
+        file = S3File.objects.get()
+        self.assertEqual(file.upload_id, 'upload-1')
+        self.assertFalse(file.uploaded)
+
+        # all part urls in one go
+        response = self.client.post(reverse('upload_multipart_sign'), {
+            'object_key': params['object_key'],
+            'part_numbers': '1,2,3',
+        })
+        urls = response.json()['urls']
+        self.assertEqual(sorted(urls), ['1', '2', '3'])
+        self.assertIn('partNumber=2', urls['2'])
+        self.assertIn('uploadId=upload-1', urls['2'])
+
+        # resuming after two parts made it
+        self.expect_parts(file, [1, 2])
+        response = self.client.get(reverse('upload_multipart_parts'), {'object_key': params['object_key']})
+        self.assertEqual([part['part_number'] for part in response.json()['parts']], [1, 2])
+
+        self.expect_parts(file, [1, 2, 3])
+        self.stubber.add_response('complete_multipart_upload', {}, {
+            'Bucket': file.s3_bucket,
+            'Key': file.s3_key,
+            'UploadId': 'upload-1',
+            'MultipartUpload': {'Parts': [{'PartNumber': number, 'ETag': '"etag{}"'.format(number)}
+                                          for number in (1, 2, 3)]},
+        })
+        response = self.client.post(reverse('upload_multipart_complete'),
+                                    {'object_key': params['object_key'], 'part_count': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.stubber.assert_no_pending_responses()
+
+        file = S3File.objects.get()
+        self.assertTrue(file.uploaded)
+        self.assertEqual(file.upload_id, '')
+
+    def test_incomplete(self):
+        params = self.start()
+        file = S3File.objects.get()
+
+        # completed before the client knows how many parts there are
+        response = self.client.post(reverse('upload_multipart_complete'), {'object_key': params['object_key']})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # a part in the middle never arrived
+        self.expect_parts(file, [1, 3])
+        response = self.client.post(reverse('upload_multipart_complete'),
+                                    {'object_key': params['object_key'], 'part_count': 3})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # all parts, one of them cut short
+        self.expect_parts(file, [1, 2, 3], size=49 * 1024 * 1024)
+        response = self.client.post(reverse('upload_multipart_complete'),
+                                    {'object_key': params['object_key'], 'part_count': 3})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.stubber.assert_no_pending_responses()
+        self.assertFalse(S3File.objects.get().uploaded)
+
+    def test_bad_sign(self):
+        params = self.start()
+        for part_numbers in ('', 'x', '0', '10001'):
+            response = self.client.post(reverse('upload_multipart_sign'), {
+                'object_key': params['object_key'],
+                'part_numbers': part_numbers,
+            })
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse('upload_multipart_sign'), {'object_key': 'nope', 'part_numbers': '1'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_too_large(self):
+        self.login()
+        response = self.client.post(reverse('upload_multipart'), {
+            'file_name': 'huge.pdf',
+            'file_type': 'application/pdf',
+            'file_size': 3 * 1024 ** 3,
+            'destination': 'uploads',
+            'year': self.my_return.year,
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_abort(self):
+        params = self.start()
+        self.stubber.add_response('abort_multipart_upload', {})
+        response = self.client.post(reverse('upload_multipart_abort'), {'object_key': params['object_key']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(S3File.objects.exists())
+        self.assertTrue(S3Deletion.objects.filter(s3_key=params['object_key']).exists())
+
+    def test_region(self):
+        # a destination outside the default region is talked to in its own
+        destinations = dict(settings.AWS_DESTINATIONS)
+        destinations['uploads'] = dict(destinations['uploads'], region='eu-west-1')
+        with override_settings(AWS_DESTINATIONS=destinations), Stubber(aws.get_client('s3', 'eu-west-1')) as stubber:
+            stubber.add_response('create_multipart_upload', {'UploadId': 'upload-1'})
+            self.login()
+            params = self.client.post(reverse('upload_multipart'), {
+                'file_name': 'statements.pdf',
+                'file_type': 'application/pdf',
+                'file_size': 50 * 1024 * 1024,
+                'destination': 'uploads',
+                'year': self.my_return.year,
+            }).json()
+            self.assertEqual(S3File.objects.get().s3_region, 'eu-west-1')
+
+            stubber.add_response('abort_multipart_upload', {})
+            response = self.client.post(reverse('upload_multipart_abort'), {'object_key': params['object_key']})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            stubber.assert_no_pending_responses()
+
+
+class ReconcileTestCase(TestCase):
+
+    def setUp(self):
+        aws._clients.clear()
+        self.user = AvUser.objects.create_user(email='test@example.com', password='password')
+        self.tax_return = Return.objects.create(user=self.user, year=1984)
+
+        self.stubber = Stubber(aws.get_client('s3'))
+        self.stubber.activate()
+
+        old = timezone.now() - datetime.timedelta(days=2)
+        self.pending = self.create('uploads/1/a', uploaded=False)
+        self.uploaded = self.create('uploads/1/b', uploaded=True)
+        self.stale = self.create('uploads/1/c', uploaded=False, date_created=old)
+        self.recent = self.create('uploads/1/d', uploaded=False)
+
+        self.stubber.add_response('list_objects_v2', {
+            'Contents': [self.object('uploads/1/a', 10), self.object('uploads/1/b', 20),
+                         self.object('uploads/1/b' + previews.PREVIEW_SUFFIX, 5, old),
+                         self.object('uploads/1/gone' + previews.PREVIEW_SUFFIX, 5, old)],
+            'IsTruncated': True,
+            'NextContinuationToken': 'next',
+        }, {'Bucket': 'test-bucket', 'Prefix': 'uploads/', 'MaxKeys': reconcile.PAGE_SIZE})
+        self.stubber.add_response('list_objects_v2', {
+            'Contents': [self.object('uploads/2/orphan', 30, old), self.object('uploads/2/new', 40)],
+            'IsTruncated': False,
+        }, {'Bucket': 'test-bucket', 'Prefix': 'uploads/', 'MaxKeys': reconcile.PAGE_SIZE,
+            'ContinuationToken': 'next'})
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        aws._clients.clear()
+
+    def create(self, key, **kwargs):
+        return S3File.objects.create(user=self.user, tax_return=self.tax_return, name=key, s3_bucket='test-bucket',
+                                     s3_key=key, **kwargs)
+
+    def object(self, key, size, last_modified=None):
+        return {'Key': key, 'Size': size, 'ETag': '"etag-{}"'.format(size),
+                'LastModified': last_modified or timezone.now()}
+
+    def test_reconcile(self):
+        out = StringIO()
+        call_command('reconcile_uploads', '--delete-orphans', stdout=out)
+        self.stubber.assert_no_pending_responses()
+
+        pending = S3File.objects.get(id=self.pending.id)
+        self.assertTrue(pending.uploaded)
+        self.assertEqual((pending.size, pending.etag), (10, 'etag-10'))
+        self.assertEqual(S3File.objects.get(id=self.uploaded.id).etag, 'etag-20')
+
+        # pending without an object is pruned once stale
+        self.assertFalse(S3File.objects.filter(id=self.stale.id).exists())
+        self.assertTrue(S3File.objects.filter(id=self.recent.id).exists())
+
+        # only old objects without a row are orphans
+        self.assertIn('Orphan object test-bucket/uploads/2/orphan', out.getvalue())
+        self.assertNotIn('uploads/2/new', out.getvalue())
+        self.assertNotIn('uploads/1/b.preview', out.getvalue())
+        self.assertIn('uploads/1/gone.preview', out.getvalue())
+        self.assertTrue(S3Deletion.objects.filter(s3_key='uploads/2/orphan').exists())
+
+    def test_dry_run(self):
+        call_command('reconcile_uploads', '--dry-run', '--delete-orphans', stdout=StringIO())
+        self.assertFalse(S3File.objects.get(id=self.pending.id).uploaded)
+        self.assertTrue(S3File.objects.filter(id=self.stale.id).exists())
+        self.assertFalse(S3Deletion.objects.exists())
+
+
+class PreviewTestCase(TestCase):
+
+    def setUp(self):
+        aws._clients.clear()
+        self.user = AvUser.objects.create_user(email='test@example.com', password='password')
+        self.tax_return = Return.objects.create(user=self.user, year=1984)
+
+        out = BytesIO()
+        Image.new('RGB', (1000, 500), 'red').save(out, 'PNG')
+        self.png = out.getvalue()
+        self.file = S3File.objects.create(user=self.user, tax_return=self.tax_return, name='receipt.png',
+                                          type='image/png', size=len(self.png), s3_bucket='test-bucket',
+                                          s3_key='uploads/1/receipt', uploaded=True)
+
+        self.stubber = Stubber(aws.get_client('s3'))
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        aws._clients.clear()
+
+    def expect_get(self, data):
+        self.stubber.add_response('get_object', {
+            'Body': StreamingBody(BytesIO(data), len(data)),
+            'ServerSideEncryption': 'AES256',
+        }, {'Bucket': 'test-bucket', 'Key': 'uploads/1/receipt'})
+
+    def test_render_image(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(self.png)
+            f.flush()
+            preview = Image.open(BytesIO(previews.render('image/png', f.name)))
+        self.assertEqual((preview.format, preview.size), ('JPEG', (thumbnails.PREVIEW_SIZE, thumbnails.PREVIEW_SIZE // 2)))
+
+    def test_generate(self):
+        self.expect_get(self.png)
+        self.stubber.add_response('put_object', {}, {
+            'Bucket': 'test-bucket', 'Key': 'uploads/1/receipt.preview.jpg', 'Body': ANY, 'ContentType': 'image/jpeg',
+            'ServerSideEncryption': 'AES256',
+        })
+
+        stats = Counter()
+        previews.generate(self.file, stats)
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(stats['generated'], 1)
+        file = S3File.objects.get()
+        self.assertEqual(file.preview_key, 'uploads/1/receipt.preview.jpg')
+        self.assertIn('receipt.preview.jpg', file.get_preview_url())
+
+        # the preview goes when the file does
+        file.delete()
+        self.assertEqual(set(S3Deletion.objects.values_list('s3_key', flat=True)),
+                         {'uploads/1/receipt', 'uploads/1/receipt.preview.jpg'})
+
+    def test_unreadable(self):
+        self.expect_get(b'not an image')
+        stats = Counter()
+        previews.generate(self.file, stats)
+        self.assertEqual(stats['failed'], 1)
+        self.assertTrue(S3File.objects.get().preview_failed)
+
+        # and is not tried again
+        out = StringIO()
+        call_command('previews', stdout=out)
+        self.assertIn('Checked 0 files', out.getvalue())
+
+    def test_generate_many(self):
+        other = S3File.objects.create(user=self.user, tax_return=self.tax_return, name='other.png', type='image/png',
+                                      size=len(self.png), s3_bucket='test-bucket', s3_key='uploads/1/other',
+                                      uploaded=True)
+
+        # an unexpected error with one file leaves the rest of the batch to go on
+        def generate(file, stats):
+            if file.id == self.file.id:
+                raise RuntimeError('boom')
+            stats['generated'] += 1
+
+        with patch.object(previews, 'generate', generate), patch.object(previews, 'connection'):
+            stats = previews.generate_many([self.file.id, other.id])
+        self.assertEqual((stats['errors'], stats['generated']), (1, 1))
+
+    @override_settings(UPLOAD_PREVIEWS=True)
+    def test_scheduled_on_complete(self):
+        self.client.login(username=self.user.email, password='password')
+        self.client.get(reverse('force_trust'))
+        self.file.uploaded = False
+        self.file.save()
+
+        # only queued by the request, the previews process renders it
+        with patch.object(previews, 'generate') as generate_mock:
+            response = self.client.post(reverse('upload_complete'), {'object_key': self.file.s3_key})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(generate_mock.called)
+        self.assertEqual(list(PreviewRequest.objects.values_list('file_id', flat=True)), [self.file.id])
+
+        with patch.object(previews, 'generate_many', return_value=Counter(generated=1)) as generate_mock:
+            stats = previews.drain()
+        generate_mock.assert_called_once_with([self.file.id])
+        self.assertEqual((stats['batches'], stats['files'], stats['generated']), (1, 1, 1))
+        self.assertFalse(PreviewRequest.objects.exists())
+
+
+class LocalStorageTestCase(TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        destinations = dict(settings.AWS_DESTINATIONS)
+        destinations['uploads'] = dict(destinations['uploads'], storage='local', location=self.location)
+        self.settings_override = override_settings(AWS_DESTINATIONS=destinations)
+        self.settings_override.enable()
+        utils._urls.clear()
+
+        self.user = AvUser.objects.create_user(email='test@example.com', password='password')
+        self.user.is_email_verified = True
+        self.user.save()
+        self.tax_return = Return.objects.create(user=self.user, year=1984)
+        self.client.login(username=self.user.email, password='password')
+        self.client.get(reverse('force_trust'))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.location)
+
+    def upload(self, name, content):
+        response = self.client.post(reverse('upload_params'), {
+            'file_name': name,
+            'file_type': 'application/pdf',
+            'file_size': len(content),
+            'destination': 'uploads',
+            'year': self.tax_return.year,
+            'presigned': '1',
+        })
+        post = response.json()['files'][0]
+        fields = dict(post['fields'], file=SimpleUploadedFile(name, content))
+        response = self.client.post(post['url'], fields)
+        self.assertEqual(response.status_code, 204)
+        self.client.post(reverse('upload_complete'), {'object_key': post['object_key']})
+        return S3File.objects.get(s3_key=post['object_key'])
+
+    def test_upload_and_download(self):
+        content = bytes(range(256)) * 10
+        file = self.upload('w2.pdf', content)
+        self.assertTrue(file.uploaded)
+        path = os.path.join(self.location, file.s3_bucket, file.s3_key)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+        url = self.client.get(reverse('upload-url', args=[file.id]))['Location']
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), content)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=w2.pdf')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/2560')
+        self.assertEqual(b''.join(response.streaming_content), content[10:20])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), content[-5:])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=5000-')
+        self.assertEqual(response.status_code, 416)
+
+        response = self.client.get(url.replace('/local/', '/local/x'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_upload_policy(self):
+        response = self.client.post(reverse('upload_params'), {
+            'file_name': 'w2.pdf',
+            'file_type': 'application/pdf',
+            'file_size': 3,
+            'destination': 'uploads',
+            'year': self.tax_return.year,
+            'presigned': '1',
+        })
+        post = response.json()['files'][0]
+
+        # the key is part of the policy
+        fields = dict(post['fields'], key='uploads/other', file=SimpleUploadedFile('w2.pdf', b'pdf'))
+        self.assertEqual(self.client.post(post['url'], fields).status_code, status.HTTP_403_FORBIDDEN)
+
+        # as are the destination's sizes
+        fields = dict(post['fields'], file=SimpleUploadedFile('w2.pdf', b''))
+        self.assertEqual(self.client.post(post['url'], fields).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(os.path.exists(os.path.join(self.location, settings.AWS_BUCKET_NAME, post['object_key'])))
+
+    def test_multipart_needs_s3(self):
+        response = self.client.post(reverse('upload_multipart'), {
+            'file_name': 'big.pdf',
+            'file_type': 'application/pdf',
+            'file_size': 100,
+            'destination': 'uploads',
+            'year': self.tax_return.year,
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(S3File.objects.exists())
+
+    def test_proxy(self):
+        content = b'0123456789' * 100
+        file = self.upload('w2.pdf', content)
+        url = reverse('upload-url', args=[file.id]) + '?proxy=1'
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), content)
+        response.close()
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=995-', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'56789')
+        response.close()
+
+        # a changed object is sent whole
+        response = self.client.get(url, HTTP_RANGE='bytes=995-', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response.close()
+
+    def test_proxy_busy(self):
+        file = self.upload('w2.pdf', b'pdf')
+        url = reverse('upload-url', args=[file.id]) + '?proxy=1'
+
+        with patch('av_uploads.downloads._slots', threading.BoundedSemaphore(1)):
+            first = self.client.get(url)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Retry-After', response)
+
+            # the slot is given back once the first download is done
+            first.close()
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response.close()
+
+    def test_zip_reconcile_and_delete(self):
+        files = [self.upload('file{}.pdf'.format(i), bytes([i]) * 100) for i in range(3)]
+
+        response = self.client.get(reverse('upload-zip', args=[self.tax_return.id]))
+        zip_file = zipfile.ZipFile(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(zip_file.read('file1.pdf'), bytes([1]) * 100)
+
+        stats, orphans = reconcile.reconcile()
+        self.assertEqual((stats['objects'], stats['backfilled'], orphans), (3, 3, []))
+
+        files[0].delete()
+        self.assertEqual(deletions.drain()['deleted'], 1)
+        local = storage.get_file_storage(files[0])
+        self.assertIsNone(local.head(files[0].s3_key))
+        self.assertEqual([obj['Key'] for page in local.list('uploads/') for obj in page],
+                         sorted(file.s3_key for file in files[1:]))
+
+
+@override_settings(UPLOAD_PROXY_DOWNLOADS=True)
+class S3ProxyTestCase(TestCase):
+
+    def setUp(self):
+        aws._clients.clear()
+        self.user = AvUser.objects.create_user(email='test@example.com', password='password')
+        self.user.is_email_verified = True
+        self.user.save()
+        tax_return = Return.objects.create(user=self.user, year=1984)
+        self.file = S3File.objects.create(user=self.user, tax_return=tax_return, name='w2.pdf',
+                                          type='application/pdf', size=1000, s3_bucket='test-bucket',
+                                          s3_key='uploads/1/w2', uploaded=True)
+        self.client.login(username=self.user.email, password='password')
+        self.client.get(reverse('force_trust'))
+
+        self.stubber = Stubber(aws.get_client('s3'))
+        self.stubber.activate()
+        self.stubber.add_response('head_object', {
+            'ContentLength': 1000, 'ETag': '"abc"', 'LastModified': datetime.datetime(2018, 4, 1, tzinfo=timezone.utc),
+        }, {'Bucket': 'test-bucket', 'Key': 'uploads/1/w2'})
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        aws._clients.clear()
+
+    def test_range(self):
+        self.stubber.add_response('get_object', {
+            'Body': StreamingBody(BytesIO(b'x' * 100), 100),
+        }, {'Bucket': 'test-bucket', 'Key': 'uploads/1/w2', 'Range': 'bytes=100-199'})
+
+        response = self.client.get(reverse('upload-url', args=[self.file.id]), HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/1000')
+        self.assertEqual(response['ETag'], '"abc"')
+        self.assertEqual(b''.join(response.streaming_content), b'x' * 100)
+        response.close()
+        self.stubber.assert_no_pending_responses()
+
+    def test_not_modified(self):
+        response = self.client.get(reverse('upload-url', args=[self.file.id]), HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(response.status_code, 304)
+        self.stubber.assert_no_pending_responses()
+
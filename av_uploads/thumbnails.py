@@ -0,0 +1,51 @@
+import os
+import subprocess
+import tempfile
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# longest side in pixels, and jpeg quality
+PREVIEW_SIZE = 320
+PREVIEW_QUALITY = 80
+
+# seconds a single render may take
+PREVIEW_TIMEOUT = 60
+
+IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/bmp', 'image/tiff', 'image/webp'}
+PDF_TYPES = {'application/pdf'}
+
+
+def render_image(path, size):
+    with Image.open(path) as image:
+        # lets jpeg decode at a fraction of full size
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        out = BytesIO()
+        image.save(out, 'JPEG', quality=PREVIEW_QUALITY, optimize=True)
+        return out.getvalue()
+
+
+def render_pdf(path, size):
+    # first page only, poppler's pdftoppm must be installed, see Aptfile
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run(
+            ['pdftoppm', '-f', '1', '-l', '1', '-singlefile', '-scale-to', str(size), '-jpeg',
+             path, os.path.join(directory, 'preview')],
+            check=True, timeout=PREVIEW_TIMEOUT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        with open(os.path.join(directory, 'preview.jpg'), 'rb') as f:
+            return f.read()
+
+
+def render(file_type, path, size=PREVIEW_SIZE):
+    """
+    Runs in a pool process started afresh, so this module keeps clear of django
+    :param path: file holding the original
+    :return: jpeg bytes
+    """
+    if file_type in PDF_TYPES:
+        return render_pdf(path, size)
+    return render_image(path, size)
@@ -4,4 +4,7 @@ from .views import *
 
 urlpatterns = [
     url(r'^get/(?P<id>\d+)/$', UploadUrlView.as_view(), name='upload-url'),
+    url(r'^zip/(?P<id>\d+)/$', UploadZipView.as_view(), name='upload-zip'),
+    url(r'^local/$', LocalUploadView.as_view(), name='upload-local-post'),
+    url(r'^local/(?P<token>[\w:.-]+)/$', LocalStorageView.as_view(), name='upload-local'),
 ]
\ No newline at end of file
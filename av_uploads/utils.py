@@ -1,9 +1,30 @@
+import functools
 import hashlib
 import hmac
+import threading
+import time
+from collections import OrderedDict
 
-import boto3
 from django.conf import settings
 
+# how long presigned urls are valid, and how much of that must be left on a url handed out from the cache
+S3_URL_EXPIRES = 3600
+S3_URL_MIN_VALIDITY = 600
+S3_URL_CACHE_SIZE = 10000
+
+# multipart uploads, s3 wants parts of at least 5 MB except for the last, and no more than 10000 of them
+S3_PART_SIZE = 20 * 1024 * 1024
+S3_MAX_PARTS = 10000
+# part urls signed per request
+S3_SIGN_PARTS = 500
+
+_urls = OrderedDict()
+_urls_lock = threading.Lock()
+
+
+def get_part_count(size):
+    return max(1, -(-size // S3_PART_SIZE))
+
 
 def get_at(index, t):
     try:
@@ -28,8 +49,8 @@ def sign(key, message):
     return hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
 
 
-def get_aws_v4_signing_key(key, signing_date, region, service):
-    datestamp = signing_date.strftime('%Y%m%d')
+@functools.lru_cache(maxsize=16)
+def derive_aws_v4_signing_key(key, datestamp, region, service):
     date_key = sign(('AWS4' + key).encode('utf-8'), datestamp)
     k_region = sign(date_key, region)
     k_service = sign(k_region, service)
@@ -37,49 +58,62 @@ def get_aws_v4_signing_key(key, signing_date, region, service):
     return k_signing
 
 
+def get_aws_v4_signing_key(key, signing_date, region, service):
+    # the key only changes with the utc date, so it is derived once a day rather than per signature
+    return derive_aws_v4_signing_key(key, signing_date.strftime('%Y%m%d'), region, service)
+
+
 def get_aws_v4_signature(key, message):
     return hmac.new(key, message.encode('utf-8'), hashlib.sha256).hexdigest()
 
 
-def get_s3_url(file):
-    if settings.TESTING:
-        return 'http://localhost/'
-    
+def get_s3_url(file, disposition='attachment'):
+    """
+    Presigned GET url, reused until less than S3_URL_MIN_VALIDITY seconds of its signature are left
+    """
     if file.s3_bucket is None or file.s3_key is None:
         return None
     if len(file.s3_bucket) == 0 or len(file.s3_key) == 0:
         return None
 
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=settings.AWS_ACCESS_KEY,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        region_name=settings.AWS_REGION,
-    )
-
-    # Generate the URL to get 'key-name' from 'bucket-name'
-    url = s3.generate_presigned_url(
-        ClientMethod='get_object',
-        Params={
-            'Bucket': file.s3_bucket,
-            'Key': file.s3_key,
-            'ResponseContentDisposition': 'attachment; filename={}'.format(file.name)
-        }
-    )
-
-    return url
+    return presigned_get(file, disposition, file.s3_key, '{}; filename={}'.format(disposition, file.name), file.type)
 
 
-def delete_s3_object(file):
-    if file.s3_bucket is None or file.s3_key is None:
-        return None
-    if len(file.s3_bucket) == 0 or len(file.s3_key) == 0:
+def get_preview_url(file):
+    """
+    Presigned GET url of the file's preview image, None if it has none
+    """
+    if not file.preview_key:
         return None
 
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=settings.AWS_ACCESS_KEY,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        region_name=settings.AWS_REGION,
-    )
-    s3.delete_object(Bucket=file.s3_bucket, Key=file.s3_key)
+    return presigned_get(file, 'preview', file.preview_key, 'inline', 'image/jpeg')
+
+
+def presigned_get(file, variant, key, content_disposition, content_type):
+    # storage needs this module, so it is imported here
+    from av_uploads.storage import get_file_storage
+
+    # bucket, key and disposition are part of the entry so a changed file is signed again
+    cache_key = (file.id, variant)
+    signed = (file.s3_bucket, key, content_disposition)
+    now = time.time()
+    with _urls_lock:
+        cached = _urls.get(cache_key)
+        if cached is not None and cached[0] == signed and cached[1] > now:
+            return cached[2]
+
+    url = get_file_storage(file).presign_get(key, content_disposition, S3_URL_EXPIRES, content_type)
+
+    with _urls_lock:
+        _urls.pop(cache_key, None)
+        _urls[cache_key] = (signed, now + S3_URL_EXPIRES - S3_URL_MIN_VALIDITY, url)
+        while len(_urls) > S3_URL_CACHE_SIZE:
+            _urls.popitem(last=False)
+
+    return url
+
+
+def forget_s3_urls(file):
+    with _urls_lock:
+        for cache_key in [cache_key for cache_key in _urls if cache_key[0] == file.id]:
+            del _urls[cache_key]
@@ -1,28 +1,49 @@
 import json
+import re
 import uuid
+from collections import defaultdict
 from datetime import datetime
 from urllib.parse import unquote
 
 import os
+from botocore.exceptions import BotoCoreError, ClientError
 from django.conf import settings
+from django.core import signing
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, \
-    HttpResponseServerError, HttpResponseRedirect
+    HttpResponseServerError, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django.utils.datastructures import MultiValueDictKeyError
+from django.utils.decorators import method_decorator
 from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import viewsets, serializers
+from rest_framework.pagination import CursorPagination
 from rest_framework.views import APIView
 
 from av_account.models import AvUser
 from av_account.utils import FullRequiredMixin
+from av_core import logger
 from av_returns.models import Return
+from av_uploads import previews
+from av_uploads.archive import stream_zip
+from av_uploads.downloads import get_slots, object_response
 from av_uploads.models import S3File
-from .utils import get_aws_v4_signature, get_aws_v4_signing_key, get_s3direct_destinations, get_s3_url
+from av_uploads.storage import LocalStorage, S3Storage, get_file_storage
+from .utils import get_aws_v4_signature, get_aws_v4_signing_key, get_s3direct_destinations, get_s3_url, \
+    get_part_count, get_preview_url, S3_MAX_PARTS, S3_PART_SIZE, S3_SIGN_PARTS, S3_URL_EXPIRES
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
 
 
 class UploadParamsView(APIView):
+    # key of the destination's allowed file sizes
+    length_range = 'content_length_range'
+    # files per presigned request, multipart uploads are started one at a time
+    max_files = 100
+    allows_presigned = True
 
     def get(self, request):
         upload_data = {
@@ -39,19 +60,42 @@ class UploadParamsView(APIView):
         return HttpResponse(json.dumps(upload_data), content_type='application/json')
 
     def post(self, request):
+        """
+        Creates the S3File and returns what the browser needs to upload it
+        With presigned=1, any number of file_name, file_type and file_size params may be given at once,
+        and each file comes back with a fully signed POST policy, so no further signing requests are needed
+        An optional file_sha256 per file lets a file already uploaded to the return be referenced instead,
+        those come back with duplicate set and the existing object_key, and must not be uploaded or completed
+        """
+        presigned = self.allows_presigned and bool(request.POST.get('presigned'))
+        file_names = request.POST.getlist('file_name')
+        file_types = request.POST.getlist('file_type')
+        file_sizes = request.POST.getlist('file_size')
+        file_hashes = [file_hash.lower() for file_hash in request.POST.getlist('file_sha256')]
         try:
-            file_name = request.POST['file_name']
-            file_type = request.POST['file_type']
-            file_size = request.POST['file_size']
             destination = get_s3direct_destinations().get(request.POST['destination'])
             year = request.POST['year']
         except MultiValueDictKeyError:
             return HttpResponseBadRequest(json.dumps({'error': 'Missing params.'}), content_type='application/json')
 
+        if not file_names or not file_types or not file_sizes:
+            return HttpResponseBadRequest(json.dumps({'error': 'Missing params.'}), content_type='application/json')
+        if not presigned:
+            # a single file, as before
+            file_names, file_types, file_sizes = file_names[-1:], file_types[-1:], file_sizes[-1:]
+            file_hashes = file_hashes[-1:]
+        elif not len(file_names) == len(file_types) == len(file_sizes) or len(file_names) > self.max_files:
+            return HttpResponseBadRequest(json.dumps({'error': 'Bad params.'}), content_type='application/json')
+        if not file_hashes:
+            file_hashes = [''] * len(file_names)
+        elif len(file_hashes) != len(file_names) or \
+                any(file_hash and not SHA256_RE.match(file_hash) for file_hash in file_hashes):
+            return HttpResponseBadRequest(json.dumps({'error': 'Bad params.'}), content_type='application/json')
+
         if not destination:
             return HttpResponseBadRequest(json.dumps({'error': 'File destination does not exist.'}), content_type='application/json')
         try:
-            file_size = int(file_size)
+            file_sizes = [int(file_size) for file_size in file_sizes]
         except ValueError:
             return HttpResponseBadRequest(json.dumps({'error': 'Bad params.'}), content_type='application/json')
 
@@ -68,28 +112,26 @@ class UploadParamsView(APIView):
         allowed = destination.get('allowed')
         auth = destination.get('auth')
         key = destination.get('key')
-        content_length_range = destination.get('content_length_range')
+        content_length_range = destination.get(self.length_range)
 
         if auth and not auth(request.user):
             return HttpResponseForbidden(json.dumps({'error': 'Permission denied.'}), content_type='application/json')
 
-        if (allowed and file_type not in allowed) and allowed != '*':
-            return HttpResponseBadRequest(json.dumps({'error': 'Invalid file type (%s).' % file_type}),
-                                          content_type='application/json')
+        for file_type, file_size in zip(file_types, file_sizes):
+            if (allowed and file_type not in allowed) and allowed != '*':
+                return HttpResponseBadRequest(json.dumps({'error': 'Invalid file type (%s).' % file_type}),
+                                              content_type='application/json')
 
-        if content_length_range and not content_length_range[0] <= file_size <= content_length_range[1]:
-            return HttpResponseBadRequest(
-                json.dumps({'error': 'Invalid file size (must be between %s and %s bytes).' % content_length_range}),
-                content_type='application/json')
+            if content_length_range and not content_length_range[0] <= file_size <= content_length_range[1]:
+                return HttpResponseBadRequest(
+                    json.dumps({'error': 'Invalid file size (must be between %s and %s bytes).' % content_length_range}),
+                    content_type='application/json')
 
         # Generate object key
         if not key:
             return HttpResponseServerError(json.dumps({'error': 'Missing destination path.'}),
                                            content_type='application/json')
-        file_id = uuid.uuid4().hex
         folder = str(request.user.id)
-        path = os.path.join(folder, file_id)
-        object_key = os.path.join(key, path)
 
         bucket = destination.get('bucket') or settings.AWS_BUCKET_NAME
         region = destination.get('region') or getattr(settings, 'AWS_REGION', None) or 'us-east-1'
@@ -101,7 +143,7 @@ class UploadParamsView(APIView):
         bucket_url = 'https://{0}/{1}'.format(endpoint, bucket)
 
         upload_data = {
-            'object_key': object_key,
+            'object_key': '',
             'access_key_id': access_key_id,
             'region': region,
             'bucket': bucket,
@@ -127,20 +169,93 @@ class UploadParamsView(APIView):
                 return HttpResponseNotFound(json.dumps({'error': 'No return found for given year.'}),
                                             content_type='application/json')
 
-        file = S3File(
-            user=request.user,
-            target_user=file_target,
-            tax_return=tax_return,
-            name=file_name,
-            type=file_type,
-            size=file_size,
-            s3_key=object_key,
-            s3_bucket=bucket,
-            s3_region=region,
-        )
-
-        file.save()
-
+        # content already uploaded to this return, looked up for the whole batch at once
+        # locked, so the object can't lose its last file and be deleted while another file starts sharing it
+        with transaction.atomic():
+            uploaded = defaultdict(list)
+            if any(file_hashes):
+                # only files whose object was checked on completion, see UploadCompleteView.verify
+                duplicates = S3File.objects.select_for_update().filter(
+                    tax_return=tax_return, uploaded=True,
+                    sha256__in={file_hash for file_hash in file_hashes if file_hash})
+                for file in duplicates.exclude(etag='').order_by('id'):
+                    uploaded[file.sha256].append(file)
+
+            files = [self.get_file(uploaded[file_hash], S3File(
+                user=request.user,
+                target_user=file_target,
+                tax_return=tax_return,
+                name=file_name,
+                type=file_type,
+                size=file_size,
+                sha256=file_hash,
+                s3_key=os.path.join(key, folder, uuid.uuid4().hex),
+                s3_bucket=bucket,
+                s3_region=region,
+            )) for file_name, file_type, file_size, file_hash in zip(file_names, file_types, file_sizes, file_hashes)]
+
+            if presigned:
+                S3File.objects.bulk_create([file for file in files if file.pk is None])
+            elif files[0].pk is None:
+                files[0].save()
+
+        if presigned:
+            return self.presigned_posts(files, upload_data, content_length_range)
+
+        file = files[0]
+        upload_data['object_key'] = file.s3_key
+        if file.uploaded:
+            upload_data['duplicate'] = True
+            return HttpResponse(json.dumps(upload_data), content_type='application/json')
+        return self.upload_created(file, upload_data)
+
+    def get_file(self, duplicates, file):
+        """
+        :param duplicates: uploaded files of the return with the same content, oldest first
+        :return: the uploader's own file of that name if there is one, otherwise the new file,
+            sharing the object of a duplicate uploaded by someone else or under another name
+        """
+        # a file of another size can't have the same content, whatever its hash says
+        duplicates = [duplicate for duplicate in duplicates if duplicate.size == file.size]
+        for duplicate in duplicates:
+            if (duplicate.user_id, duplicate.target_user_id, duplicate.name) == \
+                    (file.user_id, file.target_user_id, file.name):
+                return duplicate
+        if duplicates:
+            shared = duplicates[0]
+            file.s3_bucket, file.s3_key, file.s3_region = shared.s3_bucket, shared.s3_key, shared.s3_region
+            file.size, file.etag, file.preview_key = shared.size, shared.etag, shared.preview_key
+            file.preview_failed = shared.preview_failed
+            file.uploaded = True
+        return file
+
+    def presigned_posts(self, files, upload_data, content_length_range):
+        """
+        Signs a POST policy per file, limited to its key, type and the destination's headers and sizes
+        """
+        headers = {
+            'acl': upload_data['acl'],
+            'Cache-Control': upload_data['cache_control'],
+            'Content-Disposition': upload_data['content_disposition'],
+            'x-amz-server-side-encryption': upload_data['server_side_encryption'],
+        }
+        headers = {name: value for name, value in headers.items() if value}
+
+        posts = []
+        for file in files:
+            if file.uploaded:
+                posts.append({'name': file.name, 'object_key': file.s3_key, 'duplicate': True})
+                continue
+            fields = dict(headers, **{'Content-Type': file.type})
+            conditions = [{name: value} for name, value in fields.items()]
+            if content_length_range:
+                conditions.append(['content-length-range'] + list(content_length_range))
+            post = get_file_storage(file).presign_post(file.s3_key, fields, conditions, S3_URL_EXPIRES)
+            posts.append({'name': file.name, 'object_key': file.s3_key, 'url': post['url'], 'fields': post['fields']})
+
+        return HttpResponse(json.dumps({'files': posts}), content_type='application/json')
+
+    def upload_created(self, file, upload_data):
         return HttpResponse(json.dumps(upload_data), content_type='application/json')
 
 
@@ -154,31 +269,60 @@ class UploadSignatureView(APIView):
             return HttpResponseBadRequest(json.dumps({'error': 'Missing params.'}), content_type='application/json')
 
         try:
-            signing_date = datetime.strptime(signing_date, '%Y%m%dT%H%M%SZ')
+            signature = self.sign(message, signing_date)
         except ValueError:
             return HttpResponseBadRequest(json.dumps({'error': 'Bad params.'}), content_type='application/json')
+        return HttpResponse(signature)
 
+    def sign(self, message, signing_date):
+        signing_date = datetime.strptime(signing_date, '%Y%m%dT%H%M%SZ')
         signing_key = get_aws_v4_signing_key(settings.AWS_SECRET_ACCESS_KEY, signing_date, settings.AWS_REGION, 's3')
-        signature = get_aws_v4_signature(signing_key, message)
-        return HttpResponse(signature)
+        return get_aws_v4_signature(signing_key, message)
 
 
-class UploadCompleteView(APIView):
+class UploadSignaturesView(UploadSignatureView):
+    """
+    Signs many strings in one request, each to_sign param pairs with a datetime param, or all share a single one
+    """
+    max_signatures = 1000
 
     def post(self, request):
+        messages = [unquote(message) for message in request.POST.getlist('to_sign')]
+        signing_dates = request.POST.getlist('datetime')
+        if not messages or not signing_dates:
+            return HttpResponseBadRequest(json.dumps({'error': 'Missing params.'}), content_type='application/json')
+        if len(signing_dates) == 1:
+            signing_dates = signing_dates * len(messages)
+        if len(signing_dates) != len(messages) or len(messages) > self.max_signatures:
+            return HttpResponseBadRequest(json.dumps({'error': 'Bad params.'}), content_type='application/json')
+
         try:
-            object_key = request.POST['object_key']
-        except MultiValueDictKeyError:
+            signatures = [self.sign(message, signing_date) for message, signing_date in zip(messages, signing_dates)]
+        except ValueError:
+            return HttpResponseBadRequest(json.dumps({'error': 'Bad params.'}), content_type='application/json')
+        return HttpResponse(json.dumps({'signatures': signatures}), content_type='application/json')
+
+
+class UploadCompleteView(APIView):
+
+    def post(self, request):
+        # several object_key params complete a whole batch of presigned uploads at once
+        object_keys = set(request.POST.getlist('object_key'))
+        if not object_keys:
             return HttpResponseBadRequest(json.dumps({'error': 'Missing params.'}), content_type='application/json')
 
-        if not object_key:
+        if '' in object_keys:
             return HttpResponseNotFound(json.dumps({'error': 'No key provided.'}), content_type='application/json')
-        try:
-            file = S3File.objects.get(user=request.user, s3_key=object_key)
-        except S3File.DoesNotExist:
+        files = list(S3File.objects.filter(user=request.user, s3_key__in=object_keys))
+        # duplicates share a key, so a key may have several files
+        if len({file.s3_key for file in files}) != len(object_keys):
             return HttpResponseNotFound(json.dumps({'error': 'Key error.'}), content_type='application/json')
-        file.uploaded = True
-        file.save()
+        for file in files:
+            file.uploaded = True
+            if file.sha256 and not file.etag:
+                self.verify(file)
+            file.save()
+        previews.schedule(files)
 
         # removing this and relying instead on return state change notification
         # if file.target_user is not None:
@@ -186,14 +330,184 @@ class UploadCompleteView(APIView):
 
         return HttpResponse(json.dumps({'status': 'ok'}), content_type='application/json')
 
+    def verify(self, file):
+        """
+        The sha256 is only the browser's word, so a file is only offered for reuse, see UploadParamsView.get_file,
+        once its object turned out the size it declared, and with the etag s3 gave it
+        """
+        try:
+            head = get_file_storage(file).head(file.s3_key)
+        except (BotoCoreError, ClientError) as e:
+            logger.warn('Could not verify upload {}: {}'.format(file.s3_key, e))
+            head = None
+        if head is None or head['size'] != file.size:
+            file.sha256 = ''
+        else:
+            file.etag = head['etag']
+
+
+def json_response(data, response_class=HttpResponse):
+    return response_class(json.dumps(data), content_type='application/json')
+
+
+class MultipartUploadView(UploadParamsView):
+    """
+    Starts a multipart upload for large files, taking the same params as UploadParamsView
+    Parts are then PUT by the browser to urls from MultipartSignView, any number at a time and in any order
+    """
+    length_range = 'multipart_length_range'
+    allows_presigned = False
+
+    def upload_created(self, file, upload_data):
+        if not isinstance(get_file_storage(file), S3Storage):
+            file.delete()
+            return json_response({'error': 'Multipart uploads need s3 storage.'}, HttpResponseBadRequest)
+
+        params = {
+            'Bucket': file.s3_bucket,
+            'Key': file.s3_key,
+            'ContentType': file.type,
+        }
+        for param, value in (('ACL', upload_data['acl']),
+                             ('ServerSideEncryption', upload_data['server_side_encryption']),
+                             ('CacheControl', upload_data['cache_control']),
+                             ('ContentDisposition', upload_data['content_disposition'])):
+            if value:
+                params[param] = value
+
+        try:
+            file.upload_id = get_file_storage(file).client.create_multipart_upload(**params)['UploadId']
+        except (BotoCoreError, ClientError) as e:
+            logger.error('S3 multipart upload of {} could not start: {}'.format(file.s3_key, e))
+            file.delete()
+            return json_response({'error': 'Upload could not start.'}, HttpResponseServerError)
+        file.save()
+
+        upload_data['upload_id'] = file.upload_id
+        upload_data['part_size'] = S3_PART_SIZE
+        upload_data['part_count'] = get_part_count(file.size)
+        return json_response(upload_data)
+
+
+class MultipartMixin(object):
+    """
+    Finds the requesting user's file with a multipart upload in progress, from the object_key param
+    """
+    def get_upload(self, params):
+        object_key = params.get('object_key')
+        if not object_key:
+            return None
+        return S3File.objects.filter(user=self.request.user, s3_key=object_key).exclude(upload_id='').first()
+
+    def list_parts(self, file):
+        parts = []
+        params = {'Bucket': file.s3_bucket, 'Key': file.s3_key, 'UploadId': file.upload_id}
+        while True:
+            response = get_file_storage(file).client.list_parts(**params)
+            parts.extend(response.get('Parts', []))
+            if not response.get('IsTruncated'):
+                return parts
+            params['PartNumberMarker'] = response['NextPartNumberMarker']
+
+
+class MultipartSignView(MultipartMixin, APIView):
+    """
+    Presigned urls for uploading many parts at once, given as part_numbers=1,2,3
+    """
+    def post(self, request):
+        file = self.get_upload(request.POST)
+        if file is None:
+            return json_response({'error': 'Key error.'}, HttpResponseNotFound)
+
+        try:
+            part_numbers = sorted({int(number) for number in request.POST.get('part_numbers', '').split(',')})
+        except ValueError:
+            return json_response({'error': 'Bad params.'}, HttpResponseBadRequest)
+        if not 0 < len(part_numbers) <= S3_SIGN_PARTS or part_numbers[0] < 1 or part_numbers[-1] > S3_MAX_PARTS:
+            return json_response({'error': 'Bad params.'}, HttpResponseBadRequest)
+
+        client = get_file_storage(file).client
+        urls = {number: client.generate_presigned_url(
+            ClientMethod='upload_part',
+            Params={'Bucket': file.s3_bucket, 'Key': file.s3_key, 'UploadId': file.upload_id, 'PartNumber': number},
+            ExpiresIn=S3_URL_EXPIRES,
+        ) for number in part_numbers}
+        return json_response({'urls': urls})
+
+
+class MultipartPartsView(MultipartMixin, APIView):
+    """
+    Parts already uploaded, so an interrupted upload can carry on with the rest
+    """
+    def get(self, request):
+        file = self.get_upload(request.GET)
+        if file is None:
+            return json_response({'error': 'Key error.'}, HttpResponseNotFound)
+
+        parts = [{'part_number': part['PartNumber'], 'size': part['Size'], 'etag': part['ETag']}
+                 for part in self.list_parts(file)]
+        return json_response({'upload_id': file.upload_id, 'part_size': S3_PART_SIZE, 'parts': parts})
+
+
+class MultipartCompleteView(MultipartMixin, APIView):
+    """
+    Assembles the uploaded parts, as listed by s3, and marks the file uploaded
+    Only once every part the client sent, given as part_count, is there and they add up to the file's size
+    """
+    def post(self, request):
+        file = self.get_upload(request.POST)
+        if file is None:
+            return json_response({'error': 'Key error.'}, HttpResponseNotFound)
+
+        part_count = get_part_count(file.size)
+        if request.POST.get('part_count') != str(part_count):
+            return json_response({'error': 'Bad params.'}, HttpResponseBadRequest)
+
+        parts = self.list_parts(file)
+        if [part['PartNumber'] for part in parts] != list(range(1, part_count + 1)) \
+                or sum(part['Size'] for part in parts) != file.size:
+            return json_response({'error': 'Parts missing.'}, HttpResponseBadRequest)
+        try:
+            get_file_storage(file).client.complete_multipart_upload(
+                Bucket=file.s3_bucket, Key=file.s3_key, UploadId=file.upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': part['PartNumber'], 'ETag': part['ETag']} for part in parts]})
+        except ClientError as e:
+            logger.error('S3 multipart upload of {} could not complete: {}'.format(file.s3_key, e))
+            return json_response({'error': 'Upload could not complete.'}, HttpResponseBadRequest)
+
+        file.upload_id = ''
+        file.uploaded = True
+        file.save()
+        previews.schedule([file])
+        return json_response({'status': 'ok'})
+
+
+class MultipartAbortView(MultipartMixin, APIView):
+    """
+    Drops an unfinished upload along with its parts
+    """
+    def post(self, request):
+        file = self.get_upload(request.POST)
+        if file is None:
+            return json_response({'error': 'Key error.'}, HttpResponseNotFound)
+
+        try:
+            get_file_storage(file).client.abort_multipart_upload(Bucket=file.s3_bucket, Key=file.s3_key, UploadId=file.upload_id)
+        except ClientError as e:
+            # already gone on s3, the file should go too
+            logger.warn('S3 multipart upload of {} could not abort: {}'.format(file.s3_key, e))
+        file.delete()
+        return json_response({'status': 'ok'})
+
 
 class FileSerializer(serializers.HyperlinkedModelSerializer):
     url = serializers.SerializerMethodField('make_url')
     s3_url = serializers.SerializerMethodField()
+    preview_url = serializers.SerializerMethodField()
 
     def make_url(self, obj):
         kwargs = {
-            'year': obj.tax_return.year,
+            'year': self.context.get('year') or obj.tax_return.year,
             'pk': obj.id,
         }
         url = reverse('s3file-detail', kwargs=kwargs)
@@ -202,15 +516,80 @@ class FileSerializer(serializers.HyperlinkedModelSerializer):
     def get_s3_url(self, file):
         return get_s3_url(file)
 
+    def get_preview_url(self, file):
+        return get_preview_url(file)
+
     class Meta:
         model = S3File
-        fields = '__all__'
+        exclude = ('upload_id', 'etag', 'sha256', 'preview_key', 'preview_failed')
 
 
-class FileViewSet(viewsets.ModelViewSet):
+def url_template(request, name, **kwargs):
+    """
+    Absolute url of a detail route with {} in place of the pk, so listed rows don't each call reverse()
+    """
+    url = request.build_absolute_uri(reverse(name, kwargs=dict(kwargs, pk='__pk__')))
+    return url.replace('__pk__', '{}')
+
+
+class FileReadSerializer(serializers.BaseSerializer):
+    """
+    Same output as FileSerializer for listing and retrieving, built straight from the row
+    Expects url templates for s3file, avuser and return details in the context, see FileViewSetMixin
+    """
+    read_fields = ('name', 'type', 'size', 's3_key', 's3_bucket', 's3_region', 'description', 'uploaded')
+    datetime_field = serializers.DateTimeField()
+
+    def to_representation(self, file):
+        urls = self.context['url_templates']
+        data = {
+            'url': urls['file'].format(file.id),
+            's3_url': get_s3_url(file),
+            'preview_url': get_preview_url(file),
+            'date_created': self.datetime_field.to_representation(file.date_created),
+            'date_modified': self.datetime_field.to_representation(file.date_modified),
+        }
+        for name in self.read_fields:
+            data[name] = getattr(file, name)
+        data['user'] = urls['user'].format(file.user_id)
+        data['target_user'] = urls['user'].format(file.target_user_id) if file.target_user_id else None
+        data['tax_return'] = urls['return'].format(file.tax_return_id)
+        return data
+
+
+class FileCursorPagination(CursorPagination):
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    ordering = ('-date_created', '-id')
+
+
+class FileViewSetMixin(object):
+    """
+    Lists files a page at a time in a constant number of queries, writes still go through FileSerializer
+    """
     queryset = S3File.objects.all()
     serializer_class = FileSerializer
+    pagination_class = FileCursorPagination
     model = S3File
+
+    def get_serializer_class(self):
+        if self.action in ('list', 'retrieve'):
+            return FileReadSerializer
+        return self.serializer_class
+
+    def get_serializer_context(self):
+        context = super(FileViewSetMixin, self).get_serializer_context()
+        context['year'] = self.kwargs['year']
+        context['url_templates'] = {
+            'file': url_template(self.request, 's3file-detail', year=self.kwargs['year']),
+            'user': url_template(self.request, 'avuser-detail'),
+            'return': url_template(self.request, 'return-detail'),
+        }
+        return context
+
+
+class FileViewSet(FileViewSetMixin, viewsets.ModelViewSet):
     http_method_names = ['get', 'patch', 'head', 'delete']
 
     def get_queryset(self):
@@ -221,16 +600,8 @@ class FileViewSet(viewsets.ModelViewSet):
         else:
             return self.model.objects.filter(user=self.request.user, tax_return__year=year)
 
-    def get_serializer_context(self):
-        context = super(FileViewSet, self).get_serializer_context()
-        context['year'] = self.kwargs['year']
-        return context
-
 
-class CpaFileViewSet(viewsets.ModelViewSet):
-    queryset = S3File.objects.all()
-    serializer_class = FileSerializer
-    model = S3File
+class CpaFileViewSet(FileViewSetMixin, viewsets.ModelViewSet):
     http_method_names = ['get', 'patch', 'head', 'delete']
 
     def get_queryset(self):
@@ -240,15 +611,11 @@ class CpaFileViewSet(viewsets.ModelViewSet):
 
     def get_serializer_context(self):
         context = super(CpaFileViewSet, self).get_serializer_context()
-        context['year'] = self.kwargs['year']
         context['target'] = self.kwargs['target']
         return context
 
 
-class DownloadsViewSet(viewsets.ModelViewSet):
-    queryset = S3File.objects.all()
-    serializer_class = FileSerializer
-    model = S3File
+class DownloadsViewSet(FileViewSetMixin, viewsets.ModelViewSet):
     http_method_names = ['get', 'head']
 
     def get_queryset(self):
@@ -260,13 +627,78 @@ class UploadUrlView(FullRequiredMixin, View):
     """
     generates s3 urls and corresponding redirects
     ensures that files are only accessible by their creator, their target, or by cpa whose firm matches the file user's
+    with UPLOAD_PROXY_DOWNLOADS or ?proxy=1 the file is streamed through the app instead, for networks blocking s3
     """
     def get(self, request, id):
         file = get_object_or_404(S3File, id=id)
         if file.user == self.request.user \
                 or file.target_user == self.request.user \
                 or (self.request.user.is_cpa and file.user.firm == self.request.user.firm):
+            if not file.s3_bucket or not file.s3_key:
+                return HttpResponseNotFound()
+            if settings.UPLOAD_PROXY_DOWNLOADS or request.GET.get('proxy'):
+                return object_response(request, get_file_storage(file), file.s3_key, file.type,
+                                       'attachment; filename={}'.format(file.name), get_slots())
+
             url = get_s3_url(file)
             return HttpResponseRedirect(url)
         else:
             return HttpResponseForbidden()
+
+
+class UploadZipView(FullRequiredMixin, View):
+    """
+    streams a zip of all files uploaded for a return, or of those picked with ?id=
+    accessible by the return's user, or by cpa whose firm matches theirs
+    """
+    def get(self, request, id):
+        tax_return = get_object_or_404(Return.objects.select_related('user'), id=id)
+        user = self.request.user
+        if tax_return.user != user \
+                and not (user.is_cpa and user.firm_id is not None and tax_return.user.firm_id == user.firm_id):
+            return HttpResponseForbidden()
+
+        files = S3File.objects.filter(tax_return=tax_return, uploaded=True).order_by('id')
+        ids = [file_id for file_id in request.GET.getlist('id') if file_id.isdigit()]
+        if ids:
+            files = files.filter(id__in=ids)
+
+        response = StreamingHttpResponse(stream_zip(files), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="{} {}.zip"'.format(
+            tax_return.user.get_full_name() or tax_return.user.email, tax_return.year)
+        return response
+
+
+class LocalStorageView(View):
+    """
+    Serves an object of a local storage destination from a presigned url, see LocalStorage
+    Supports single byte ranges, so pdf viewers and media players can seek without fetching everything
+    """
+    def get(self, request, token):
+        try:
+            params = LocalStorage.unsign(token)
+        except signing.BadSignature:
+            return HttpResponseForbidden()
+        return object_response(request, params['storage'], params['key'], params['type'], params['disposition'],
+                               get_slots())
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class LocalUploadView(View):
+    """
+    Takes the form POST of a presigned upload to a local storage destination, checked like s3 checks its policies
+    """
+    def post(self, request):
+        try:
+            params = LocalStorage.unsign(request.POST['policy'])
+            upload = request.FILES['file']
+        except (MultiValueDictKeyError, signing.BadSignature):
+            return HttpResponseForbidden()
+
+        if request.POST.get('key') != params['key'] or request.POST.get('Content-Type') != params['type']:
+            return HttpResponseForbidden()
+        if params['length_range'] and not params['length_range'][0] <= upload.size <= params['length_range'][1]:
+            return HttpResponseBadRequest()
+
+        params['storage'].put(params['key'], upload.chunks(), params['type'])
+        return HttpResponse(status=204)
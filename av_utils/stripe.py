@@ -2,6 +2,9 @@ from collections import namedtuple
 
 Customer = namedtuple('Customer', 'id subscriptions')
 Items = namedtuple('Items', 'data')
-Subscription = namedtuple('Subscription', 'id plan')
-Plan = namedtuple('Plan', 'id metadata')
+Subscription = namedtuple('Subscription', 'id plan status trial_end current_period_end')
+Subscription.__new__.__defaults__ = ('active', None, None)
+Plan = namedtuple('Plan', 'id metadata interval')
+Plan.__new__.__defaults__ = ('month',)
 MetaData = namedtuple('MetaData', 'name support max_cpa max_client')
+PricedPlan = namedtuple('PricedPlan', 'id amount interval nickname metadata')
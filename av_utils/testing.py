@@ -0,0 +1,39 @@
+from unittest.mock import patch
+
+from django.db import connection, transaction
+
+
+class CommitCallbacksMixin(object):
+    """
+    Runs transaction.on_commit callbacks of a TestCase as if the test ran in autocommit
+    TestCase wraps each test in a transaction that never commits, so they would not run at all otherwise
+    Callbacks registered in an atomic block run as the outermost one exits, and are dropped if it rolls back
+    """
+    def setUp(self):
+        super(CommitCallbacksMixin, self).setUp()
+        # the test's own transaction stands in for autocommit
+        depth = len(connection.savepoint_ids)
+
+        def run_on_commit():
+            if len(connection.savepoint_ids) != depth:
+                return
+            callbacks, connection.run_on_commit = connection.run_on_commit, []
+            for sids, func in callbacks:
+                func()
+
+        connection_on_commit = connection.on_commit
+        atomic_exit = transaction.Atomic.__exit__
+
+        def on_commit(func):
+            connection_on_commit(func)
+            run_on_commit()
+
+        def exit(atomic, exc_type, exc_value, traceback):
+            atomic_exit(atomic, exc_type, exc_value, traceback)
+            if exc_type is None:
+                run_on_commit()
+
+        for patcher in (patch.object(connection, 'on_commit', on_commit),
+                        patch.object(transaction.Atomic, '__exit__', exit)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
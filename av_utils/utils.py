@@ -3,6 +3,7 @@ from crispy_forms.layout import BaseInput
 from django.conf import settings
 from django.contrib import messages
 from django.db import models
+from django.db.models import Case, Value, When
 from django.shortcuts import _get_queryset
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
@@ -117,3 +118,21 @@ def get_object_or_this(model, this=None, *args, **kwargs):
     """
 
     return get_object_or_None(model, *args, **kwargs) or this
+
+
+def bulk_update(model, objs, fields, batch_size=500):
+    """
+    Saves the given fields of many objects with a single UPDATE per batch,
+    standing in for QuerySet.bulk_update which only arrives in Django 2.2
+
+    Note: like QuerySet.update(), auto_now fields and save signals are skipped.
+    """
+    objs = list(objs)
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        updates = {}
+        for name in fields:
+            field = model._meta.get_field(name)
+            whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in batch]
+            updates[field.attname] = Case(*whens, output_field=field)
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(**updates)
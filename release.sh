@@ -3,4 +3,7 @@
 # release phase commands for all apps
 
 python manage.py migrate
+python manage.py createcachetable
+# best effort, get_plans() fills the cache on first use if stripe is unreachable now
+python manage.py plans || echo "Could not warm the Stripe plan cache"
 